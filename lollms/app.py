@@ -8,8 +8,21 @@ from lollms.helpers import ASCIIColors, trace_exception
 from lollms.com import NotificationType, NotificationDisplayType, LoLLMsCom
 from lollms.terminal import MainMenu
 from lollms.utilities import PromptReshaper
+from lollms.scheduler import GenerationScheduler, SchedulerLane
+from lollms.batching import ContinuousBatcher
+from lollms.prefix_cache import PrefixCache
+from lollms.response_cache import ResponseCache
+from lollms.model_pool import ModelPool
+from lollms.speculative import SpeculativeDecoder, build_draft_binding
+from lollms.embeddings import EmbeddingBatcher
+from lollms.binding_workers import BindingWorkerPool, BindingWorkersModel
+from lollms.types import MSG_TYPE
+from lollms.generation import TOKEN_USAGE, GENERATION_TIMINGS, track_usage, track_timings, current_timings
+from lollms.metrics import metrics
+from lollms.tracing import setup_tracing
 from safe_store import TextVectorizer, VectorizationMethod, VisualizationMethod
-from typing import Callable
+from typing import Callable, List
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 from functools import partial
@@ -18,6 +31,7 @@ import subprocess
 import importlib
 import sys, os
 import platform
+import time
 
 
 class LollmsApplication(LoLLMsCom):
@@ -56,6 +70,35 @@ class LollmsApplication(LoLLMsCom):
 
         self.tts                        = None
 
+        # Every generation goes through the scheduler (requests are queued instead of rejected)
+        self.scheduler                  = GenerationScheduler(on_position=self.notify_queue_position, max_workers=self.config.generation_workers)
+        # Only used when the binding supports continuous batching
+        self.batcher:ContinuousBatcher  = None
+        # Only used when the binding supports state snapshots
+        self.prefix_cache:PrefixCache   = None
+        self.response_cache:ResponseCache = None
+        # Only used when speculative decoding is enabled and the binding supports token scoring
+        self.speculative_decoder:SpeculativeDecoder = None
+        # Merges the concurrent embedding requests into embed_batch calls
+        self.embedding_batcher          = EmbeddingBatcher(self.config.embedding_batch_size, self.config.embedding_batch_max_wait/1000, self.scheduler)
+        # Keeps several models loaded (requests are routed with their model name)
+        self.model_pool:ModelPool       = ModelPool(self, self.config.model_pool_max_memory*1024*1024) if self.config.model_pool_enabled else None
+        if self.config.response_cache_enabled:
+            self.response_cache = ResponseCache(
+                                                    self.config.response_cache_max_entries,
+                                                    self.config.response_cache_ttl,
+                                                    self.lollms_paths.personal_cache_path/"responses" if self.config.response_cache_use_disk else None
+                                                )
+        # Spans of the generation pipeline (only when tracing is enabled)
+        setup_tracing(self.config, self.lollms_paths)
+        # Gauges evaluated when /metrics is scraped
+        metrics.gauge("lollms_queue_depth", "Number of generation jobs waiting in the scheduler", lambda: self.scheduler.queue_depth)
+        metrics.gauge("lollms_running_generations", "Number of generation jobs being executed", lambda: self.scheduler.get_status()["running"])
+        metrics.gauge("lollms_generation_workers_active", "Number of generation workers running a job", lambda: self.scheduler.workers.active)
+        metrics.gauge("lollms_generation_workers_waiting", "Number of generation jobs waiting for a free worker", lambda: self.scheduler.workers.waiting)
+        metrics.gauge("lollms_batch_active_sequences", "Number of sequences in the continuous batch", lambda: self.batcher.nb_active_sequences if self.batcher is not None else 0)
+        metrics.gauge("lollms_model_pool_memory_bytes", "Estimated memory used by the models of the model pool", lambda: self.model_pool.memory if self.model_pool is not None else 0)
+
         if not free_mode:
             try:
                 if config.auto_update:
@@ -185,25 +228,30 @@ class LollmsApplication(LoLLMsCom):
         ASCIIColors.green(f"Received {generation_infos['nb_received_tokens']} tokens (speed: {spd:.2f}t/s)              ",end="\r",flush=True) 
         sys.stdout = sys.__stdout__
         sys.stdout.flush()
+        detector = generation_infos.get("antiprompt_detector")
+        if detector is None or detector.position!=len(generation_infos["generated_text"]):
+            detector = generation_infos["antiprompt_detector"] = self.personality.antiprompt_detector.clone()
+            detector.feed(generation_infos["generated_text"])
         if chunk:
             generation_infos["generated_text"] += chunk
-        antiprompt = self.personality.detect_antiprompt(generation_infos["generated_text"])
-        if antiprompt:
+            detector.feed(chunk)
+        if detector.match:
+            antiprompt, offset = detector.match
             ASCIIColors.warning(f"\nDetected hallucination with antiprompt: {antiprompt}")
-            generation_infos["generated_text"] = self.remove_text_from_string(generation_infos["generated_text"],antiprompt)
+            generation_infos["generated_text"] = generation_infos["generated_text"][:offset]
             return False
         else:
             generation_infos["nb_received_tokens"] += 1
             generation_infos["first_chunk"]=False
             # if stop generation is detected then stop
-            if not self.cancel_gen:
+            cancellation_token = self.scheduler.current_cancellation_token()
+            if cancellation_token is None or not cancellation_token.canceled:
                 return True
             else:
-                self.cancel_gen = False
                 ASCIIColors.warning("Generation canceled")
                 return False
                 
-    def learn_from_discussion(self, title, discussion, nb_gen=None, callback=None):
+    def learn_from_discussion(self, title, discussion, nb_gen=None, callback=None, lane:SchedulerLane=SchedulerLane.INTERACTIVE):
         if self.config.summerize_discussion:
             prompt = f"!@>discussion:\n--\n!@>title:{title}!@>content:\n{discussion}\n--\n!@>question:What should we learn from this discussion?!@>Summerizer: Here is a summary of the most important informations extracted from the discussion:\n"
             if nb_gen is None:
@@ -217,7 +265,7 @@ class LollmsApplication(LoLLMsCom):
             }
             if callback is None:
                 callback = partial(self.default_callback, generation_infos=gen_infos)
-            self.model.generate(prompt, nb_gen, callback)
+            self.scheduler.run(self.generate_text, prompt, nb_gen, callback, lane=lane)
             if self.config.debug:
                 ASCIIColors.yellow(gen_infos["generated_text"])
             return gen_infos["generated_text"]
@@ -242,33 +290,201 @@ class LollmsApplication(LoLLMsCom):
 
         return string
 
-    def safe_generate(self, full_discussion:str, n_predict=None, callback: Callable[[str, int, dict], bool]=None, placeholder={}, place_holders_to_sacrifice=[], debug=False):
+    def safe_generate(self, full_discussion:str, n_predict=None, callback: Callable[[str, int, dict], bool]=None, placeholder={}, place_holders_to_sacrifice=[], debug=False, timings:GENERATION_TIMINGS=None, lane:SchedulerLane=SchedulerLane.INTERACTIVE):
         """safe_generate
 
         Args:
             full_discussion (string): A prompt or a long discussion to use for generation
             callback (_type_, optional): A callback to call for each received token. Defaults to None.
+            timings (GENERATION_TIMINGS, optional): Receives the time spent in each step (prompt building, tokenization, decode...). Defaults to None.
+            lane (SchedulerLane, optional): Scheduler lane of the generation when it isn't called from a running job. Defaults to SchedulerLane.INTERACTIVE.
+
+        Returns:
+            str: Model output
+        """
+        timings = timings if timings is not None else current_timings()
+
+        def generate():
+            with track_timings(timings):
+                job = self.scheduler.current_job()
+                if timings is not None and job is not None:
+                    timings.set_first("queue", job.wait_time)
+                nonlocal full_discussion, n_predict, callback
+                full_discussion = PromptReshaper(full_discussion).build(placeholder, self.model.tokenizer_cache.tokenize, self.model.tokenizer_cache.detokenize, max_nb_tokens=self.config.ctx_size-n_predict, place_holders_to_sacrifice=place_holders_to_sacrifice )
+                if debug:
+                    ASCIIColors.yellow(full_discussion)
+                if n_predict == None:
+                    n_predict =self.personality.model_n_predicts
+                self.bot_says = ""
+                if self.personality.processor is not None and self.personality.processor_cfg["custom_workflow"]:
+                    ASCIIColors.info("processing...")
+                    if timings is not None:
+                        callback = timings.track_decode(callback)
+                    generated_text = self.personality.processor.run_workflow(full_discussion.split("!@>")[-1] if "!@>" in full_discussion else full_discussion, previous_discussion_text=self.personality.personality_conditioning+fd, callback=callback)
+                else:
+                    ASCIIColors.info("generating...")
+                    # Goes through the cancellation checks, metrics, batcher and speculative decoder
+                    generated_text = self.generate_text(full_discussion, n_predict=n_predict, callback=callback, model=self.personality.model, timings=timings)
+            return generated_text
+        # Executed inline when called from a running job
+        return self.scheduler.run(generate, lane=lane)
+
+    def generate_text(self, prompt:str, n_predict:int=128, callback: Callable[[str, int, dict], bool]=None, model:LLMBinding=None, usage:TOKEN_USAGE=None, timings:GENERATION_TIMINGS=None, **gpt_params):
+        """
+        Generates text with the current model.
+        When the binding supports continuous batching, the request joins the shared decode loop.
+        Otherwise, when speculative decoding is enabled, the draft model proposes the tokens.
+        Bindings with an async client (overriding LLMBinding.agenerate) generate through it.
+        The token counts and latencies are recorded in the server metrics.
+
+        Args:
+            prompt (str): The prompt to use for generation
+            n_predict (int, optional): Number of tokens to predict. Defaults to 128.
+            callback (Callable[[str, int, dict], bool], optional): A callback called for each received chunk. Defaults to None.
+            model (LLMBinding, optional): Another model of the model pool to use instead of the active one. Defaults to None.
+            usage (TOKEN_USAGE, optional): Receives the token counts (one per received chunk, or the exact ones reported by the binding). Defaults to None.
+            timings (GENERATION_TIMINGS, optional): Receives the time spent in queue, tokenization, prefill and decode. Defaults to None.
 
         Returns:
             str: Model output
         """
-        full_discussion = PromptReshaper(full_discussion).build(placeholder, self.model.tokenize, self.model.detokenize, max_nb_tokens=self.config.ctx_size-n_predict, place_holders_to_sacrifice=place_holders_to_sacrifice )
-        if debug:
-            ASCIIColors.yellow(full_discussion)
-        if n_predict == None:
-            n_predict =self.personality.model_n_predicts
-        self.bot_says = ""
-        if self.personality.processor is not None and self.personality.processor_cfg["custom_workflow"]:
-            ASCIIColors.info("processing...")
-            generated_text = self.personality.processor.run_workflow(full_discussion.split("!@>")[-1] if "!@>" in full_discussion else full_discussion, previous_discussion_text=self.personality.personality_conditioning+fd, callback=callback)
+        if model is None or model is self.model:
+            model = self.model
+            if self.batcher is not None:
+                generate = self.batcher.generate
+            elif self.speculative_decoder is not None:
+                generate = self.speculative_decoder.generate
+            else:
+                generate = model.generate
         else:
-            ASCIIColors.info("generating...")
-            generated_text = self.personality.model.generate(full_discussion, n_predict=n_predict, callback=callback)
-        return generated_text
+            generate = model.generate
+        if generate==model.generate and isinstance(model, LLMBinding) and model.has_native_agenerate:
+            # Bindings with an async client generate through their agenerate
+            generate = model.generate_from_agenerate
+        model_config = model.config if isinstance(model, LLMBinding) else self.config
+        cancellation_token = self.scheduler.current_cancellation_token()
+        if usage is None:
+            usage = TOKEN_USAGE()
+        timings = timings if timings is not None else current_timings()
+        if timings is not None:
+            job = self.scheduler.current_job()
+            if job is not None:
+                timings.set_first("queue", job.wait_time)
+            callback = timings.track_decode(callback)
+        labels = {"binding":model_config.binding_name, "model":model_config.model_name}
+        start_time = time.perf_counter()
+        last_chunk_time = None
+        # Count the tokens and record the latencies as they arrive, and stop at the next chunk when the request is canceled
+        user_callback = callback
+        def callback(chunk, message_type:MSG_TYPE=MSG_TYPE.MSG_TYPE_CHUNK, *args, **kwargs):
+            nonlocal last_chunk_time
+            if chunk is not None and message_type==MSG_TYPE.MSG_TYPE_CHUNK:
+                usage.count_chunk()
+                now = time.perf_counter()
+                if last_chunk_time is None:
+                    metrics.observe("lollms_time_to_first_token_seconds", now-start_time, **labels)
+                else:
+                    metrics.observe("lollms_inter_token_latency_seconds", now-last_chunk_time, **labels)
+                last_chunk_time = now
+            if cancellation_token is not None and cancellation_token.canceled:
+                return False
+            if user_callback is not None:
+                return user_callback(chunk, message_type, *args, **kwargs)
+            return True
+        try:
+            with track_usage(usage), track_timings(timings):
+                if self.response_cache is not None:
+                    return self.response_cache.generate(generate, prompt, n_predict, callback=callback, model_name=model_config.model_name, binding_name=model_config.binding_name, cancellation_token=cancellation_token, **gpt_params)
+                return generate(prompt, n_predict, callback=callback, **gpt_params)
+        except Exception:
+            metrics.inc("lollms_errors_total", source="generation")
+            raise
+        finally:
+            duration = time.perf_counter()-start_time
+            if usage.prompt_tokens==0 and isinstance(model, LLMBinding):
+                usage.prompt_tokens = len(model.tokenizer_cache.tokenize(prompt))
+            metrics.inc("lollms_generations_total", **labels)
+            metrics.inc("lollms_prompt_tokens_total", usage.prompt_tokens, **labels)
+            metrics.inc("lollms_completion_tokens_total", usage.completion_tokens, **labels)
+            metrics.inc("lollms_generation_seconds_total", duration, **labels)
+            if usage.completion_tokens>0 and duration>0:
+                metrics.observe("lollms_tokens_per_second", usage.completion_tokens/duration, **labels)
+
+    def _prewarm_prompt(self, model:LLMBinding, prompt:str, timings:GENERATION_TIMINGS=None):
+        with track_timings(timings):
+            model.prewarm_prefix(model.tokenizer_cache.tokenize(prompt))
+
+    def generate_choices(self, prompt:str, n_predict:int=128, callbacks:List[Callable[[str, int, dict], bool]]=None, nb_choices:int=None, model:LLMBinding=None, usages:List[TOKEN_USAGE]=None, timings:GENERATION_TIMINGS=None, **gpt_params) -> List[str]:
+        """
+        Generates several completions of the same prompt (n/best_of sampling).
+
+        The prompt is prefilled once: with a prefix cache, the state after the prompt is stored
+        before the branches start and every branch restores it. The branches then run in parallel,
+        in the decode loop of the batcher for batch capable bindings, or in a thread pool limited
+        to max_concurrent_generations otherwise. The calling job holds one scheduler slot, the
+        other parallel branches take the free slots of the scheduler (the branches run one after
+        the other when the other jobs use all of them). When a seed is given, branch i uses seed+i.
+
+        Args:
+            prompt (str): The prompt to use for generation
+            n_predict (int, optional): Number of tokens to predict per choice. Defaults to 128.
+            callbacks (List[Callable[[str, int, dict], bool]], optional): One callback per choice. Defaults to None.
+            nb_choices (int, optional): Number of choices when no callbacks are given. Defaults to None.
+            model (LLMBinding, optional): Another model of the model pool to use instead of the active one. Defaults to None.
+            usages (List[TOKEN_USAGE], optional): One usage per choice receiving its token counts. Defaults to None.
+            timings (GENERATION_TIMINGS, optional): Receives the time spent in each step (shared by the choices). Defaults to None.
+
+        Returns:
+            List[str]: The output of each choice
+        """
+        nb_choices = len(callbacks) if callbacks is not None else max(1, nb_choices or 1)
+        if model is None:
+            model = self.model
+        if gpt_params.get("seed") is None:
+            # No seed: the binding uses its own
+            gpt_params.pop("seed", None)
+        if nb_choices==1:
+            return [self.generate_text(prompt, n_predict, callback=callbacks[0] if callbacks is not None else None, model=model, usage=usages[0] if usages is not None else None, timings=timings, **gpt_params)]
+
+        job = self.scheduler.current_job()
+        if timings is not None and job is not None:
+            timings.set_first("queue", job.wait_time)
+        if isinstance(model, LLMBinding) and model.prefix_cache is not None:
+            # Executed inline when called from a running job
+            self.scheduler.run(self._prewarm_prompt, model, prompt, timings, lane=SchedulerLane.BACKGROUND)
+        if model is self.model and self.batcher is not None:
+            max_workers = min(nb_choices, self.batcher.max_batch_size)
+        elif isinstance(model, LLMBinding):
+            max_workers = min(nb_choices, model.binding_config.get("max_concurrent_generations", 1))
+        else:
+            max_workers = 1
+
+        # The branches run outside of the scheduler job so they get its cancellation token explicitly
+        cancellation_token = self.scheduler.current_cancellation_token()
+        def generate_choice(index:int):
+            params = dict(gpt_params)
+            if params.get("seed") is not None and params["seed"]>=0:
+                params["seed"] += index
+            user_callback = callbacks[index] if callbacks is not None else None
+            def callback(chunk, message_type:MSG_TYPE=MSG_TYPE.MSG_TYPE_CHUNK, *args, **kwargs):
+                if cancellation_token is not None and cancellation_token.canceled:
+                    return False
+                if user_callback is not None:
+                    return user_callback(chunk, message_type, *args, **kwargs)
+                return True
+            return self.generate_text(prompt, n_predict, callback=callback, model=model, usage=usages[index] if usages is not None else None, timings=timings, **params)
+
+        with self.scheduler.reserve_slots(max_workers-1) as nb_reserved:
+            nb_workers = 1+nb_reserved
+            if nb_workers<=1:
+                return [generate_choice(index) for index in range(nb_choices)]
+            with ThreadPoolExecutor(nb_workers, thread_name_prefix="lollms-choice") as pool:
+                return list(pool.map(generate_choice, range(nb_choices)))
 
     def load_binding(self):
         try:
             binding = BindingBuilder().build_binding(self.config, self.lollms_paths, lollmsCom=self)
+            self.scheduler.set_concurrency(binding.binding_config.get("max_concurrent_generations", 1))
             return binding    
         except Exception as ex:
             self.error("Couldn't load binding")
@@ -276,6 +492,7 @@ class LollmsApplication(LoLLMsCom):
             trace_exception(ex)
             try:
                 binding = BindingBuilder().build_binding(self.config, self.lollms_paths,installation_option=InstallOption.FORCE_INSTALL, lollmsCom=self)
+                self.scheduler.set_concurrency(binding.binding_config.get("max_concurrent_generations", 1))
             except Exception as ex:
                 self.error("Couldn't reinstall binding")
                 trace_exception(ex)
@@ -284,10 +501,23 @@ class LollmsApplication(LoLLMsCom):
     
     def load_model(self):
         try:
-            model = ModelBuilder(self.binding).get_model()
+            if self.config.binding_workers>0:
+                # The generations run in worker processes. The model is only built in the server process
+                # when asked (tokenization and embeddings go to the workers otherwise)
+                if isinstance(self.model, BindingWorkersModel):
+                    self.model.pool.shutdown()
+                local_model = self.config.binding_workers_local_model
+                model = ModelBuilder(self.binding).get_model() if local_model else self.binding
+                if model is not None:
+                    model = BindingWorkersModel(model, BindingWorkerPool(self.config, self.lollms_paths, self.config.binding_workers, self.config.binding_workers_restart_delay), local_model)
+            else:
+                model = ModelBuilder(self.binding).get_model()
             for personality in self.mounted_personalities:
                 if personality is not None:
                     personality.model = model
+            self.setup_model(model)
+            if self.model_pool is not None and model is not None:
+                self.model_pool.register(self.binding, model)
         except Exception as ex:
             self.error("Couldn't load model.")
             ASCIIColors.error(f"Couldn't load model. Please verify your configuration file at {self.lollms_paths.personal_configuration_path} or use the next menu to select a valid model")
@@ -300,6 +530,86 @@ class LollmsApplication(LoLLMsCom):
         return model
 
 
+    def setup_model(self, model):
+        """Prepares the generation helpers (continuous batching, prefix cache) of the active model."""
+        if self.batcher is not None:
+            # The decode loop of the previous model must not outlive it
+            self.batcher.stop()
+            self.batcher = None
+        if isinstance(model, LLMBinding) and model.supports_batching():
+            self.batcher = ContinuousBatcher(model, model.binding_config.get("max_batch_size", 8))
+            # Let the scheduler feed the whole batch
+            self.scheduler.set_concurrency(max(self.batcher.max_batch_size, model.binding_config.get("max_concurrent_generations", 1)))
+        else:
+            self.batcher = None
+            if isinstance(model, BindingWorkersModel):
+                # Enough concurrent jobs to keep every worker process busy
+                self.scheduler.set_concurrency(max(model.pool.nb_workers, model.binding_config.get("max_concurrent_generations", 1)))
+            elif isinstance(model, LLMBinding):
+                self.scheduler.set_concurrency(model.binding_config.get("max_concurrent_generations", 1))
+        if isinstance(model, LLMBinding) and model.supports_state_snapshot() and self.config.prefix_cache_enabled:
+            self.prefix_cache = PrefixCache(self.config.prefix_cache_max_memory*1024*1024)
+            model.prefix_cache = self.prefix_cache
+        else:
+            self.prefix_cache = None
+        self.setup_speculative_decoding(model)
+
+    def setup_speculative_decoding(self, model):
+        """Loads the draft model when speculative decoding is enabled and the model supports token scoring."""
+        previous_decoder = self.speculative_decoder
+        self.speculative_decoder = None
+        if not self.config.speculative_decoding_enabled or self.config.speculative_draft_model_name is None:
+            return
+        if not isinstance(model, LLMBinding) or not model.supports_token_scoring() or self.batcher is not None:
+            ASCIIColors.warning("Speculative decoding is enabled but the current binding doesn't support token scoring")
+            return
+        draft_binding_name = self.config.speculative_draft_binding_name or model.config.binding_name
+        try:
+            if previous_decoder is not None and previous_decoder.draft_binding.config.binding_name==draft_binding_name and previous_decoder.draft_binding.config.model_name==self.config.speculative_draft_model_name:
+                draft_binding = previous_decoder.draft_binding
+            else:
+                if previous_decoder is not None:
+                    previous_decoder.draft_binding.destroy_model()
+                draft_binding = build_draft_binding(self, draft_binding_name, self.config.speculative_draft_model_name)
+            if not draft_binding.supports_token_scoring():
+                raise RuntimeError(f"The draft binding {draft_binding_name} doesn't support token scoring")
+            self.speculative_decoder = SpeculativeDecoder(
+                                                            model,
+                                                            draft_binding,
+                                                            self.config.speculative_nb_draft_tokens,
+                                                            self.config.speculative_min_acceptance_rate
+                                                        )
+            ASCIIColors.success(f"Speculative decoding enabled with draft model {self.config.speculative_draft_model_name}")
+        except Exception as ex:
+            trace_exception(ex)
+            self.error(f"Couldn't load the draft model {self.config.speculative_draft_model_name}, speculative decoding is disabled")
+
+    def select_model(self, model_name:str, binding_name:str=None):
+        """
+        Loads a model through the model pool in the background and makes it the active
+        model once it is ready. The current model keeps serving in the meantime.
+
+        Returns:
+            Future: Resolved with the model pool entry once the model is active.
+        """
+        future = self.model_pool.load(model_name, binding_name)
+        def activate(future):
+            if future.exception() is not None:
+                self.error(f"Couldn't load model {model_name}")
+                return
+            entry = future.result()
+            self.config["binding_name"] = entry.binding_name
+            self.config["model_name"] = entry.model_name
+            self.binding = entry.binding
+            self.model = entry.model
+            for personality in self.mounted_personalities:
+                if personality is not None:
+                    personality.model = entry.model
+            self.setup_model(entry.model)
+            ASCIIColors.success(f"Model {model_name} is now the active model")
+        future.add_done_callback(activate)
+        return future
+
     def mount_extension(self, id:int, callback=None):
         try:
             extension = ExtensionBuilder().build_extension(self.config["extensions"][id], self.lollms_paths, self)
@@ -315,8 +625,11 @@ class LollmsApplication(LoLLMsCom):
         try:
             personality = PersonalityBuilder(self.lollms_paths, self.config, self.model, self, callback=callback).build_personality(id)
             if personality.model is not None:
-                self.cond_tk = personality.model.tokenize(personality.personality_conditioning)
+                self.cond_tk = personality.model.tokenizer_cache.tokenize(personality.personality_conditioning)
                 self.n_cond_tk = len(self.cond_tk)
+                if self.prefix_cache is not None:
+                    # Pre-warm the conditioning so that the first turn doesn't have to prefill it (the scheduler logs the errors)
+                    self.scheduler.submit(personality.model.prewarm_prefix, self.cond_tk, lane=SchedulerLane.BACKGROUND)
                 ASCIIColors.success(f"Personality  {personality.name} mounted successfully")
             else:
                 if personality.selected_language is not None:
@@ -0,0 +1,208 @@
+######
+# Project       : lollms
+# File          : batching.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Continuous batching. Merges the concurrent generation requests into a single
+# decode loop for bindings that implement the step-wise batching interface.
+######
+from lollms.binding import LLMBinding
+from lollms.types import MSG_TYPE
+from lollms.utilities import trace_exception
+from collections import deque
+from typing import Callable
+import threading
+
+
+class BatchedSequence:
+    """A generation request handled by the ContinuousBatcher."""
+    def __init__(self, prompt:str, n_predict:int, callback:Callable[[str, MSG_TYPE], bool]=None, gpt_params:dict=None) -> None:
+        self.prompt         = prompt
+        self.n_predict      = n_predict
+        self.callback       = callback
+        self.gpt_params     = gpt_params if gpt_params is not None else {}
+        self.handle         = None
+        # Decoded chunks not yet given to the callback
+        self.chunks         = deque()
+        self.nb_tokens      = 0
+        self.exception      = None
+        # Set by the requesting thread when the callback asks to stop
+        self.stopped        = False
+        # Set by the decode loop once the sequence left the batch
+        self.finished       = False
+
+
+class ContinuousBatcher:
+    """
+    Runs one decode loop for all active requests.
+
+    New sequences join the batch at the next token boundary and finished ones
+    (end of sequence, n_predict reached or callback returned False) leave it
+    without interrupting the others.
+
+    The decode loop never calls the callbacks: the chunks are queued on their sequence
+    and each requesting thread gives them to its own callback, so a slow client only
+    slows itself down. A sequence with `max_queued_chunks` undelivered chunks is left
+    out of the decode steps until its client catches up.
+
+    Args:
+        binding (LLMBinding): A binding supporting batching.
+        max_batch_size (int): Maximum number of sequences decoded together.
+        max_queued_chunks (int): Number of undelivered chunks that pauses a sequence.
+    """
+    def __init__(self, binding:LLMBinding, max_batch_size:int=8, max_queued_chunks:int=64) -> None:
+        self.binding            = binding
+        self.max_batch_size     = max(1, max_batch_size)
+        self.max_queued_chunks  = max(1, max_queued_chunks)
+
+        self._lock          = threading.Condition()
+        self._pending       = []
+        self._active        = {}
+        self._closed        = False
+        self._thread        = threading.Thread(target=self._decode_loop, name="lollms-batcher", daemon=True)
+        self._thread.start()
+
+    @property
+    def nb_active_sequences(self) -> int:
+        with self._lock:
+            return len(self._active)
+
+    @property
+    def nb_pending_sequences(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def generate(self, prompt:str, n_predict:int=128, callback:Callable[[str, MSG_TYPE], bool]=None, verbose:bool=False, **gpt_params) -> str:
+        """
+        Same contract as LLMBinding.generate: blocks until the sequence is done and returns the generated text.
+        The callback is called from the calling thread.
+        """
+        sequence = BatchedSequence(prompt, n_predict, callback, gpt_params)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The batcher is stopped")
+            self._pending.append(sequence)
+            self._lock.notify_all()
+        output = ""
+        finished = False
+        while not finished:
+            with self._lock:
+                while len(sequence.chunks)==0 and not sequence.finished:
+                    self._lock.wait()
+                chunks = list(sequence.chunks)
+                sequence.chunks.clear()
+                finished = sequence.finished
+                # The sequence may have been paused
+                self._lock.notify_all()
+            for chunk in chunks:
+                if sequence.stopped:
+                    break
+                output += chunk
+                if not self._deliver(sequence, chunk):
+                    with self._lock:
+                        sequence.stopped = True
+                        self._lock.notify_all()
+        if sequence.exception is not None:
+            raise sequence.exception
+        # Each decode step produces one token
+        self.binding.report_usage(completion_tokens=sequence.nb_tokens)
+        return output
+
+    def stop(self):
+        """Stops the decode loop. The sequences in the batch or waiting for it fail."""
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _deliver(self, sequence:BatchedSequence, chunk:str) -> bool:
+        """Gives a chunk to the callback and returns False if the sequence must stop."""
+        if sequence.callback is None:
+            return True
+        try:
+            return sequence.callback(chunk, MSG_TYPE.MSG_TYPE_CHUNK) is not False
+        except Exception as ex:
+            trace_exception(ex)
+            return False
+
+    def _decodable(self, sequence:BatchedSequence) -> bool:
+        # Lock must be held
+        return not sequence.stopped and len(sequence.chunks)<self.max_queued_chunks
+
+    def _next_batch(self) -> list:
+        """
+        Waits for work, admits the waiting sequences and returns the handles to decode
+        (called at a token boundary). Returns None once the batcher is stopped.
+        """
+        with self._lock:
+            while not self._closed and len(self._pending)==0 and not any(sequence.stopped or self._decodable(sequence) for sequence in self._active.values()):
+                self._lock.wait()
+            if self._closed:
+                return None
+            stopped = [sequence for sequence in self._active.values() if sequence.stopped]
+            admitted = []
+            while len(self._pending)>0 and len(self._active)-len(stopped)+len(admitted)<self.max_batch_size:
+                admitted.append(self._pending.pop(0))
+        for sequence in stopped:
+            self._finish(sequence)
+        for sequence in admitted:
+            try:
+                sequence.handle = self.binding.add_sequence(sequence.prompt, sequence.n_predict, **sequence.gpt_params)
+                with self._lock:
+                    self._active[sequence.handle] = sequence
+            except Exception as ex:
+                trace_exception(ex)
+                sequence.exception = ex
+                self._finish(sequence)
+        with self._lock:
+            return [handle for handle, sequence in self._active.items() if self._decodable(sequence)]
+
+    def _finish(self, sequence:BatchedSequence):
+        if sequence.handle is not None:
+            try:
+                self.binding.remove_sequence(sequence.handle)
+            except Exception as ex:
+                trace_exception(ex)
+        with self._lock:
+            self._active.pop(sequence.handle, None)
+            sequence.finished = True
+            self._lock.notify_all()
+
+    def _decode_loop(self):
+        while True:
+            handles = self._next_batch()
+            if handles is None:
+                break
+            if len(handles)==0:
+                continue
+            try:
+                chunks = self.binding.decode_step(handles)
+            except Exception as ex:
+                trace_exception(ex)
+                for handle in handles:
+                    self._active[handle].exception = ex
+                    self._finish(self._active[handle])
+                continue
+
+            for handle, chunk in chunks.items():
+                sequence = self._active[handle]
+                keep_going = chunk is not None
+                if chunk is not None:
+                    sequence.nb_tokens += 1
+                    with self._lock:
+                        sequence.chunks.append(chunk)
+                        self._lock.notify_all()
+                    if sequence.nb_tokens>=sequence.n_predict:
+                        keep_going = False
+                if not keep_going:
+                    self._finish(sequence)
+
+        # Stopped: the sequences in the batch and the waiting ones fail
+        with self._lock:
+            sequences = list(self._active.values()) + self._pending
+            self._pending = []
+        for sequence in sequences:
+            sequence.exception = RuntimeError("The batcher is stopped")
+            self._finish(sequence)
@@ -7,7 +7,7 @@
 # This is an interface class for lollms bindings.
 ######
 from fastapi import Request
-from typing import Dict, Any
+from typing import Dict, Any, List, AsyncIterator
 from pathlib import Path
 from typing import Callable
 from lollms.paths import LollmsPaths
@@ -23,11 +23,17 @@ import subprocess
 from lollms.config import TypedConfig, InstallOption
 from lollms.main_config import LOLLMSConfig
 from lollms.com import NotificationType, NotificationDisplayType, LoLLMsCom
+from lollms.types import MSG_TYPE
 import urllib
 import inspect
+import threading
+import asyncio
 from datetime import datetime
 from enum import Enum
 from lollms.utilities import trace_exception
+from lollms.tokenizer_cache import TokenizerCache
+from lollms.generation import current_usage, timed_span
+from lollms.tracing import traced, trace_overrides
 
 from tqdm import tqdm
 
@@ -52,6 +58,11 @@ class BindingType(Enum):
 
 class LLMBinding:
     
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # The model calls of the bindings are traced when tracing is enabled
+        trace_overrides(cls, {"generate":"binding.generate", "tokenize":"binding.tokenize", "embed":"binding.embed", "embed_batch":"binding.embed_batch"}, binding=cls.__name__)
+
     def __init__(
                     self,
                     binding_dir:Path,
@@ -80,6 +91,8 @@ class LLMBinding:
         self.add_default_configurations(binding_config)
 
         self.interrogatorStorer = None
+        # Set by the application when the binding supports state snapshots (see restore_prefix/store_prefix)
+        self.prefix_cache                       = None
         self.supported_file_extensions          = supported_file_extensions
         self.seed                               = config["seed"]
 
@@ -104,6 +117,9 @@ class LLMBinding:
         for models_folder in self.models_folders:
             models_folder.mkdir(parents=True, exist_ok=True)
 
+        # Memoized tokenize/detokenize used when building prompts
+        self.tokenizer_cache = TokenizerCache(self, self.binding_config.get("tokenizer_cache_max_memory", 32)*1024*1024)
+
     def sync_configuration(self, binding_config:TypedConfig, lollms_paths:LollmsPaths):
         self.configuration_file_path = lollms_paths.personal_configuration_path/"bindings"/self.binding_folder_name/f"config.yaml"
         self.configuration_file_path.parent.mkdir(parents=True, exist_ok=True)
@@ -338,6 +354,9 @@ class LLMBinding:
             {"name":"clip_model_name","type":"str","value":'ViT-L-14/openai','options':["ViT-L-14/openai","ViT-H-14/laion2b_s32b_b79k"], "help":"Clip model to be used for images understanding"},
             {"name":"caption_model_name","type":"str","value":'blip-large','options':['blip-base', 'git-large-coco', 'blip-large','blip2-2.7b', 'blip2-flan-t5-xl'], "help":"Clip model to be used for images understanding"},
             {"name":"vqa_model_name","type":"str","value":'Salesforce/blip-vqa-capfilt-large','options':['Salesforce/blip-vqa-capfilt-large', 'Salesforce/blip-vqa-base', 'Salesforce/blip-image-captioning-large','Salesforce/blip2-opt-2.7b', 'Salesforce/blip2-flan-t5-xxl'], "help":"Salesforce question/answer model"},
+            {"name":"max_concurrent_generations","type":"int","value":1, "min":1, "help":"Maximum number of generations the server runs at the same time with this binding. Extra requests are queued"},
+            {"name":"max_batch_size","type":"int","value":8, "min":1, "help":"Maximum number of sequences decoded together (only used by bindings that support continuous batching)"},
+            {"name":"tokenizer_cache_max_memory","type":"int","value":32, "min":0, "help":"Memory used to memoize tokenize/detokenize results in MB (0 disables the cache)"},
         ])
 
     def InfoMessage(self, content, client_id=None, verbose:bool=True):
@@ -660,7 +679,217 @@ class LLMBinding:
             verbose (bool, optional): If true, the code will spit many informations about the generation process. Defaults to False.
         """
         pass
+
+    def report_usage(self, prompt_tokens:int=None, completion_tokens:int=None):
+        """
+        Reports the exact token counts of the current generation.
+        Bindings that know them (from their decode loop or from the API response) call this
+        method from generate, the values replace the counts estimated from the received chunks.
+
+        Args:
+            prompt_tokens (int, optional): Number of tokens of the prompt. Defaults to None.
+            completion_tokens (int, optional): Number of generated tokens. Defaults to None.
+        """
+        usage = current_usage()
+        if usage is not None:
+            usage.report(prompt_tokens, completion_tokens)
     
+    # ----------------------------------- Continuous batching -----------------------------------
+    # Bindings that can decode several sequences at once implement add_sequence, decode_step and
+    # remove_sequence. The server then merges the active requests in a single decode loop
+    # (see lollms.batching.ContinuousBatcher).
+    def supports_batching(self) -> bool:
+        """
+        Returns True if the binding implements the step-wise batching interface.
+        """
+        return type(self).decode_step is not LLMBinding.decode_step
+
+    def add_sequence(self, prompt:str, n_predict:int = 128, **gpt_params):
+        """
+        Adds a new sequence to the running batch. The prompt is prefilled and the sequence takes part in the next decode_step.
+        This should be implemented by child classes that support batching.
+
+        Args:
+            prompt (str): The prompt to use for generation
+            n_predict (int, optional): Number of tokens to predict. Defaults to 128.
+
+        Returns:
+            Any: A handle identifying the sequence
+        """
+        raise NotImplementedError("This binding does not support continuous batching")
+
+    def decode_step(self, handles:list) -> Dict[Any, str]:
+        """
+        Decodes one token for each of the given sequences.
+        This should be implemented by child classes that support batching.
+
+        Args:
+            handles (list): The handles of the active sequences
+
+        Returns:
+            dict: The text of the new token for each handle (None when the sequence has ended)
+        """
+        raise NotImplementedError("This binding does not support continuous batching")
+
+    def remove_sequence(self, handle):
+        """
+        Removes a sequence from the running batch and frees its resources.
+
+        Args:
+            handle: The handle returned by add_sequence
+        """
+        pass
+
+    def generate_batch(self, 
+                 prompts:List[str],
+                 n_predict: int = 128,
+                 callbacks: List[Callable[[str, int, dict], bool]] = None,
+                 verbose: bool = False,
+                 **gpt_params ) -> List[str]:
+        """Generates text for several prompts at once
+
+        Bindings that support batching decode all prompts in a single loop, the others generate them one after the other.
+
+        Args:
+            prompts (List[str]): The prompts to use for generation
+            n_predict (int, optional): Number of tokens to predict for each prompt. Defaults to 128.
+            callbacks (List[Callable[[str, int, dict], bool]], optional): One callback per prompt. Defaults to None.
+            verbose (bool, optional): If true, the code will spit many informations about the generation process. Defaults to False.
+
+        Returns:
+            List[str]: The generated texts in the order of the prompts
+        """
+        if callbacks is None:
+            callbacks = [None]*len(prompts)
+        if not self.supports_batching():
+            return [self.generate(prompt, n_predict, callback=callback, verbose=verbose, **gpt_params) for prompt, callback in zip(prompts, callbacks)]
+
+        outputs = [""]*len(prompts)
+        active = {self.add_sequence(prompt, n_predict, **gpt_params):i for i, prompt in enumerate(prompts)}
+        nb_tokens = {handle:0 for handle in active}
+        while len(active)>0:
+            chunks = self.decode_step(list(active.keys()))
+            for handle, chunk in chunks.items():
+                i = active[handle]
+                keep_going = chunk is not None
+                if chunk is not None:
+                    outputs[i] += chunk
+                    nb_tokens[handle] += 1
+                    if callbacks[i] is not None and callbacks[i](chunk, MSG_TYPE.MSG_TYPE_CHUNK) is False:
+                        keep_going = False
+                    if nb_tokens[handle]>=n_predict:
+                        keep_going = False
+                if not keep_going:
+                    self.remove_sequence(handle)
+                    del active[handle]
+        return outputs
+
+    # ----------------------------------- Prompt prefix reuse -----------------------------------
+    # Bindings that can snapshot their state (KV cache) implement save_state, load_state and prefill.
+    # In their generate method they call restore_prefix before prefilling the prompt and store_prefix
+    # once it is prefilled, so that the next prompt sharing the same prefix skips that work.
+    def supports_state_snapshot(self) -> bool:
+        """
+        Returns True if the binding can save and restore its state.
+        """
+        return type(self).save_state is not LLMBinding.save_state
+
+    def save_state(self):
+        """
+        Snapshots the current model state (the processed tokens and their KV cache).
+        This should be implemented by child classes that support state snapshots.
+
+        Returns:
+            tuple: The state and its size in bytes
+        """
+        raise NotImplementedError("This binding does not support state snapshots")
+
+    def load_state(self, state):
+        """
+        Restores a state returned by save_state.
+        This should be implemented by child classes that support state snapshots.
+        """
+        raise NotImplementedError("This binding does not support state snapshots")
+
+    def prefill(self, tokens:list):
+        """
+        Resets the context and processes the tokens without generating anything (used to pre-warm the prefix cache).
+        This should be implemented by child classes that support state snapshots.
+        """
+        raise NotImplementedError("This binding does not support state snapshots")
+
+    def restore_prefix(self, tokens:list) -> int:
+        """
+        Loads the cached state of the longest known prefix of the tokens.
+
+        Args:
+            tokens (list): The prompt tokens
+
+        Returns:
+            int: The number of tokens already processed (the binding only needs to prefill tokens[n:])
+        """
+        if self.prefix_cache is None:
+            return 0
+        nb_tokens, state = self.prefix_cache.lookup(tokens)
+        if state is None:
+            return 0
+        self.load_state(state)
+        return nb_tokens
+
+    def store_prefix(self, tokens:list):
+        """
+        Saves the current state in the prefix cache. The state must be the one obtained after processing the tokens.
+
+        Args:
+            tokens (list): The tokens processed so far
+        """
+        if self.prefix_cache is None:
+            return
+        state, size = self.save_state()
+        self.prefix_cache.store(tokens, state, size)
+
+    @timed_span("prefill")
+    def prewarm_prefix(self, tokens:list):
+        """
+        Prefills the tokens (unless they are already cached) and stores the resulting state.
+
+        Args:
+            tokens (list): The tokens to pre-warm (personality conditioning for example)
+        """
+        if self.prefix_cache is None or len(tokens)==0:
+            return
+        nb_tokens, _ = self.prefix_cache.lookup(tokens)
+        if nb_tokens<len(tokens):
+            self.prefill(tokens)
+            self.store_prefix(tokens)
+
+    # ----------------------------------- Token scoring -----------------------------------
+    # Bindings that can run a forward pass on a token list implement score_tokens. This is what
+    # speculative decoding needs (see lollms.speculative.SpeculativeDecoder): the draft model
+    # proposes tokens one by one and the main model verifies all of them in one pass.
+    def supports_token_scoring(self) -> bool:
+        """
+        Returns True if the binding implements score_tokens.
+        """
+        return type(self).score_tokens is not LLMBinding.score_tokens
+
+    def score_tokens(self, tokens:list, nb_candidates:int = 0, **gpt_params) -> list:
+        """
+        Runs one forward pass on the tokens and returns the token the model picks (using the
+        sampling parameters) after each of the last nb_candidates tokens and after the whole list.
+        Consecutive calls share most of their tokens, implementations should only process the
+        tokens that differ from the previous call (KV cache reuse).
+        This should be implemented by child classes that support token scoring.
+
+        Args:
+            tokens (list): The prompt tokens followed by nb_candidates candidate tokens
+            nb_candidates (int): Number of candidate tokens at the end of the list
+
+        Returns:
+            list: nb_candidates+1 tokens. Item i is the token chosen after tokens[:len(tokens)-nb_candidates+i] (None for end of sequence)
+        """
+        raise NotImplementedError("This binding does not support token scoring")
+
     def tokenize(self, prompt:str):
         """
         Tokenizes the given prompt using the model's tokenizer.
@@ -685,6 +914,109 @@ class LLMBinding:
         """
         return " ".join(tokens_list)
 
+    # ----------------------------------- Async interface -----------------------------------
+    # Used by the server so that a model call never blocks the event loop. The default
+    # implementations run the sync methods in an executor, bindings with an async client
+    # (remote APIs) can override them with native async calls. An overridden agenerate is
+    # what the scheduler jobs call (see generate_from_agenerate), so the generations keep
+    # their queueing, cancellation and caches.
+    async def atokenize(self, prompt:str) -> list:
+        """
+        Async version of tokenize.
+
+        Args:
+            prompt (str): The input prompt to be tokenized.
+
+        Returns:
+            list: A list of tokens representing the tokenized prompt.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.tokenize, prompt)
+
+    async def adetokenize(self, tokens_list:list) -> str:
+        """
+        Async version of detokenize.
+
+        Args:
+            tokens_list (list): A list of tokens to be detokenized.
+
+        Returns:
+            str: The detokenized text as a string.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.detokenize, tokens_list)
+
+    async def agenerate(self, 
+                 prompt:str,
+                 n_predict: int = 128,
+                 verbose: bool = False,
+                 **gpt_params ) -> AsyncIterator[str]:
+        """
+        Async version of generate yielding the generated chunks.
+        Leaving the iteration stops the generation at the next chunk.
+
+        Args:
+            prompt (str): The prompt to use for generation
+            n_predict (int, optional): Number of tokens to prodict. Defaults to 128.
+            verbose (bool, optional): If true, the code will spit many informations about the generation process. Defaults to False.
+
+        Returns:
+            AsyncIterator[str]: The generated chunks.
+        """
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        stopped = threading.Event()
+
+        def callback(chunk, chunk_type:MSG_TYPE=MSG_TYPE.MSG_TYPE_CHUNK, metadata:dict={}):
+            if chunk is not None and chunk_type==MSG_TYPE.MSG_TYPE_CHUNK:
+                loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+            return not stopped.is_set()
+
+        def run():
+            try:
+                self.generate(prompt, n_predict, callback, verbose, **gpt_params)
+            finally:
+                loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+        generation = loop.run_in_executor(None, run)
+        try:
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    break
+                yield chunk
+            # Raises the exception of generate if any
+            await generation
+        finally:
+            stopped.set()
+
+    @property
+    def has_native_agenerate(self) -> bool:
+        """True if the binding overrides agenerate (async client)."""
+        return type(self).agenerate is not LLMBinding.agenerate
+
+    def generate_from_agenerate(self, 
+                 prompt:str,
+                 n_predict: int = 128,
+                 callback: Callable[[str], None] = None,
+                 verbose: bool = False,
+                 **gpt_params ) -> str:
+        """
+        Same as generate, driven by agenerate in an event loop of the calling thread (a scheduler worker).
+
+        Returns:
+            str: The generated text.
+        """
+        async def run():
+            output = ""
+            chunks = self.agenerate(prompt, n_predict, verbose, **gpt_params)
+            try:
+                async for chunk in chunks:
+                    output += chunk
+                    if callback is not None and callback(chunk, MSG_TYPE.MSG_TYPE_CHUNK) is False:
+                        break
+            finally:
+                await chunks.aclose()
+            return output
+        return asyncio.run(run())
 
     def embed(self, text):
         """
@@ -696,6 +1028,18 @@ class LLMBinding:
         """
         pass
 
+    def embed_batch(self, texts:List[str]) -> list:
+        """
+        Computes the embeddings of several texts.
+        Bindings that can embed a batch in one pass should override this method, the default
+        implementation calls embed for each text.
+        Args:
+            texts (List[str]): The texts to be embedded.
+        Returns:
+            List[List[float]]: One embedding per text
+        """
+        return [self.embed(text) for text in texts]
+
 
     def list_models(self):
         """Lists the models for this binding
@@ -0,0 +1,404 @@
+######
+# Project       : lollms
+# File          : binding_workers.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Multi-process binding mode. The generations are executed by worker processes
+# each hosting its own instance of the binding, so a multi-core box can serve
+# several model replicas. Prompts and generated chunks go through pipes, the
+# requests are sent to the least loaded worker and the crashed workers are
+# restarted. Tokenization and embeddings are sent to the workers too, unless the
+# server process loads its own copy of the model (binding_workers_local_model).
+######
+from ascii_colors import ASCIIColors
+from lollms.binding import LLMBinding, BindingBuilder, ModelBuilder
+from lollms.main_config import LOLLMSConfig
+from lollms.paths import LollmsPaths
+from lollms.generation import TOKEN_USAGE, track_usage
+from lollms.types import MSG_TYPE
+from lollms.utilities import trace_exception
+from lollms.tokenizer_cache import TokenizerCache
+from typing import Callable, Dict, List
+import multiprocessing
+import threading
+import queue
+import time
+import uuid
+
+# Methods of the model that the server process can call in the workers
+WORKER_CALLS = ("tokenize", "detokenize", "embed", "embed_batch")
+
+
+# ----------------------------------- Worker process -----------------------------------
+def _worker_main(connection, config:dict, lollms_paths:LollmsPaths, index:int):
+    """Entry point of a worker process: builds the binding and serves the generations and calls sent through connection."""
+    try:
+        worker_config = LOLLMSConfig(lollms_paths=lollms_paths)
+        worker_config.config = config
+        binding = BindingBuilder().build_binding(worker_config, lollms_paths)
+        model = ModelBuilder(binding).get_model()
+        if model is None:
+            raise RuntimeError(f"Binding {worker_config.binding_name} couldn't build model {worker_config.model_name}")
+    except Exception as ex:
+        trace_exception(ex)
+        connection.send(("failed", None, str(ex)))
+        return
+    connection.send(("ready", None, None))
+
+    send_lock = threading.Lock()
+    def send(message:tuple):
+        with send_lock:
+            connection.send(message)
+
+    requests = queue.Queue()
+    calls = queue.Queue()
+    # Generations queued or running, a cancel received for another id is late and ignored
+    active = set()
+    canceled = set()
+    active_lock = threading.Lock()
+    def receive():
+        # Cancellations and calls must be received while a generation runs
+        while True:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                message = ("stop", None, None)
+            if message[0]=="cancel":
+                with active_lock:
+                    if message[1] in active:
+                        canceled.add(message[1])
+            elif message[0]=="call":
+                calls.put(message)
+            elif message[0]=="generate":
+                with active_lock:
+                    active.add(message[1])
+                requests.put(message)
+            else:
+                requests.put(message)
+            if message[0]=="stop":
+                calls.put(message)
+                return
+    def serve_calls():
+        # Tokenizations don't wait for the running generation
+        while True:
+            kind, request_id, data = calls.get()
+            if kind=="stop":
+                return
+            name, args = data
+            try:
+                if name not in WORKER_CALLS:
+                    raise ValueError(f"{name} can't be called in a binding worker")
+                send(("result", request_id, getattr(model, name)(*args)))
+            except Exception as ex:
+                trace_exception(ex)
+                send(("error", request_id, str(ex)))
+    threading.Thread(target=receive, name=f"lollms-binding-worker-{index}-receiver", daemon=True).start()
+    threading.Thread(target=serve_calls, name=f"lollms-binding-worker-{index}-calls", daemon=True).start()
+
+    def finish(request_id:str, message:tuple):
+        with active_lock:
+            active.discard(request_id)
+            canceled.discard(request_id)
+        send(message)
+
+    while True:
+        kind, request_id, data = requests.get()
+        if kind=="stop":
+            return
+        if request_id in canceled:
+            finish(request_id, ("done", request_id, (None, None)))
+            continue
+        prompt, n_predict, gpt_params = data
+        def callback(chunk, chunk_type:MSG_TYPE=MSG_TYPE.MSG_TYPE_CHUNK, metadata:dict={}):
+            if chunk is not None and chunk_type==MSG_TYPE.MSG_TYPE_CHUNK:
+                send(("chunk", request_id, chunk))
+            return request_id not in canceled
+        try:
+            with track_usage(TOKEN_USAGE()) as usage:
+                model.generate(prompt, n_predict, callback, **gpt_params)
+            finish(request_id, ("done", request_id, (usage.reported_prompt_tokens, usage.reported_completion_tokens)))
+        except Exception as ex:
+            trace_exception(ex)
+            finish(request_id, ("error", request_id, str(ex)))
+
+
+# ----------------------------------- Server process -----------------------------------
+class BindingWorkerRequest:
+    """A generation sent to a worker. The messages of the worker are queued until the generating thread reads them."""
+    def __init__(self) -> None:
+        self.id         = str(uuid.uuid4())
+        self.messages   = queue.Queue()
+
+
+class BindingWorker:
+    """A worker process and the generations it was sent."""
+    def __init__(self, index:int) -> None:
+        self.index      = index
+        self.process    = None
+        self.connection = None
+        self.ready      = False
+        self.restarts   = 0
+        # Restarts since the worker was last ready (the restart delay doubles with each of them)
+        self.failures   = 0
+        self.pending:Dict[str, BindingWorkerRequest] = {}
+        self.send_lock  = threading.Lock()
+
+    def send(self, message:tuple):
+        with self.send_lock:
+            self.connection.send(message)
+
+
+class BindingWorkerPool:
+    """
+    Runs the generations in `nb_workers` processes hosting their own binding instance.
+
+    Each request goes to the ready worker with the fewest pending generations. A worker
+    that dies is restarted after `restart_delay` seconds, its pending generations fail.
+
+    Args:
+        config (LOLLMSConfig): The configuration (binding and model) used by the workers.
+        lollms_paths (LollmsPaths): The paths of the server.
+        nb_workers (int): Number of worker processes.
+        restart_delay (float): Time in seconds before restarting a dead worker.
+        start_timeout (float): Time in seconds a request waits for a ready worker.
+    """
+    def __init__(self, config:LOLLMSConfig, lollms_paths:LollmsPaths, nb_workers:int, restart_delay:float=1, start_timeout:float=300) -> None:
+        self.config         = dict(config.config)
+        self.lollms_paths   = lollms_paths
+        self.restart_delay  = restart_delay
+        self.start_timeout  = start_timeout
+        # fork is not safe once the server threads are running
+        self._context       = multiprocessing.get_context("spawn")
+        self._lock          = threading.Condition()
+        self._closed        = False
+        self.workers:List[BindingWorker] = [BindingWorker(index) for index in range(max(1, nb_workers))]
+        for worker in self.workers:
+            self._start(worker)
+
+    @property
+    def nb_workers(self) -> int:
+        return len(self.workers)
+
+    def _start(self, worker:BindingWorker):
+        parent_connection, child_connection = self._context.Pipe()
+        process = self._context.Process(
+                                            target=_worker_main,
+                                            args=(child_connection, self.config, self.lollms_paths, worker.index),
+                                            name=f"lollms-binding-worker-{worker.index}",
+                                            daemon=True
+                                        )
+        process.start()
+        child_connection.close()
+        worker.process = process
+        worker.connection = parent_connection
+        threading.Thread(target=self._receive, args=(worker, parent_connection), name=f"lollms-binding-worker-{worker.index}-reader", daemon=True).start()
+
+    def _receive(self, worker:BindingWorker, connection):
+        while True:
+            try:
+                kind, request_id, data = connection.recv()
+            except (EOFError, OSError):
+                break
+            if kind=="ready":
+                with self._lock:
+                    worker.ready = True
+                    worker.failures = 0
+                    self._lock.notify_all()
+                ASCIIColors.success(f"Binding worker {worker.index} ready (pid {worker.process.pid})")
+            elif kind=="failed":
+                ASCIIColors.error(f"Binding worker {worker.index} couldn't load the model: {data}")
+            else:
+                with self._lock:
+                    request = worker.pending.get(request_id)
+                    if kind in ["done", "error", "result"]:
+                        worker.pending.pop(request_id, None)
+                        self._lock.notify_all()
+                if request is not None:
+                    request.messages.put((kind, data))
+        self._on_exit(worker, connection)
+
+    def _on_exit(self, worker:BindingWorker, connection):
+        worker.process.join(5)
+        with self._lock:
+            worker.ready = False
+            pending = list(worker.pending.values())
+            worker.pending.clear()
+            closed = self._closed
+        connection.close()
+        for request in pending:
+            request.messages.put(("error", f"Binding worker {worker.index} exited"))
+        if closed:
+            return
+        delay = min(self.restart_delay*2**worker.failures, 60)
+        ASCIIColors.warning(f"Binding worker {worker.index} exited with code {worker.process.exitcode}, restarting it in {delay}s")
+        time.sleep(delay)
+        with self._lock:
+            if self._closed:
+                return
+            worker.restarts += 1
+            worker.failures += 1
+        self._start(worker)
+
+    def _acquire(self, request:BindingWorkerRequest) -> BindingWorker:
+        """Registers the request on the least loaded ready worker."""
+        deadline = time.time()+self.start_timeout
+        with self._lock:
+            while True:
+                if self._closed:
+                    raise RuntimeError("The binding workers are stopped")
+                ready = [worker for worker in self.workers if worker.ready]
+                if len(ready)>0:
+                    worker = min(ready, key=lambda worker: len(worker.pending))
+                    worker.pending[request.id] = request
+                    return worker
+                remaining = deadline-time.time()
+                if remaining<=0:
+                    raise RuntimeError("No binding worker is ready")
+                self._lock.wait(remaining)
+
+    def generate(self,
+                 prompt:str,
+                 n_predict: int = 128,
+                 callback: Callable[[str, int, dict], bool] = None,
+                 **gpt_params ):
+        """
+        Generates text in a worker process. The callback is called from the calling thread.
+
+        Returns:
+            tuple: The generated text and the (prompt_tokens, completion_tokens) reported by the binding of the worker.
+        """
+        request = BindingWorkerRequest()
+        worker = self._acquire(request)
+        try:
+            worker.send(("generate", request.id, (prompt, n_predict, gpt_params)))
+        except (OSError, ValueError) as ex:
+            with self._lock:
+                worker.pending.pop(request.id, None)
+            raise RuntimeError(f"Binding worker {worker.index} is not reachable") from ex
+        output = ""
+        stopped = False
+        while True:
+            kind, data = request.messages.get()
+            if kind=="chunk":
+                if stopped:
+                    # Chunks generated before the worker received the cancel
+                    continue
+                output += data
+                if callback is not None and callback(data, MSG_TYPE.MSG_TYPE_CHUNK) is False:
+                    stopped = True
+                    try:
+                        worker.send(("cancel", request.id, None))
+                    except (OSError, ValueError):
+                        pass
+            elif kind=="done":
+                return output, data
+            else:
+                raise RuntimeError(data)
+
+    def call(self, name:str, *args):
+        """Calls a method of the model (see WORKER_CALLS) in the least loaded worker and returns its result."""
+        request = BindingWorkerRequest()
+        worker = self._acquire(request)
+        try:
+            worker.send(("call", request.id, (name, args)))
+        except (OSError, ValueError) as ex:
+            with self._lock:
+                worker.pending.pop(request.id, None)
+            raise RuntimeError(f"Binding worker {worker.index} is not reachable") from ex
+        kind, data = request.messages.get()
+        if kind=="result":
+            return data
+        raise RuntimeError(data)
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                "workers": [
+                    {
+                        "index": worker.index,
+                        "pid": worker.process.pid if worker.process is not None else None,
+                        "ready": worker.ready,
+                        "pending": len(worker.pending),
+                        "restarts": worker.restarts,
+                    } for worker in self.workers
+                ]
+            }
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        for worker in self.workers:
+            try:
+                worker.send(("stop", None, None))
+            except (OSError, ValueError):
+                pass
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(5)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+
+
+class BindingWorkersModel(LLMBinding):
+    """
+    Model whose generations are executed by a BindingWorkerPool.
+
+    The binding instance of the server process answers the configuration. When its model
+    is loaded (local_model), it also tokenizes and embeds. Otherwise these calls are sent
+    to the workers, and the server process doesn't hold one more copy of the weights.
+
+    Args:
+        binding (LLMBinding): The binding of the server process.
+        pool (BindingWorkerPool): The worker processes.
+        local_model (bool): True if the model of the binding is built in the server process.
+    """
+    def __init__(self, binding:LLMBinding, pool:BindingWorkerPool, local_model:bool=False) -> None:
+        # LLMBinding.__init__ is not called, the attributes come from the local binding
+        self.binding        = binding
+        self.pool           = pool
+        self.local_model    = local_model
+        if not local_model:
+            # The cache of the binding would call its tokenizer, which has no model
+            self.tokenizer_cache = TokenizerCache(self, binding.binding_config.get("tokenizer_cache_max_memory", 32)*1024*1024)
+
+    def __getattr__(self, name:str):
+        if name in ["binding", "pool", "local_model"]:
+            raise AttributeError(name)
+        return getattr(self.binding, name)
+
+    def generate(self,
+                 prompt:str,
+                 n_predict: int = 128,
+                 callback: Callable[[str, int, dict], bool] = None,
+                 verbose: bool = False,
+                 **gpt_params ):
+        output, (prompt_tokens, completion_tokens) = self.pool.generate(prompt, n_predict, callback, **gpt_params)
+        self.report_usage(prompt_tokens, completion_tokens)
+        return output
+
+    def tokenize(self, prompt:str):
+        if self.local_model:
+            return self.binding.tokenize(prompt)
+        return self.pool.call("tokenize", prompt)
+
+    def detokenize(self, tokens_list:list):
+        if self.local_model:
+            return self.binding.detokenize(tokens_list)
+        return self.pool.call("detokenize", list(tokens_list))
+
+    def embed(self, text):
+        if self.local_model:
+            return self.binding.embed(text)
+        return self.pool.call("embed", text)
+
+    def embed_batch(self, texts:List[str]) -> list:
+        if self.local_model:
+            return self.binding.embed_batch(texts)
+        return self.pool.call("embed_batch", list(texts))
+
+    def destroy_model(self):
+        self.pool.shutdown()
+        if self.local_model:
+            self.binding.destroy_model()
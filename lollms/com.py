@@ -174,4 +174,8 @@ class LoLLMsCom:
                             status=True,
                             error="",
                              ):
-        pass
\ No newline at end of file
+        pass
+
+    def notify_queue_position(self, job, position:int):
+        """Called by the generation scheduler when a queued job moves in the queue"""
+        pass
@@ -0,0 +1,110 @@
+######
+# Project       : lollms
+# File          : discussion_window.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Discussion of a socket.io session kept with the tokens of each message.
+# New messages are tokenized once when they are added and the context is
+# built from the last messages that fit in the token budget, so a turn only
+# tokenizes its new text instead of the whole discussion.
+######
+from lollms.binding import LLMBinding
+from collections import deque
+from typing import Tuple
+import threading
+import time
+
+
+class DiscussionMessage:
+    """A message of the discussion with its token ids."""
+    def __init__(self, text:str, tokens:list) -> None:
+        self.text       = text
+        self.tokens     = tokens
+
+
+class DiscussionWindow:
+    """
+    Messages of a session with a running token count.
+
+    The oldest messages are dropped when the discussion exceeds `max_tokens`, and
+    `build` returns the last whole messages that fit in a token budget.
+
+    Args:
+        binding (LLMBinding): The model used to tokenize the messages.
+        max_tokens (int): Maximum number of tokens kept for the session.
+    """
+    def __init__(self, binding:LLMBinding, max_tokens:int=32768) -> None:
+        self.binding        = binding
+        self.max_tokens     = max_tokens
+        self.messages       = deque()
+        self.nb_tokens      = 0
+        self.last_used      = time.time()
+        self._lock          = threading.Lock()
+
+    def _tokenize(self, text:str) -> list:
+        tokenizer_cache = getattr(self.binding, "tokenizer_cache", None)
+        return tokenizer_cache.tokenize(text) if tokenizer_cache is not None else self.binding.tokenize(text)
+
+    def set_binding(self, binding:LLMBinding):
+        """Changes the model of the session (the messages are tokenized again with the new model)."""
+        with self._lock:
+            if binding is self.binding:
+                return
+            self.binding = binding
+            self.nb_tokens = 0
+            for message in self.messages:
+                message.tokens = self._tokenize(message.text)
+                self.nb_tokens += len(message.tokens)
+            self._enforce_limit()
+
+    def append(self, text:str):
+        """Adds a message at the end of the discussion."""
+        if text=="":
+            return
+        tokens = self._tokenize(text)
+        with self._lock:
+            self.messages.append(DiscussionMessage(text, tokens))
+            self.nb_tokens += len(tokens)
+            self.last_used = time.time()
+            self._enforce_limit()
+
+    def _enforce_limit(self):
+        # The last message is always kept
+        while self.nb_tokens>self.max_tokens and len(self.messages)>1:
+            self.nb_tokens -= len(self.messages.popleft().tokens)
+
+    def build(self, max_tokens:int) -> Tuple[str, int]:
+        """
+        Builds the text of the last messages that fit in max_tokens tokens.
+
+        The discussion is cut at a message boundary. When the last message alone doesn't
+        fit, its last max_tokens tokens are used.
+
+        Args:
+            max_tokens (int): The token budget.
+
+        Returns:
+            Tuple[str, int]: The text and its number of tokens.
+        """
+        with self._lock:
+            self.last_used = time.time()
+            selected = []
+            nb_tokens = 0
+            for message in reversed(self.messages):
+                if nb_tokens+len(message.tokens)>max_tokens:
+                    break
+                selected.append(message.text)
+                nb_tokens += len(message.tokens)
+            if len(selected)==0 and len(self.messages)>0 and max_tokens>0:
+                tokens = self.messages[-1].tokens[-max_tokens:]
+                return self.binding.detokenize(tokens), len(tokens)
+            return "".join(reversed(selected)), nb_tokens
+
+    def clear(self):
+        with self._lock:
+            self.messages.clear()
+            self.nb_tokens = 0
+
+    def idle_time(self) -> float:
+        return time.time()-self.last_used
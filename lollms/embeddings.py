@@ -0,0 +1,191 @@
+######
+# Project       : lollms
+# File          : embeddings.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Batched embeddings. The EmbeddingBatcher merges the embedding requests that
+# arrive within a few milliseconds into a single LLMBinding.embed_batch call,
+# and index_vectorizer embeds the chunks of a vector store batch by batch.
+######
+from ascii_colors import ASCIIColors
+from lollms.binding import LLMBinding
+from lollms.utilities import trace_exception
+from lollms.tracing import traced
+from lollms.scheduler import GenerationScheduler
+from safe_store import TextVectorizer, VectorizationMethod
+from concurrent.futures import Future
+from functools import partial
+from typing import List
+import threading
+import asyncio
+import time
+
+
+class EmbeddingRequest:
+    """Texts waiting to be embedded by the EmbeddingBatcher."""
+    def __init__(self, binding:LLMBinding, texts:List[str]) -> None:
+        self.binding    = binding
+        self.texts      = texts
+        self.future     = Future()
+
+
+class EmbeddingBatcher:
+    """
+    Merges concurrent embedding requests into batches.
+
+    The first waiting request opens a batch, the requests received during the next
+    `max_wait` seconds (or until `max_batch_size` texts are collected) join it and the
+    whole batch is embedded with one embed_batch call per binding.
+
+    With a scheduler, every embed_batch call is a scheduler job (client "embeddings")
+    so the embeddings share the binding with the generations instead of running
+    next to them. The next batch is collected while the job waits in the queue.
+
+    Args:
+        max_batch_size (int): Maximum number of texts per embed_batch call.
+        max_wait (float): Time in seconds a batch waits for other requests.
+        scheduler (GenerationScheduler, optional): The scheduler running the embed_batch calls. Defaults to None (called from the batching thread).
+    """
+    def __init__(self, max_batch_size:int=64, max_wait:float=0.005, scheduler:GenerationScheduler=None) -> None:
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait       = max_wait
+        self.scheduler      = scheduler
+
+        self._lock          = threading.Condition()
+        self._pending       = []
+        self._thread        = None
+        self.nb_batches     = 0
+        self.nb_texts       = 0
+
+    def embed(self, binding:LLMBinding, texts:List[str]) -> list:
+        """Embeds the texts (blocks until the batch containing them is processed)."""
+        return self.submit(binding, texts).result()
+
+    async def aembed(self, binding:LLMBinding, texts:List[str]) -> list:
+        """Same as embed without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(binding, texts))
+
+    def submit(self, binding:LLMBinding, texts:List[str]) -> Future:
+        """Queues the texts and returns a future resolved with their embeddings."""
+        request = EmbeddingRequest(binding, list(texts))
+        if len(request.texts)==0:
+            request.future.set_result([])
+            return request.future
+        if self.scheduler is not None and self.scheduler.current_job() is not None:
+            # A job waiting for a batch job could hold the only generation slot
+            try:
+                request.future.set_result(binding.embed_batch(request.texts))
+            except Exception as ex:
+                request.future.set_exception(ex)
+            return request.future
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._batch_loop, name="lollms-embedding-batcher", daemon=True)
+                self._thread.start()
+            self._pending.append(request)
+            self._lock.notify_all()
+        return request.future
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                "pending_requests": len(self._pending),
+                "batches": self.nb_batches,
+                "texts": self.nb_texts,
+                "mean_batch_size": self.nb_texts/self.nb_batches if self.nb_batches>0 else 0,
+            }
+
+    def _next_batch(self) -> List[EmbeddingRequest]:
+        with self._lock:
+            while len(self._pending)==0:
+                self._lock.wait()
+            deadline = time.monotonic() + self.max_wait
+            while sum(len(request.texts) for request in self._pending)<self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining<=0:
+                    break
+                self._lock.wait(remaining)
+            # A request is never split, a batch can exceed max_batch_size only when a single request does
+            batch = [self._pending.pop(0)]
+            nb_texts = len(batch[0].texts)
+            while len(self._pending)>0 and nb_texts+len(self._pending[0].texts)<=self.max_batch_size:
+                nb_texts += len(self._pending[0].texts)
+                batch.append(self._pending.pop(0))
+            return batch
+
+    def _batch_loop(self):
+        while True:
+            batch = self._next_batch()
+            # Requests may target different models of the model pool
+            by_binding = {}
+            for request in batch:
+                by_binding.setdefault(id(request.binding), []).append(request)
+            for requests in by_binding.values():
+                texts = [text for request in requests for text in request.texts]
+                if self.scheduler is None:
+                    future = Future()
+                    try:
+                        future.set_result(requests[0].binding.embed_batch(texts))
+                    except Exception as ex:
+                        trace_exception(ex)
+                        future.set_exception(ex)
+                else:
+                    future = self.scheduler.submit(requests[0].binding.embed_batch, texts, client_id="embeddings").future
+                future.add_done_callback(partial(self._dispatch, requests, len(texts)))
+
+    def _dispatch(self, requests:List[EmbeddingRequest], nb_texts:int, future:Future):
+        """Gives each request its part of the embeddings of a batch."""
+        if future.cancelled():
+            exception = RuntimeError("The embedding batch was canceled")
+        else:
+            exception = future.exception()
+        if exception is not None:
+            for request in requests:
+                request.future.set_exception(exception)
+            return
+        embeddings = future.result()
+        with self._lock:
+            self.nb_batches += 1
+            self.nb_texts += nb_texts
+        start = 0
+        for request in requests:
+            request.future.set_result(embeddings[start:start+len(request.texts)])
+            start += len(request.texts)
+
+
+@traced("vectorizer.index")
+def index_vectorizer(vectorizer:TextVectorizer, batch_size:int=64, embedding_batcher:EmbeddingBatcher=None) -> bool:
+    """
+    Indexes a vector store. With model embeddings, the chunks are embedded batch by batch
+    with embed_batch instead of one embed call per chunk.
+
+    Args:
+        vectorizer (TextVectorizer): The vector store to index.
+        batch_size (int): Number of chunks per embed_batch call.
+        embedding_batcher (EmbeddingBatcher, optional): The batcher of the application, its scheduler runs the batches so that they don't run next to the generations. Defaults to None (embed_batch is called directly).
+
+    Returns:
+        bool: True if the vector store was indexed.
+    """
+    if vectorizer.vectorization_method!=VectorizationMethod.MODEL_EMBEDDING or not isinstance(vectorizer.model, LLMBinding) or len(vectorizer.chunks)==0:
+        return vectorizer.index()
+    ASCIIColors.yellow("Indexing database ...",end="")
+    chunks = list(vectorizer.chunks.values())
+    for start in range(0, len(chunks), max(1, batch_size)):
+        batch = chunks[start:start+batch_size]
+        try:
+            texts = [chunk["chunk_text"] for chunk in batch]
+            if embedding_batcher is not None:
+                embeddings = embedding_batcher.embed(vectorizer.model, texts)
+            else:
+                embeddings = vectorizer.model.embed_batch(texts)
+            for chunk, embedding in zip(batch, embeddings):
+                chunk["embeddings"] = embedding
+        except Exception as ex:
+            trace_exception(ex)
+    if vectorizer.save_db:
+        vectorizer.save_to_json()
+    ASCIIColors.green("ok")
+    vectorizer.ready = True
+    return True
@@ -0,0 +1,200 @@
+######
+# Project       : lollms
+# File          : emit_bridge.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Thread safe socket.io emits. The generation threads hand their emits to the
+# server event loop with run_coroutine_threadsafe (instead of running a new
+# event loop per emit) and the text chunks of each client are merged into
+# frames sent every few milliseconds.
+######
+from ascii_colors import ASCIIColors
+from lollms.utilities import trace_exception, run_async
+from functools import partial
+from typing import Dict, Tuple
+import threading
+import asyncio
+
+
+class ChunkBuffer:
+    """Chunks of a client waiting to be merged into a frame."""
+    def __init__(self, data:dict, key:str) -> None:
+        # The other fields of the frame are taken from the first chunk
+        self.data               = data
+        self.key                = key
+        self.parts              = []
+        self.size               = 0
+        self.flush_scheduled    = False
+        # Frames handed to the event loop and not emitted yet
+        self.pending_frames     = 0
+
+
+class EmitBridge:
+    """
+    Emits socket.io events from any thread.
+
+    emit sends an event as is. emit_chunk merges the chunks sent to the same client: a
+    frame is emitted `flush_interval` seconds after its first chunk or as soon as it reaches
+    `max_frame_size` characters. When `max_pending_frames` frames of a client are waiting
+    for the event loop, the new chunks are merged in the next frame instead of queuing
+    more frames. An event emitted to a client first flushes the chunks waiting for it so
+    the events keep their order.
+
+    Args:
+        sio (AsyncServer): The socket.io server.
+        flush_interval (float): Maximum time in seconds a chunk waits before being emitted.
+        max_frame_size (int): Number of characters that triggers the emission of a frame.
+        max_pending_frames (int): Maximum number of frames of a client waiting for the event loop.
+    """
+    def __init__(self, sio, flush_interval:float=0.005, max_frame_size:int=4096, max_pending_frames:int=64) -> None:
+        self.sio                = sio
+        self.loop               = None
+        self.flush_interval     = flush_interval
+        self.max_frame_size     = max(1, max_frame_size)
+        self.max_pending_frames = max(1, max_pending_frames)
+
+        # Reentrant: without event loop the frames are emitted (and acknowledged) synchronously
+        self._lock              = threading.RLock()
+        self._buffers:Dict[Tuple[str, str], ChunkBuffer] = {}
+        self.nb_chunks          = 0
+        self.nb_frames          = 0
+
+    def attach(self, loop:asyncio.AbstractEventLoop):
+        """Sets the event loop of the server (the first emit made from the loop also sets it)."""
+        self.loop = loop
+
+    def _get_loop(self):
+        """Returns the server loop and whether the caller runs on it."""
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if self.loop is None or self.loop.is_closed():
+            self.loop = running_loop
+        return self.loop, running_loop is not None and running_loop is self.loop
+
+    def _schedule(self, emit:partial, done=None):
+        loop, on_loop = self._get_loop()
+        if loop is None:
+            # No server loop (scripts, tests)
+            try:
+                run_async(emit)
+            finally:
+                if done is not None:
+                    done()
+            return
+        if on_loop:
+            task = loop.create_task(emit())
+            if done is not None:
+                task.add_done_callback(lambda _: done())
+        else:
+            future = asyncio.run_coroutine_threadsafe(emit(), loop)
+            if done is not None:
+                future.add_done_callback(lambda _: done())
+
+    def _call_later(self, delay:float, fn, *args):
+        loop, on_loop = self._get_loop()
+        if loop is None:
+            fn(*args)
+        elif on_loop:
+            loop.call_later(delay, fn, *args)
+        else:
+            loop.call_soon_threadsafe(loop.call_later, delay, fn, *args)
+
+    # ----------------------------------- Emission -----------------------------------
+    def emit(self, event:str, data=None, to=None, room=None, **kwargs):
+        """
+        Emits an event (same arguments as AsyncServer.emit) after the chunks waiting for its recipient.
+        """
+        with self._lock:
+            recipient = to if to is not None else room
+            if recipient is not None:
+                self._flush_client(recipient)
+            self._schedule(partial(self.sio.emit, event, data, to=to, room=room, **kwargs))
+
+    def emit_chunk(self, event:str, data:dict, to, key:str="chunk"):
+        """
+        Queues a chunk for a client. data[key] is merged with the other chunks of the same event.
+
+        Args:
+            event (str): Name of the event.
+            data (dict): Payload of the chunk.
+            to: The client.
+            key (str): Field of the payload containing the text to merge.
+        """
+        buffer_key = (to, event)
+        with self._lock:
+            self.nb_chunks += 1
+            buffer = self._buffers.get(buffer_key)
+            if buffer is None:
+                buffer = self._buffers[buffer_key] = ChunkBuffer(dict(data), key)
+            text = data.get(key) or ""
+            buffer.parts.append(text)
+            buffer.size += len(text)
+            if buffer.pending_frames>=self.max_pending_frames:
+                # The client is late, the chunk is merged with the next frame
+                return
+            if buffer.size>=self.max_frame_size:
+                self._send(buffer_key, buffer)
+            elif not buffer.flush_scheduled:
+                buffer.flush_scheduled = True
+                self._call_later(self.flush_interval, self._flush_buffer, buffer_key)
+
+    def flush(self, to):
+        """Emits the chunks waiting for a client."""
+        with self._lock:
+            self._flush_client(to)
+
+    def _flush_client(self, to):
+        for buffer_key, buffer in list(self._buffers.items()):
+            if buffer_key[0]==to and len(buffer.parts)>0:
+                self._send(buffer_key, buffer)
+
+    def _flush_buffer(self, buffer_key:Tuple[str, str]):
+        with self._lock:
+            buffer = self._buffers.get(buffer_key)
+            if buffer is None:
+                return
+            buffer.flush_scheduled = False
+            if len(buffer.parts)>0:
+                if buffer.pending_frames<self.max_pending_frames:
+                    self._send(buffer_key, buffer)
+            elif buffer.pending_frames==0:
+                del self._buffers[buffer_key]
+
+    def _send(self, buffer_key:Tuple[str, str], buffer:ChunkBuffer):
+        # Called with the lock held
+        frame = dict(buffer.data)
+        frame[buffer.key] = "".join(buffer.parts)
+        buffer.parts = []
+        buffer.size = 0
+        buffer.pending_frames += 1
+        self.nb_frames += 1
+        try:
+            self._schedule(partial(self.sio.emit, buffer_key[1], frame, to=buffer_key[0]), partial(self._frame_emitted, buffer_key))
+        except Exception as ex:
+            trace_exception(ex)
+            ASCIIColors.warning(f"Couldn't emit {buffer_key[1]} to {buffer_key[0]}")
+
+    def _frame_emitted(self, buffer_key:Tuple[str, str]):
+        with self._lock:
+            buffer = self._buffers.get(buffer_key)
+            if buffer is None:
+                return
+            buffer.pending_frames -= 1
+            if len(buffer.parts)>0:
+                if not buffer.flush_scheduled and buffer.pending_frames<self.max_pending_frames:
+                    self._send(buffer_key, buffer)
+            elif buffer.pending_frames==0 and not buffer.flush_scheduled:
+                # Nothing left for this client
+                del self._buffers[buffer_key]
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                "chunks": self.nb_chunks,
+                "frames": self.nb_frames,
+                "chunks_per_frame": self.nb_chunks/self.nb_frames if self.nb_frames>0 else 0,
+                "buffered_clients": len(set(buffer_key[0] for buffer_key in self._buffers)),
+            }
@@ -7,6 +7,7 @@ from ascii_colors import ASCIIColors
 
 from lollms.config import InstallOption, TypedConfig, BaseConfig, ConfigTemplate
 from lollms.paths import LollmsPaths
+from lollms.tracing import trace_overrides
 from enum import Enum
 from pathlib import Path
 import importlib
@@ -23,6 +24,11 @@ class EXTENSION_TYPE(Enum):
 
 
 class LOLLMSExtension():
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # The generation hooks of the extensions are traced when tracing is enabled
+        trace_overrides(cls, {"pre_gen":"extension.pre_gen", "in_gen":"extension.in_gen", "post_gen":"extension.post_gen"}, extension=cls.__name__)
+
     def __init__(self, 
                     name:str, 
                     script_path:str|Path, 
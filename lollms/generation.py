@@ -1,5 +1,12 @@
 from enum import Enum
 from ascii_colors import ASCIIColors
+from json.encoder import encode_basestring_ascii
+import asyncio
+import threading
+import json
+import time
+from contextlib import contextmanager
+from functools import wraps
 class ROLE_CHANGE_DECISION(Enum):
     """Roles change detection."""
     
@@ -23,28 +30,355 @@ class ROLE_CHANGE_OURTPUT:
         self.value = value
 
 class RECPTION_MANAGER:
-    done:bool=False
-    chunk:str=""
-    new_role:str=""
-    reception_buffer:str=""
-    def new_chunk(self, chunk):
-        self.chunk = chunk
-        if chunk=="!" and self.new_role == "":
-            self.new_role+=chunk
+    """Accumulates the generated chunks and stops on stop sequences.
+
+    The stop sequences are matched (case insensitive) by an AntipromptDetector that
+    carries partial matches across chunk boundaries, whatever the way the tokenizer
+    splits them. The end of the received text that could still be the beginning of a
+    stop sequence is held back and released as soon as it can't be one anymore.
+    The received text is kept as a list of chunks and only joined when
+    `reception_buffer` is read.
+
+    Args:
+        stop_sequences (list): The sequences that end the generation (defaults to the role change "!@>").
+    """
+    def __init__(self, stop_sequences:list=None) -> None:
+        # lollms.utilities imports this module
+        from lollms.utilities import get_antiprompt_detector
+        self.stop_sequences = [s for s in (stop_sequences if stop_sequences is not None else ["!@>"]) if s]
+        self.detector = get_antiprompt_detector(tuple(self.stop_sequences)).clone()
+        self.done:bool = False
+        self.chunk:str = ""
+        # The stop sequence that ended the generation
+        self.stop_sequence:str = None
+        self.chunks:list = []
+        self._pending:str = ""
+        self._buffer:str = ""
+        self._nb_joined_chunks:int = 0
+
+    @property
+    def reception_buffer(self) -> str:
+        """The text received so far (without the held back text nor the stop sequence)."""
+        if self._nb_joined_chunks<len(self.chunks):
+            self._buffer += "".join(self.chunks[self._nb_joined_chunks:])
+            self._nb_joined_chunks = len(self.chunks)
+        return self._buffer
+
+    def new_chunk(self, chunk:str) -> ROLE_CHANGE_OURTPUT:
+        """Processes a received chunk.
+
+        Returns:
+            ROLE_CHANGE_OURTPUT: The decision. Its value (also stored in `chunk`) is the text that can be sent to the client now:
+                MOVE_ON: the chunk is normal text
+                PROGRESSING: the chunk may be the beginning of a stop sequence, nothing to send yet
+                FALSE_ALERT: previously held back text turned out not to be a stop sequence and is released
+                ROLE_CHANGED: a stop sequence was completed, the generation must stop
+        """
+        if self.done:
+            self.chunk = ""
+            return ROLE_CHANGE_OURTPUT(ROLE_CHANGE_DECISION.ROLE_CHANGED)
+        had_pending = self._pending!=""
+        window = self._pending + chunk
+        # Offset of the window in the stream fed to the detector
+        start = self.detector.position - len(self._pending)
+        match = self.detector.feed(chunk)
+        if match is not None:
+            stop_sequence, offset = match
+            self.stop_sequence = next((s for s in self.stop_sequences if s.lower()==stop_sequence), stop_sequence)
+            self._pending = ""
+            self.chunk = window[:offset-start]
+            if self.chunk:
+                self.chunks.append(self.chunk)
+            self.done = True
+            ASCIIColors.yellow("Detected end of sentence")
+            return ROLE_CHANGE_OURTPUT(ROLE_CHANGE_DECISION.ROLE_CHANGED, self.chunk)
+
+        released = self.detector.pending_offset-start
+        self._pending = window[released:]
+        self.chunk = window[:released]
+        if self.chunk:
+            self.chunks.append(self.chunk)
+        if self.chunk=="":
             return ROLE_CHANGE_OURTPUT(ROLE_CHANGE_DECISION.PROGRESSING)
-        elif self.new_role != "":
-            if self.new_role=="!" and chunk=="@":
-                self.new_role+=chunk
-                return ROLE_CHANGE_OURTPUT(ROLE_CHANGE_DECISION.PROGRESSING)
-            elif self.new_role=="!@" and chunk==">":
-                self.new_role=""
-                self.done=True
-                ASCIIColors.yellow("Delected end of sentence")
-                return ROLE_CHANGE_OURTPUT(ROLE_CHANGE_DECISION.ROLE_CHANGED, self.reception_buffer)
-            else:
-                rc = ROLE_CHANGE_OURTPUT(ROLE_CHANGE_DECISION.FALSE_ALERT, self.reception_buffer)
-                self.reception_buffer += self.new_role      
-                return rc
-        self.reception_buffer += chunk
-        return ROLE_CHANGE_OURTPUT(ROLE_CHANGE_DECISION.MOVE_ON)
+        return ROLE_CHANGE_OURTPUT(ROLE_CHANGE_DECISION.FALSE_ALERT if had_pending else ROLE_CHANGE_DECISION.MOVE_ON, self.chunk)
+
+    def flush(self) -> str:
+        """Releases the held back text at the end of the generation and returns it."""
+        self.chunk = self._pending
+        self._pending = ""
+        if self.chunk:
+            self.chunks.append(self.chunk)
+        return self.chunk
+
+
+
+class STREAM_BRIDGE:
+    """Thread to asyncio bridge used to stream generated chunks.
+
+    The generation thread calls `put` for every chunk. The chunk is handed to the
+    event loop through `loop.call_soon_threadsafe` and the consumer awaits it with
+    `async for`. The bridge is bounded: when `max_size` chunks are waiting, the
+    producer blocks until the consumer catches up (backpressure).
+    """
+    def __init__(self, loop:asyncio.AbstractEventLoop, max_size:int=256) -> None:
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.closed = False
+
+    def put(self, chunk:str) -> bool:
+        """Sends a chunk to the consumer (called from the generation thread).
+
+        Returns:
+            bool: False if the consumer is gone and the generation should stop.
+        """
+        while not self.slots.acquire(timeout=0.1):
+            if self.closed:
+                return False
+        if self.closed:
+            return False
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, chunk)
+        except RuntimeError: # The event loop is closed
+            self.closed = True
+            return False
+        return True
+
+    def finish(self):
+        """Signals the end of the stream (called from the generation thread)."""
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+        except RuntimeError:
+            pass
+
+    def close(self):
+        """Called by the consumer when it stops reading."""
+        self.closed = True
+
+    async def __aiter__(self):
+        try:
+            while True:
+                chunk = await self.queue.get()
+                if chunk is None:
+                    break
+                self.slots.release()
+                yield chunk
+        finally:
+            self.close()
+
+
+class OPENAI_SSE_ENCODER:
+    """Server sent events encoder for OpenAI compatible streaming.
+
+    The JSON envelope of the chunks (id, object, created, model, choice) is
+    rendered once per request: each token only costs escaping its content and
+    joining three strings.
+
+    Args:
+        id (str): The identifier shared by all the chunks of the request.
+        model (str): The model name reported to the client.
+        chat (bool): True for chat.completion.chunk objects (delta content), False for text_completion objects (text).
+        created (int): Creation timestamp (defaults to now).
+    """
+    DONE = "data: [DONE]\n\n"
+
+    def __init__(self, id:str, model:str, chat:bool=True, created:int=None) -> None:
+        self.id = id
+        self.model = model
+        self.chat = chat
+        self.created = int(time.time()) if created is None else created
+        self.object = "chat.completion.chunk" if chat else "text_completion"
+        self._header = (
+            'data: {"id":' + json.dumps(self.id) +
+            ',"object":' + json.dumps(self.object) +
+            ',"created":' + str(self.created) +
+            ',"model":' + json.dumps(self.model) +
+            ',"system_fingerprint":null,"choices":['
+        )
+        self._prefixes = {}
+        self._suffix = ',"logprobs":null,"finish_reason":null}]}\n\n'
+
+    def _prefix(self, index:int) -> str:
+        prefix = self._prefixes.get(index)
+        if prefix is None:
+            content = '"delta":{"content":' if self.chat else '"text":'
+            prefix = self._prefixes[index] = self._header + '{"index":' + str(index) + ',' + content
+        return prefix
+
+    def role(self, index:int=0, role:str="assistant") -> str:
+        """First chunk of a chat completion announcing the role."""
+        return self._header + '{"index":' + str(index) + ',"delta":{"role":' + json.dumps(role) + ',"content":""}' + self._suffix
+
+    def chunk(self, text:str, index:int=0) -> str:
+        """Encodes a generated chunk."""
+        return self._prefix(index) + encode_basestring_ascii(text) + ('}' if self.chat else '') + self._suffix
+
+    def finish(self, finish_reason:str="stop", index:int=0) -> str:
+        """Last chunk of a choice."""
+        content = '"delta":{}' if self.chat else '"text":""'
+        return self._header + '{"index":' + str(index) + ',' + content + ',"logprobs":null,"finish_reason":' + json.dumps(finish_reason) + '}]}\n\n'
+
+    def usage(self, prompt_tokens:int, completion_tokens:int, timings:dict=None) -> str:
+        """Usage chunk sent after all the choices are finished (with the request timings if they were asked)."""
+        return (
+            self._header + '],"usage":{"prompt_tokens":' + str(prompt_tokens) +
+            ',"completion_tokens":' + str(completion_tokens) +
+            ',"total_tokens":' + str(prompt_tokens+completion_tokens) + '}' +
+            (',"timings":' + json.dumps(timings) if timings is not None else '') + '}\n\n'
+        )
+
+
+class TOKEN_USAGE:
+    """Token counts of a generation.
+
+    The callback pipeline counts one completion token per received chunk while the
+    generation runs. Bindings that know the exact numbers report them with
+    `LLMBinding.report_usage`, the reported values replace the counted ones.
+
+    Args:
+        prompt_tokens (int): Number of tokens of the prompt (estimated before the generation).
+    """
+    def __init__(self, prompt_tokens:int=0) -> None:
+        self.counted_prompt_tokens = prompt_tokens
+        self.counted_completion_tokens = 0
+        self.reported_prompt_tokens:int = None
+        self.reported_completion_tokens:int = None
+
+    @property
+    def exact(self) -> bool:
+        return self.reported_completion_tokens is not None
+
+    @property
+    def prompt_tokens(self) -> int:
+        return self.reported_prompt_tokens if self.reported_prompt_tokens is not None else self.counted_prompt_tokens
+
+    @prompt_tokens.setter
+    def prompt_tokens(self, value:int):
+        self.counted_prompt_tokens = value
+
+    @property
+    def completion_tokens(self) -> int:
+        return self.reported_completion_tokens if self.reported_completion_tokens is not None else self.counted_completion_tokens
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def count_chunk(self):
+        self.counted_completion_tokens += 1
+
+    def report(self, prompt_tokens:int=None, completion_tokens:int=None):
+        if prompt_tokens is not None:
+            self.reported_prompt_tokens = prompt_tokens
+        if completion_tokens is not None:
+            self.reported_completion_tokens = completion_tokens
+
+    def to_dict(self) -> dict:
+        return {"prompt_tokens":self.prompt_tokens, "completion_tokens":self.completion_tokens, "total_tokens":self.total_tokens}
+
+
+_usage_local = threading.local()
+
+def current_usage() -> TOKEN_USAGE:
+    """Usage of the generation running in the calling thread (None outside of a tracked generation)."""
+    return getattr(_usage_local, "usage", None)
+
+@contextmanager
+def track_usage(usage:TOKEN_USAGE):
+    """Makes usage the target of LLMBinding.report_usage calls made by the calling thread."""
+    previous_usage = current_usage()
+    _usage_local.usage = usage
+    try:
+        yield usage
+    finally:
+        _usage_local.usage = previous_usage
+
+
+class GENERATION_TIMINGS:
+    """Time spent in each step of a request (queue, tokenization, prompt building, prefill, decode, ...).
+
+    Steps are recorded as spans and the durations of a step add up. The decode timings
+    are gathered by the callbacks wrapped with `track_decode` (one per generated choice).
+    `to_dict` returns the durations in seconds.
+    """
+    def __init__(self) -> None:
+        self.created_at = time.perf_counter()
+        self.values = {}
+        # [start time, first chunk time, last chunk time, number of chunks] of each tracked generation
+        self.decodes = []
+        self._lock = threading.Lock()
+
+    def add(self, name:str, seconds:float):
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + seconds
+
+    def set_first(self, name:str, seconds:float):
+        """Records a value unless it was already recorded (queue time of the first job for example)."""
+        with self._lock:
+            self.values.setdefault(name, seconds)
+
+    @contextmanager
+    def span(self, name:str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter()-start)
+
+    def track_decode(self, callback):
+        """Wraps a generation callback to record the time to first token and the decode speed."""
+        decode = [time.perf_counter(), None, None, 0]
+        with self._lock:
+            self.decodes.append(decode)
+        def timed_callback(chunk, *args, **kwargs):
+            if chunk is not None:
+                now = time.perf_counter()
+                if decode[1] is None:
+                    decode[1] = now
+                decode[2] = now
+                decode[3] += 1
+            return callback(chunk, *args, **kwargs) if callback is not None else True
+        return timed_callback
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            timings = {name:round(value, 6) for name, value in self.values.items()}
+            decodes = [decode for decode in self.decodes if decode[1] is not None]
+        if len(decodes)>0:
+            timings["ttft"] = round(min(decode[1]-decode[0] for decode in decodes), 6)
+            decode_time = sum(decode[2]-decode[1] for decode in decodes)
+            nb_decoded = sum(decode[3]-1 for decode in decodes)
+            timings["decode"] = round(decode_time, 6)
+            timings["tokens_per_second"] = round(nb_decoded/decode_time, 3) if decode_time>0 else 0
+        timings["total"] = round(time.perf_counter()-self.created_at, 6)
+        return timings
+
+
+_timings_local = threading.local()
+
+def current_timings() -> GENERATION_TIMINGS:
+    """Timings of the request handled by the calling thread (None if the request didn't ask for them)."""
+    return getattr(_timings_local, "timings", None)
+
+@contextmanager
+def track_timings(timings:GENERATION_TIMINGS):
+    """Makes timings the target of the spans recorded by the calling thread."""
+    previous_timings = current_timings()
+    _timings_local.timings = timings
+    try:
+        yield timings
+    finally:
+        _timings_local.timings = previous_timings
 
+def timed_span(name:str):
+    """Decorator recording the duration of the calls in the timings of the current request."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            timings = current_timings()
+            if timings is None:
+                return fn(*args, **kwargs)
+            with timings.span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
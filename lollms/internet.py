@@ -1,4 +1,5 @@
 from ascii_colors import ASCIIColors, trace_exception
+from lollms.tracing import tracer
 def get_favicon_url(url):
     import requests
     from bs4 import BeautifulSoup
@@ -58,7 +59,8 @@ def get_relevant_text_block(
         }
         document_id["title"] = title
         document_id["brief"] = brief
-        vectorizer.add_document(document_id,all_text, config.internet_vectorization_chunk_size, config.internet_vectorization_overlap_size)
+        with tracer.span("vectorizer.add_document", document=url):
+            vectorizer.add_document(document_id,all_text, config.internet_vectorization_chunk_size, config.internet_vectorization_overlap_size)
     except:
         ASCIIColors.warning(f"Couldn't scrape: {url}")
 
@@ -161,15 +163,18 @@ def internet_search(query, chromedriver_path, config, model = None, quick_search
         brief = result["brief"]
         href = result["href"]
         if quick_search:
-            vectorizer.add_document({'url':href, 'title':title, 'brief': brief}, brief)
+            with tracer.span("vectorizer.add_document", document=href):
+                vectorizer.add_document({'url':href, 'title':title, 'brief': brief}, brief)
         else:
             get_relevant_text_block(href, driver, config, vectorizer, title, brief)
         nb_non_empty += 1
         if nb_non_empty>=config.internet_nb_search_pages:
             break
-    vectorizer.index()
+    with tracer.span("vectorizer.index"):
+        vectorizer.index()
     # Close the browser
     driver.quit()
 
-    docs, sorted_similarities, document_ids = vectorizer.recover_text(query, config.internet_vectorization_nb_chunks)
+    with tracer.span("vectorizer.query", nb_chunks=config.internet_vectorization_nb_chunks):
+        docs, sorted_similarities, document_ids = vectorizer.recover_text(query, config.internet_vectorization_nb_chunks)
     return docs, sorted_similarities, document_ids
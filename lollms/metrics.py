@@ -0,0 +1,187 @@
+######
+# Project       : lollms
+# File          : metrics.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Metrics of the generation server in the Prometheus text format. Counters and
+# histograms are recorded in per-thread shards (no lock on the hot path) and
+# aggregated when /metrics is scraped.
+######
+from bisect import bisect_left
+from typing import Callable, Dict, Tuple
+import threading
+import math
+
+
+TTFT_BUCKETS            = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+INTER_TOKEN_BUCKETS     = (0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsShard:
+    """Counters and histograms written by a single thread."""
+    def __init__(self, thread:threading.Thread) -> None:
+        self.thread     = thread
+        # (name, labels) -> value
+        self.counters:Dict[Tuple[str, tuple], float] = {}
+        # (name, labels) -> [count per bucket..., +Inf count, sum]
+        self.histograms:Dict[Tuple[str, tuple], list] = {}
+
+
+class MetricsRegistry:
+    """
+    Registry of the server metrics.
+
+    `inc` and `observe` only touch the shard of the calling thread. `render` merges
+    the shards (the shards of finished threads are folded into a retired shard) and
+    evaluates the gauges.
+    """
+    def __init__(self) -> None:
+        self._local         = threading.local()
+        self._lock          = threading.Lock()
+        self._shards        = []
+        self._retired       = MetricsShard(None)
+        # name -> (type, help)
+        self._descriptions:Dict[str, Tuple[str, str]] = {}
+        self._buckets:Dict[str, tuple] = {}
+        # name -> callable returning a value or a {labels tuple: value} dict
+        self._gauges:Dict[str, Callable] = {}
+
+    # ----------------------------------- Declaration -----------------------------------
+    def counter(self, name:str, help:str):
+        self._descriptions[name] = ("counter", help)
+
+    def histogram(self, name:str, help:str, buckets:tuple):
+        self._descriptions[name] = ("histogram", help)
+        self._buckets[name] = tuple(buckets)
+
+    def gauge(self, name:str, help:str, fn:Callable):
+        """Declares a gauge evaluated at scrape time. fn returns a number or a {((label, value),...): number} dict."""
+        self._descriptions[name] = ("gauge", help)
+        self._gauges[name] = fn
+
+    # ----------------------------------- Recording -----------------------------------
+    def _shard(self) -> MetricsShard:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = MetricsShard(threading.current_thread())
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def inc(self, name:str, value:float=1, **labels):
+        counters = self._shard().counters
+        key = (name, tuple(labels.items()))
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name:str, value:float, **labels):
+        histograms = self._shard().histograms
+        key = (name, tuple(labels.items()))
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0]*(len(self._buckets[name])+2)
+        histogram[bisect_left(self._buckets[name], value)] += 1
+        histogram[-1] += value
+
+    # ----------------------------------- Scraping -----------------------------------
+    @staticmethod
+    def _merge(counters:dict, histograms:dict, shard:MetricsShard):
+        # dict() copies are atomic under the GIL, the owner thread may keep writing
+        for (name, labels), value in dict(shard.counters).items():
+            key = (name, tuple(sorted(labels)))
+            counters[key] = counters.get(key, 0) + value
+        for (name, labels), values in dict(shard.histograms).items():
+            key = (name, tuple(sorted(labels)))
+            values = list(values)
+            merged = histograms.get(key)
+            if merged is None:
+                histograms[key] = values
+            else:
+                histograms[key] = [a+b for a, b in zip(merged, values)]
+
+    def collect(self) -> Tuple[dict, dict]:
+        """Returns the aggregated counters and histograms."""
+        with self._lock:
+            alive = []
+            for shard in self._shards:
+                if shard.thread.is_alive():
+                    alive.append(shard)
+                else:
+                    # The thread is gone, its shard won't change anymore
+                    self._merge(self._retired.counters, self._retired.histograms, shard)
+            self._shards = alive
+            counters, histograms = {}, {}
+            self._merge(counters, histograms, self._retired)
+            for shard in alive:
+                self._merge(counters, histograms, shard)
+        return counters, histograms
+
+    @staticmethod
+    def _format_labels(labels:tuple, extra:tuple=()) -> str:
+        labels = tuple(labels) + tuple(extra)
+        if len(labels)==0:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+    @staticmethod
+    def _format_value(value:float) -> str:
+        if isinstance(value, float):
+            if math.isinf(value):
+                return "+Inf" if value>0 else "-Inf"
+            return repr(value)
+        return str(value)
+
+    def render(self) -> str:
+        """Renders all the metrics in the Prometheus text exposition format."""
+        counters, histograms = self.collect()
+        lines = []
+        for name, (metric_type, help) in self._descriptions.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type=="counter":
+                for (metric_name, labels), value in counters.items():
+                    if metric_name==name:
+                        lines.append(f"{name}{self._format_labels(labels)} {self._format_value(value)}")
+            elif metric_type=="histogram":
+                buckets = self._buckets[name]
+                for (metric_name, labels), values in histograms.items():
+                    if metric_name!=name:
+                        continue
+                    cumulated = 0
+                    for bound, count in zip(buckets, values):
+                        cumulated += count
+                        lines.append(f"{name}_bucket{self._format_labels(labels, (('le', self._format_value(float(bound))),))} {cumulated}")
+                    cumulated += values[len(buckets)]
+                    lines.append(f"{name}_bucket{self._format_labels(labels, (('le', '+Inf'),))} {cumulated}")
+                    lines.append(f"{name}_sum{self._format_labels(labels)} {self._format_value(float(values[-1]))}")
+                    lines.append(f"{name}_count{self._format_labels(labels)} {cumulated}")
+            else:
+                try:
+                    value = self._gauges[name]()
+                except Exception:
+                    continue
+                if isinstance(value, dict):
+                    for labels, gauge_value in value.items():
+                        lines.append(f"{name}{self._format_labels(labels)} {self._format_value(gauge_value)}")
+                else:
+                    lines.append(f"{name} {self._format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# Metrics of the server (shared by the application, the scheduler and the endpoints)
+metrics = MetricsRegistry()
+metrics.counter("lollms_requests_total", "Number of generation requests received by endpoint")
+metrics.counter("lollms_errors_total", "Number of failed requests and generations by source")
+metrics.counter("lollms_cancellations_total", "Number of canceled generations by reason")
+metrics.counter("lollms_generations_total", "Number of generations by binding and model")
+metrics.counter("lollms_prompt_tokens_total", "Number of prompt tokens processed by binding and model")
+metrics.counter("lollms_completion_tokens_total", "Number of generated tokens by binding and model")
+metrics.counter("lollms_generation_seconds_total", "Time spent generating by binding and model")
+metrics.histogram("lollms_time_to_first_token_seconds", "Time between the start of a generation and its first token", TTFT_BUCKETS)
+metrics.histogram("lollms_inter_token_latency_seconds", "Time between two consecutive tokens", INTER_TOKEN_BUCKETS)
+metrics.histogram("lollms_tokens_per_second", "Decoding speed of each generation", TOKENS_PER_SECOND_BUCKETS)
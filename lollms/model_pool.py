@@ -0,0 +1,243 @@
+######
+# Project       : lollms
+# File          : model_pool.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Model pool. Keeps several (binding, model) pairs loaded at the same time
+# within a memory budget so that requests can be routed to the model they ask
+# for. Models are loaded in the background and the least recently used ones
+# are unloaded when the budget is exceeded.
+######
+from ascii_colors import ASCIIColors
+from lollms.main_config import LOLLMSConfig
+from lollms.binding import LLMBinding, BindingBuilder, ModelBuilder
+from lollms.utilities import trace_exception
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Dict, Tuple
+import threading
+import asyncio
+import time
+import gc
+
+# Number of times acquire loads a model again when it is unloaded before being used
+ACQUIRE_ATTEMPTS = 3
+
+
+class ModelPoolEntry:
+    """A (binding, model) pair of the pool."""
+    def __init__(self, binding_name:str, model_name:str) -> None:
+        self.binding_name       = binding_name
+        self.model_name         = model_name
+        self.binding:LLMBinding = None
+        self.model:Any          = None
+        self.size               = 0
+        self.last_used          = time.time()
+        # Number of generations currently using the model (it can't be unloaded while > 0)
+        self.users              = 0
+        self.future             = Future()
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return (self.binding_name, self.model_name)
+
+    @property
+    def loaded(self) -> bool:
+        return self.future.done() and self.future.exception() is None
+
+
+class ModelPool:
+    """
+    Keeps several models loaded within a memory budget.
+
+    The memory used by a model is estimated from the size of its files. The active
+    model of the application and the models used by running generations are never
+    unloaded.
+
+    Args:
+        app (LollmsApplication): The application (provides the configuration, paths and the active model).
+        max_memory (int): Memory budget in bytes.
+        retry_delay (float): Time in seconds before trying again to load a model that failed to load.
+    """
+    def __init__(self, app, max_memory:int, retry_delay:float=300) -> None:
+        self.app            = app
+        self.max_memory     = max_memory
+        self.retry_delay    = retry_delay
+
+        self._entries:Dict[Tuple[str, str], ModelPoolEntry] = {}
+        self._failures:Dict[Tuple[str, str], float] = {}
+        self._lock          = threading.RLock()
+
+    # ----------------------------------- Public API -----------------------------------
+    @property
+    def memory(self) -> int:
+        with self._lock:
+            return sum(entry.size for entry in self._entries.values() if entry.loaded)
+
+    def register(self, binding:LLMBinding, model:Any) -> ModelPoolEntry:
+        """Adds an already loaded model (the one loaded by the application at startup for example)."""
+        entry = ModelPoolEntry(binding.config.binding_name, binding.config.model_name)
+        entry.binding = binding
+        entry.model = model
+        entry.size = self._estimate_size(binding)
+        entry.future.set_result(entry)
+        with self._lock:
+            self._entries[entry.key] = entry
+        self._evict(entry)
+        return entry
+
+    def load(self, model_name:str, binding_name:str=None) -> Future:
+        """
+        Returns a future resolved with the entry of the model, loading it in the background if needed.
+        """
+        binding_name = binding_name or self.app.config.binding_name
+        key = (binding_name, model_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.last_used = time.time()
+                return entry.future
+            failure_time = self._failures.get(key)
+            if failure_time is not None and time.time()-failure_time<self.retry_delay:
+                future = Future()
+                future.set_exception(RuntimeError(f"Model {model_name} of binding {binding_name} failed to load recently"))
+                return future
+            entry = ModelPoolEntry(binding_name, model_name)
+            self._entries[key] = entry
+        threading.Thread(target=self._load, args=(entry,), name=f"lollms-model-loader-{model_name}", daemon=True).start()
+        return entry.future
+
+    def acquire(self, model_name:str, binding_name:str=None, timeout:float=None) -> ModelPoolEntry:
+        """
+        Waits until the model is loaded and marks it as used. Every acquire must be followed by a release.
+
+        A model unloaded between the end of its loading and the acquire is loaded again,
+        RuntimeError is raised if this keeps happening.
+        """
+        for _ in range(ACQUIRE_ATTEMPTS):
+            entry = self.load(model_name, binding_name).result(timeout)
+            if self._use(entry):
+                return entry
+        raise RuntimeError(f"Model {model_name} was unloaded before it could be used")
+
+    async def acquire_async(self, model_name:str, binding_name:str=None) -> ModelPoolEntry:
+        """Same as acquire without blocking the event loop."""
+        for _ in range(ACQUIRE_ATTEMPTS):
+            entry = await asyncio.wrap_future(self.load(model_name, binding_name))
+            if self._use(entry):
+                return entry
+        raise RuntimeError(f"Model {model_name} was unloaded before it could be used")
+
+    def release(self, entry:ModelPoolEntry):
+        with self._lock:
+            entry.users -= 1
+            entry.last_used = time.time()
+
+    def unload(self, model_name:str, binding_name:str=None) -> bool:
+        """Unloads a model (unless it is active or in use)."""
+        binding_name = binding_name or self.app.config.binding_name
+        with self._lock:
+            entry = self._entries.get((binding_name, model_name))
+            if entry is None or not entry.loaded or not self._evictable(entry):
+                return False
+            del self._entries[entry.key]
+        self._destroy(entry)
+        return True
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                "memory": sum(entry.size for entry in self._entries.values() if entry.loaded),
+                "max_memory": self.max_memory,
+                "models": [
+                    {
+                        "binding_name": entry.binding_name,
+                        "model_name": entry.model_name,
+                        "status": "loaded" if entry.loaded else "loading",
+                        "size": entry.size,
+                        "users": entry.users,
+                        "active": entry.model is not None and entry.model is self.app.model,
+                        "last_used": entry.last_used,
+                    } for entry in self._entries.values()
+                ]
+            }
+
+    # ----------------------------------- Internals -----------------------------------
+    def _use(self, entry:ModelPoolEntry) -> bool:
+        """Marks the entry as used unless it was removed from the pool (unloaded) in the meantime."""
+        with self._lock:
+            if self._entries.get(entry.key) is not entry:
+                return False
+            entry.users += 1
+            entry.last_used = time.time()
+            return True
+
+    def _estimate_size(self, binding:LLMBinding) -> int:
+        """Size of the model files (0 for remote models)."""
+        try:
+            model_path = binding.get_model_path()
+            if model_path is None or not Path(model_path).exists():
+                return 0
+            model_path = Path(model_path)
+            if model_path.is_file():
+                return model_path.stat().st_size
+            return sum(f.stat().st_size for f in model_path.rglob("*") if f.is_file())
+        except Exception as ex:
+            trace_exception(ex)
+            return 0
+
+    def _load(self, entry:ModelPoolEntry):
+        ASCIIColors.info(f"Model pool: loading {entry.model_name} ({entry.binding_name}) in the background")
+        try:
+            # Each binding instance gets its own copy of the configuration since bindings read the model name from it
+            config = LOLLMSConfig(lollms_paths=self.app.lollms_paths)
+            config.config = dict(self.app.config.config)
+            config["binding_name"] = entry.binding_name
+            config["model_name"] = entry.model_name
+            entry.binding = BindingBuilder().build_binding(config, self.app.lollms_paths, lollmsCom=self.app)
+            entry.size = self._estimate_size(entry.binding)
+            # Make room before the weights are loaded
+            self._evict(entry)
+            entry.model = ModelBuilder(entry.binding).get_model()
+            if entry.model is None:
+                raise RuntimeError(f"Binding {entry.binding_name} couldn't build model {entry.model_name}")
+            entry.last_used = time.time()
+            entry.future.set_result(entry)
+            ASCIIColors.success(f"Model pool: {entry.model_name} loaded")
+        except Exception as ex:
+            trace_exception(ex)
+            with self._lock:
+                self._entries.pop(entry.key, None)
+                self._failures[entry.key] = time.time()
+            entry.future.set_exception(ex)
+
+    def _evictable(self, entry:ModelPoolEntry) -> bool:
+        return entry.users==0 and entry.model is not self.app.model
+
+    def _evict(self, keep:ModelPoolEntry):
+        """Unloads the least recently used models until the budget is respected."""
+        evicted = []
+        with self._lock:
+            loaded = [entry for entry in self._entries.values() if entry.loaded or entry is keep]
+            memory = sum(entry.size for entry in loaded)
+            for entry in sorted(loaded, key=lambda e: e.last_used):
+                if memory<=self.max_memory:
+                    break
+                if entry is keep or not self._evictable(entry):
+                    continue
+                del self._entries[entry.key]
+                memory -= entry.size
+                evicted.append(entry)
+        for entry in evicted:
+            self._destroy(entry)
+
+    def _destroy(self, entry:ModelPoolEntry):
+        ASCIIColors.info(f"Model pool: unloading {entry.model_name} ({entry.binding_name})")
+        try:
+            entry.binding.destroy_model()
+        except Exception as ex:
+            trace_exception(ex)
+        entry.binding = None
+        entry.model = None
+        gc.collect()
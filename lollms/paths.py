@@ -70,6 +70,7 @@ class LollmsPaths:
         self.personal_certificates          = self.personal_path / "certs"
         self.personal_outputs_path          = self.personal_path / "outputs"
         self.personal_user_infos_path       = self.personal_path / "user_infos"
+        self.personal_cache_path            = self.personal_path / "cache"
 
         self.personal_trainers_path         = self.personal_path / "trainers"
         self.gptqlora_path                  = self.personal_trainers_path / "gptqlora"
@@ -174,6 +175,7 @@ class LollmsPaths:
         self.personal_outputs_path.mkdir(parents=True, exist_ok=True)
         self.personal_uploads_path.mkdir(parents=True, exist_ok=True)
         self.personal_user_infos_path.mkdir(parents=True, exist_ok=True)
+        self.personal_cache_path.mkdir(parents=True, exist_ok=True)
         self.personal_trainers_path.mkdir(parents=True, exist_ok=True)
         self.custom_personalities_path.mkdir(parents=True, exist_ok=True)
         self.custom_voices_path.mkdir(parents=True, exist_ok=True)
@@ -13,7 +13,11 @@ from lollms.config import InstallOption, TypedConfig, BaseConfig
 from lollms.main_config import LOLLMSConfig
 from lollms.paths import LollmsPaths
 from lollms.binding import LLMBinding, BindingType
-from lollms.utilities import PromptReshaper, PackageManager, discussion_path_to_url
+from lollms.utilities import PromptReshaper, PackageManager, discussion_path_to_url, AntipromptDetector, get_antiprompt_detector
+from lollms.scheduler import SchedulerLane
+from lollms.embeddings import index_vectorizer
+from lollms.generation import timed_span, current_timings
+from lollms.tracing import tracer, traced, trace_overrides
 from lollms.com import NotificationType, NotificationDisplayType
 
 import pkg_resources
@@ -117,6 +121,8 @@ class AIPersonality:
         ValueError: If the provided path is not a folder or does not contain a config.yaml file.
         """
         self.bot_says = ""
+        # Streaming antiprompt detector of the current generation (see process)
+        self._antiprompt_stream:AntipromptDetector = None
 
         self.lollms_paths = lollms_paths
         self.model = model
@@ -329,6 +335,7 @@ Date: {{date}}
             callback(full_text, MSG_TYPE.MSG_TYPE_FULL_INVISIBLE_TO_USER)
 
 
+    @timed_span("prompt_building")
     def build_prompt(self, prompt_parts:List[str], sacrifice_id:int=-1, context_size:int=None, minimum_spare_context_size:int=None):
         """
         Builds the prompt for code generation.
@@ -353,14 +360,14 @@ Date: {{date}}
             part_tokens=[]
             nb_tokens=0
             for i,part in enumerate(prompt_parts):
-                tk = self.model.tokenize(part)
+                tk = self.model.tokenizer_cache.tokenize(part)
                 part_tokens.append(tk)
                 if i != sacrifice_id:
                     nb_tokens += len(tk)
             if len(part_tokens[sacrifice_id])>0:
                 sacrifice_tk = part_tokens[sacrifice_id]
                 sacrifice_tk= sacrifice_tk[-(context_size-nb_tokens-minimum_spare_context_size):]
-                sacrifice_text = self.model.detokenize(sacrifice_tk)
+                sacrifice_text = self.model.tokenizer_cache.detokenize(sacrifice_tk)
             else:
                 sacrifice_text = ""
             prompt_parts[sacrifice_id] = sacrifice_text
@@ -439,7 +446,7 @@ Date: {{date}}
         elements += ["!@>answer:"]
         prompt = self.build_prompt(elements)
             
-        gen = self.generate(prompt, max_answer_length, temperature=0.1, top_k=50, top_p=0.9, repeat_penalty=1.0, repeat_last_n=50, callback=self.sink).strip().replace("</s>","").replace("<s>","")
+        gen = self.generate(prompt, max_answer_length, temperature=0.1, top_k=50, top_p=0.9, repeat_penalty=1.0, repeat_last_n=50, callback=self.sink, cache=True).strip().replace("</s>","").replace("<s>","")
         selection = gen.strip().split()[0].replace(",","").replace(".","")
         self.print_prompt("Multi choice selection",prompt+gen)
         try:
@@ -481,7 +488,7 @@ Date: {{date}}
         elements += ["!@>answer:"]
         prompt = self.build_prompt(elements)
             
-        gen = self.generate(prompt, max_answer_length, temperature=0.1, top_k=50, top_p=0.9, repeat_penalty=1.0, repeat_last_n=50).strip().replace("</s>","").replace("<s>","")
+        gen = self.generate(prompt, max_answer_length, temperature=0.1, top_k=50, top_p=0.9, repeat_penalty=1.0, repeat_last_n=50, cache=True).strip().replace("</s>","").replace("<s>","")
         self.print_prompt("Multi choice ranking",prompt+gen)
         if gen.index("]")>=0:
             try:
@@ -567,17 +574,17 @@ Date: {{date}}
             debug = self.config.debug
             
         if max_generation_size is None:
-            prompt_size = self.model.tokenize(prompt)
+            prompt_size = self.model.tokenizer_cache.tokenize(prompt)
             max_generation_size = self.model.config.ctx_size - len(prompt_size)
 
         pr = PromptReshaper(prompt)
         prompt = pr.build(placeholders, 
-                        self.model.tokenize, 
-                        self.model.detokenize, 
+                        self.model.tokenizer_cache.tokenize, 
+                        self.model.tokenizer_cache.detokenize, 
                         self.model.config.ctx_size - max_generation_size,
                         sacrifice
                         )
-        ntk = len(self.model.tokenize(prompt))
+        ntk = len(self.model.tokenizer_cache.tokenize(prompt))
         max_generation_size = min(self.model.config.ctx_size - ntk, max_generation_size)
         # TODO : add show progress
 
@@ -587,7 +594,8 @@ Date: {{date}}
            
         return gen
 
-    def fast_gen(self, prompt: str, max_generation_size: int=None, placeholders: dict = {}, sacrifice: list = ["previous_discussion"], debug: bool  = False, callback=None, show_progress=False) -> str:
+    @traced("personality.fast_gen")
+    def fast_gen(self, prompt: str, max_generation_size: int=None, placeholders: dict = {}, sacrifice: list = ["previous_discussion"], debug: bool  = False, callback=None, show_progress=False, cache: bool = False) -> str:
         """
         Fast way to generate code
         
@@ -600,6 +608,7 @@ Date: {{date}}
         - placeholders (dict, optional): A dictionary of placeholders to be replaced in the prompt. Defaults to an empty dictionary.
         - sacrifice (list, optional): A list of placeholders to sacrifice if the window is bigger than the context size minus the number of tokens to generate. Defaults to ["previous_discussion"].
         - debug (bool, optional): Flag to enable/disable debug mode. Defaults to False.
+        - cache (bool, optional): If True, the output is served from the response cache (when enabled) even if the sampling is not deterministic. Defaults to False.
         
         Returns:
         - str: The generated text after removing special tokens ("<s>" and "</s>") and stripping any leading/trailing whitespace.
@@ -608,21 +617,21 @@ Date: {{date}}
             debug = self.config.debug
             
         if max_generation_size is None:
-            prompt_size = self.model.tokenize(prompt)
+            prompt_size = self.model.tokenizer_cache.tokenize(prompt)
             max_generation_size = self.model.config.ctx_size - len(prompt_size)
 
         pr = PromptReshaper(prompt)
         prompt = pr.build(placeholders, 
-                        self.model.tokenize, 
-                        self.model.detokenize, 
+                        self.model.tokenizer_cache.tokenize, 
+                        self.model.tokenizer_cache.detokenize, 
                         self.model.config.ctx_size - max_generation_size,
                         sacrifice
                         )
-        ntk = len(self.model.tokenize(prompt))
+        ntk = len(self.model.tokenizer_cache.tokenize(prompt))
         max_generation_size = min(self.model.config.ctx_size - ntk, max_generation_size)
         # TODO : add show progress
 
-        gen = self.generate(prompt, max_generation_size, callback=callback, show_progress=show_progress).strip().replace("</s>", "").replace("<s>", "")
+        gen = self.generate(prompt, max_generation_size, callback=callback, show_progress=show_progress, cache=cache).strip().replace("</s>", "").replace("<s>", "")
         if debug:
             self.print_prompt("prompt", prompt+gen)
            
@@ -646,15 +655,36 @@ Date: {{date}}
 
         return string
 
+    def _current_cancellation_token(self):
+        """Cancellation token of the request being processed by this thread (None outside of the scheduler)."""
+        scheduler = getattr(self.app, "scheduler", None)
+        return scheduler.current_cancellation_token() if scheduler is not None else None
+
     def process(self, text:str, message_type:MSG_TYPE, callback=None, show_progress=False):
         if callback is None:
             callback = self.callback
         if text is None:
             return True
+        cancellation_token = self._current_cancellation_token()
+        if cancellation_token is not None and cancellation_token.canceled:
+            ASCIIColors.warning("Generation canceled")
+            return False
+        timings = current_timings()
+        detection_start = time.perf_counter() if timings is not None else None
         if message_type==MSG_TYPE.MSG_TYPE_CHUNK:
             bot_says = self.bot_says + text
+            if self._antiprompt_stream is None or self._antiprompt_stream.position!=len(self.bot_says):
+                # New generation (or bot_says was changed from outside): rescan once
+                self._antiprompt_stream = self.antiprompt_detector.clone()
+                antiprompt = self._antiprompt_stream.feed(bot_says)
+            else:
+                antiprompt = self._antiprompt_stream.feed(text)
         elif  message_type==MSG_TYPE.MSG_TYPE_FULL:
             bot_says = text
+            self._antiprompt_stream = self.antiprompt_detector.clone()
+            antiprompt = self._antiprompt_stream.feed(bot_says)
+        if timings is not None:
+            timings.add("stop_processing", time.perf_counter()-detection_start)
 
         if show_progress:
             if self.nb_received_tokens==0:
@@ -669,9 +699,9 @@ Date: {{date}}
             self.nb_received_tokens+=1
 
         
-        antiprompt = self.detect_antiprompt(bot_says)
         if antiprompt:
-            self.bot_says = self.remove_text_from_string(bot_says,antiprompt)
+            antiprompt, offset = antiprompt
+            self.bot_says = bot_says[:offset]
             ASCIIColors.warning(f"\nDetected hallucination with antiprompt: {antiprompt}")
             return False
         else:
@@ -700,17 +730,27 @@ Date: {{date}}
                                 ).strip()    
         return self.bot_says
 
-    def generate(self, prompt, max_size, temperature = None, top_k = None, top_p=None, repeat_penalty=None, repeat_last_n=None, callback=None, debug=False, show_progress=False ):
+    def generate(self, prompt, max_size, temperature = None, top_k = None, top_p=None, repeat_penalty=None, repeat_last_n=None, callback=None, debug=False, show_progress=False, cache=False ):
         ASCIIColors.info("Text generation started: Warming up")
         self.nb_received_tokens = 0
         self.bot_says = ""
         if debug:
             self.print_prompt("gen",prompt)
 
-        self.model.generate(
+        generate = self.model.generate
+        response_cache = getattr(self.app, "response_cache", None)
+        if response_cache is not None:
+            # Deterministic generations (or the ones explicitly flagged with cache, when the response cache is enabled) are served from the response cache
+            generate = partial(response_cache.generate, self.model.generate, force=cache, model_name=self.config.model_name, binding_name=self.config.binding_name, cancellation_token=self._current_cancellation_token())
+        process = partial(self.process, callback=callback, show_progress=show_progress)
+        timings = current_timings()
+        if timings is not None:
+            # Time to first token and decode speed of the request asking for timings
+            process = timings.track_decode(process)
+        generate(
                                 prompt, 
                                 max_size, 
-                                partial(self.process, callback=callback, show_progress=show_progress),
+                                process,
                                 temperature=self.model_temperature if temperature is None else temperature,
                                 top_k=self.model_top_k if top_k is None else top_k,
                                 top_p=self.model_top_p if top_p is None else top_p,
@@ -1005,8 +1045,9 @@ Date: {{date}}
                                 data_visualization_method=VisualizationMethod.PCA,
                                 database_dict=None)
                     data = GenericDataLoader.read_file(path)
-                    self.vectorizer.add_document(path, data, self.config.data_vectorization_chunk_size, self.config.data_vectorization_overlap_size)
-                    self.vectorizer.index()
+                    with tracer.span("vectorizer.add_document", document=str(path)):
+                        self.vectorizer.add_document(path, data, self.config.data_vectorization_chunk_size, self.config.data_vectorization_overlap_size)
+                    index_vectorizer(self.vectorizer, self.config.embedding_batch_size, getattr(self.app, "embedding_batcher", None))
                     if callback is not None:
                         callback("File added successfully",MSG_TYPE.MSG_TYPE_INFO)
                     self.HideBlockingMessage("Adding file to vector store.\nPlease stand by")
@@ -1598,10 +1639,13 @@ Date: {{date}}
         Returns:
             bool: True if any antiprompt is found in the text (ignoring case), False otherwise.
         """
-        for prompt in self.anti_prompts:
-            if prompt.lower() in text.lower():
-                return prompt.lower()
-        return None
+        match = self.antiprompt_detector.search(text)
+        return match[0] if match is not None else None
+
+    @property
+    def antiprompt_detector(self) -> AntipromptDetector:
+        """The compiled antiprompt matcher of this personality (shared, use `clone` before streaming into it)."""
+        return get_antiprompt_detector(tuple(self.anti_prompts))
 
     
     # Helper functions
@@ -1829,6 +1873,11 @@ class APScript(StateMachine):
     This class provides a basic structure and placeholder methods for processing model inputs and outputs.
     Personality-specific processor classes should inherit from this class and override the necessary methods.
     """
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # The workflows of the personalities are traced when tracing is enabled
+        trace_overrides(cls, {"run_workflow":"personality.run_workflow"})
+
     def __init__(
                     self, 
                     personality         :AIPersonality,
@@ -2009,8 +2058,8 @@ class APScript(StateMachine):
     def generate_with_images(self, prompt, images, max_size, temperature = None, top_k = None, top_p=None, repeat_penalty=None, repeat_last_n=None, callback=None, debug=False ):
         return self.personality.generate_with_images(prompt, images, max_size, temperature, top_k, top_p, repeat_penalty, repeat_last_n, callback, debug=debug)
 
-    def generate(self, prompt, max_size, temperature = None, top_k = None, top_p=None, repeat_penalty=None, repeat_last_n=None, callback=None, debug=False ):
-        return self.personality.generate(prompt, max_size, temperature, top_k, top_p, repeat_penalty, repeat_last_n, callback, debug=debug)
+    def generate(self, prompt, max_size, temperature = None, top_k = None, top_p=None, repeat_penalty=None, repeat_last_n=None, callback=None, debug=False, cache=False ):
+        return self.personality.generate(prompt, max_size, temperature, top_k, top_p, repeat_penalty, repeat_last_n, callback, debug=debug, cache=cache)
 
     def run_workflow(self, prompt:str, previous_discussion_text:str="", callback: Callable[[str, MSG_TYPE, dict, list], bool]=None, context_details:dict=None):
         """
@@ -2151,13 +2200,15 @@ class APScript(StateMachine):
                                     f"!@>Translation:",
                                     f"```markdown\n"
                                     ]),
-                                    max_generation_size=max_generation_size))
+                                    max_generation_size=max_generation_size, cache=True))
         return translated
     def summerize(self, chunks, summary_instruction="summerize", chunk_name="chunk", answer_start="", max_generation_size=3000):
         summeries = []
+        scheduler = getattr(self.personality.app, "scheduler", None)
+        fast_gen = partial(scheduler.run, self.fast_gen, lane=SchedulerLane.BACKGROUND) if scheduler is not None else self.fast_gen
         for i, chunk in enumerate(chunks):
             self.step_start(f"Processing chunk : {i+1}/{len(chunks)}")
-            summary = f"```markdown\n{answer_start}"+ self.fast_gen(
+            summary = f"```markdown\n{answer_start}"+ fast_gen(
                         "\n".join([
                             f"!@>Document_chunk: {chunk_name}:",
                             f"{chunk}",
@@ -2175,6 +2226,7 @@ class APScript(StateMachine):
         return "\n".join(summeries)
 
 
+    @timed_span("prompt_building")
     def build_prompt(self, prompt_parts:List[str], sacrifice_id:int=-1, context_size:int=None, minimum_spare_context_size:int=None):
         """
         Builds the prompt for code generation.
@@ -2199,14 +2251,14 @@ class APScript(StateMachine):
             part_tokens=[]
             nb_tokens=0
             for i,part in enumerate(prompt_parts):
-                tk = self.personality.model.tokenize(part)
+                tk = self.personality.model.tokenizer_cache.tokenize(part)
                 part_tokens.append(tk)
                 if i != sacrifice_id:
                     nb_tokens += len(tk)
             if len(part_tokens[sacrifice_id])>0:
                 sacrifice_tk = part_tokens[sacrifice_id]
                 sacrifice_tk= sacrifice_tk[-(context_size-nb_tokens-minimum_spare_context_size):]
-                sacrifice_text = self.personality.model.detokenize(sacrifice_tk)
+                sacrifice_text = self.personality.model.tokenizer_cache.detokenize(sacrifice_tk)
             else:
                 sacrifice_text = ""
             prompt_parts[sacrifice_id] = sacrifice_text
@@ -2517,7 +2569,7 @@ class APScript(StateMachine):
             str: The generated title.
         """        
         global_prompt = f"!@>instruction: Create a title for the following prompt:\n!@>prompt:{prompt}\n!@>title:"
-        title = self.fast_gen(global_prompt,max_title_length)
+        title = self.fast_gen(global_prompt,max_title_length, cache=True)
         return title
 
 
@@ -2573,8 +2625,8 @@ The AI should respond in this format using data from actions_list:
                 "request":request,
                 "actions_list":",\n".join([f"{action}" for action in actions_list])
                 }, 
-                self.personality.model.tokenize, 
-                self.personality.model.detokenize, 
+                self.personality.model.tokenizer_cache.tokenize, 
+                self.personality.model.tokenizer_cache.detokenize, 
                 self.personality.model.config.ctx_size,
                 ["previous_discussion"]
                 )
@@ -2636,8 +2688,8 @@ The AI should respond in this format using data from actions_list:
                 "request":request,
                 "actions_list":",\n".join([f"{action}" for action in actions_list])
                 }, 
-                self.personality.model.tokenize, 
-                self.personality.model.detokenize, 
+                self.personality.model.tokenizer_cache.tokenize, 
+                self.personality.model.tokenizer_cache.detokenize, 
                 self.personality.model.config.ctx_size,
                 ["previous_discussion"]
                 )
@@ -2788,7 +2840,7 @@ The AI should respond in this format using data from actions_list:
         elements += ["!@>answer:"]
         prompt = self.build_prompt(elements)
             
-        gen = self.generate(prompt, max_answer_length, temperature=0.1, top_k=50, top_p=0.9, repeat_penalty=1.0, repeat_last_n=50, callback=self.sink).strip().replace("</s>","").replace("<s>","")
+        gen = self.generate(prompt, max_answer_length, temperature=0.1, top_k=50, top_p=0.9, repeat_penalty=1.0, repeat_last_n=50, callback=self.sink, cache=True).strip().replace("</s>","").replace("<s>","")
         selection = gen.strip().split()[0].replace(",","").replace(".","")
         self.print_prompt("Multi choice selection",prompt+gen)
         try:
@@ -2830,7 +2882,7 @@ The AI should respond in this format using data from actions_list:
         elements += ["!@>answer:"]
         prompt = self.build_prompt(elements)
             
-        gen = self.generate(prompt, max_answer_length, temperature=0.1, top_k=50, top_p=0.9, repeat_penalty=1.0, repeat_last_n=50).strip().replace("</s>","").replace("<s>","")
+        gen = self.generate(prompt, max_answer_length, temperature=0.1, top_k=50, top_p=0.9, repeat_penalty=1.0, repeat_last_n=50, cache=True).strip().replace("</s>","").replace("<s>","")
         self.print_prompt("Multi choice ranking",prompt+gen)
         if gen.index("]")>=0:
             try:
@@ -2943,7 +2995,7 @@ The AI should respond in this format using data from actions_list:
         """
         return self.personality.fast_gen_with_images(prompt=prompt, images=images, max_generation_size=max_generation_size,placeholders=placeholders, sacrifice=sacrifice, debug=debug, callback=callback, show_progress=show_progress)
     
-    def fast_gen(self, prompt: str, max_generation_size: int= None, placeholders: dict = {}, sacrifice: list = ["previous_discussion"], debug: bool = False, callback=None, show_progress=False) -> str:
+    def fast_gen(self, prompt: str, max_generation_size: int= None, placeholders: dict = {}, sacrifice: list = ["previous_discussion"], debug: bool = False, callback=None, show_progress=False, cache: bool = False) -> str:
         """
         Fast way to generate code
         
@@ -2956,11 +3008,12 @@ The AI should respond in this format using data from actions_list:
         - placeholders (dict, optional): A dictionary of placeholders to be replaced in the prompt. Defaults to an empty dictionary.
         - sacrifice (list, optional): A list of placeholders to sacrifice if the window is bigger than the context size minus the number of tokens to generate. Defaults to ["previous_discussion"].
         - debug (bool, optional): Flag to enable/disable debug mode. Defaults to False.
+        - cache (bool, optional): If True, the output is served from the response cache (when enabled) even if the sampling is not deterministic. Defaults to False.
         
         Returns:
         - str: The generated text after removing special tokens ("<s>" and "</s>") and stripping any leading/trailing whitespace.
         """
-        return self.personality.fast_gen(prompt=prompt,max_generation_size=max_generation_size,placeholders=placeholders, sacrifice=sacrifice, debug=debug, callback=callback, show_progress=show_progress)
+        return self.personality.fast_gen(prompt=prompt,max_generation_size=max_generation_size,placeholders=placeholders, sacrifice=sacrifice, debug=debug, callback=callback, show_progress=show_progress, cache=cache)
     
 
     #Helper method to convert outputs path to url
@@ -0,0 +1,120 @@
+######
+# Project       : lollms
+# File          : prefix_cache.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Prompt prefix cache. Stores binding states (KV cache snapshots) keyed by the
+# hash of the token prefix that produced them, so that a new prompt sharing a
+# prefix with a previous one (personality conditioning, discussion history)
+# does not need to be prefilled again.
+######
+from collections import OrderedDict
+from typing import Any, Tuple
+import threading
+import hashlib
+
+
+class PrefixCacheEntry:
+    def __init__(self, nb_tokens:int, state:Any, size:int) -> None:
+        self.nb_tokens  = nb_tokens
+        self.state      = state
+        self.size       = size
+
+
+class PrefixCache:
+    """
+    LRU cache of binding states keyed by token prefix, bounded by a memory budget.
+
+    Args:
+        max_memory (int): Maximum total size of the stored states in bytes.
+    """
+    def __init__(self, max_memory:int) -> None:
+        self.max_memory     = max_memory
+        self.memory         = 0
+        self.hits           = 0
+        self.misses         = 0
+        self.reused_tokens  = 0
+
+        self._entries:OrderedDict[str, PrefixCacheEntry] = OrderedDict()
+        # number of tokens -> number of entries with that length (only these lengths are checked on lookup)
+        self._lengths       = {}
+        self._lock          = threading.Lock()
+
+    @staticmethod
+    def _prefix_digests(tokens:list, lengths:set) -> dict:
+        """Hashes the token list once and returns the digest of each requested prefix length."""
+        digests = {}
+        h = hashlib.sha1()
+        for i, token in enumerate(tokens):
+            h.update(repr(token).encode("utf-8"))
+            h.update(b"\x00")
+            if i+1 in lengths:
+                digests[i+1] = h.copy().hexdigest()
+        return digests
+
+    def lookup(self, tokens:list) -> Tuple[int, Any]:
+        """
+        Finds the longest cached prefix of the tokens.
+
+        Returns:
+            Tuple[int, Any]: The number of tokens covered by the cached state and the state itself ((0, None) on a miss)
+        """
+        with self._lock:
+            lengths = {length for length in self._lengths if length<=len(tokens)}
+        digests = self._prefix_digests(tokens, lengths)
+        with self._lock:
+            for length in sorted(digests.keys(), reverse=True):
+                entry = self._entries.get(digests[length])
+                if entry is not None:
+                    self._entries.move_to_end(digests[length])
+                    self.hits += 1
+                    self.reused_tokens += entry.nb_tokens
+                    return entry.nb_tokens, entry.state
+            self.misses += 1
+        return 0, None
+
+    def store(self, tokens:list, state:Any, size:int):
+        """
+        Stores the state obtained after processing the tokens.
+
+        Args:
+            tokens (list): The token prefix that produced the state
+            state (Any): The binding state (as returned by LLMBinding.save_state)
+            size (int): The size of the state in bytes
+        """
+        if size>self.max_memory or len(tokens)==0:
+            return
+        key = self._prefix_digests(tokens, {len(tokens)})[len(tokens)]
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = PrefixCacheEntry(len(tokens), state, size)
+            self._lengths[len(tokens)] = self._lengths.get(len(tokens), 0) + 1
+            self.memory += size
+            while self.memory>self.max_memory:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._lengths.clear()
+            self.memory = 0
+
+    def _remove(self, key:str):
+        entry = self._entries.pop(key)
+        self.memory -= entry.size
+        self._lengths[entry.nb_tokens] -= 1
+        if self._lengths[entry.nb_tokens]==0:
+            del self._lengths[entry.nb_tokens]
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "memory": self.memory,
+                "max_memory": self.max_memory,
+                "hits": self.hits,
+                "misses": self.misses,
+                "reused_tokens": self.reused_tokens,
+            }
@@ -0,0 +1,194 @@
+######
+# Project       : lollms
+# File          : response_cache.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Exact match response cache. Deterministic generations (temperature 0 or a
+# fixed seed) and helpers that explicitly ask for it are answered from the
+# cache. Cached answers are replayed chunk by chunk through the callback so
+# streaming clients can't tell the difference.
+######
+from ascii_colors import ASCIIColors
+from lollms.types import MSG_TYPE
+from lollms.utilities import trace_exception
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, List
+import threading
+import hashlib
+import json
+import time
+
+
+class ResponseCache:
+    """
+    LRU + TTL cache of generated outputs keyed on (model, binding, prompt, sampling parameters, seed).
+
+    Args:
+        max_entries (int): Maximum number of responses kept in memory.
+        ttl (float): Time to live of an entry in seconds (0 means no expiry).
+        disk_path (Path, optional): If set, responses are also saved to this folder and survive restarts.
+    """
+    def __init__(self, max_entries:int=1000, ttl:float=3600, disk_path:Path=None) -> None:
+        self.max_entries    = max_entries
+        self.ttl            = ttl
+        self.disk_path      = Path(disk_path) if disk_path is not None else None
+        if self.disk_path is not None:
+            self.disk_path.mkdir(parents=True, exist_ok=True)
+
+        self.hits           = 0
+        self.misses         = 0
+
+        self._entries:OrderedDict = OrderedDict()
+        self._lock          = threading.Lock()
+
+    @staticmethod
+    def is_deterministic(gpt_params:dict) -> bool:
+        """Returns True if the sampling parameters always give the same output for the same prompt."""
+        temperature = gpt_params.get("temperature")
+        seed = gpt_params.get("seed")
+        return temperature==0 or (seed is not None and seed!=-1)
+
+    @staticmethod
+    def make_key(model_name:str, binding_name:str, prompt:str, n_predict:int, gpt_params:dict) -> str:
+        description = json.dumps({
+            "model": model_name,
+            "binding": binding_name,
+            "prompt": prompt,
+            "n_predict": n_predict,
+            "parameters": gpt_params
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+    def get(self, key:str) -> List[str]:
+        """Returns the cached chunks of a response or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self.ttl>0 and now-entry["created"]>self.ttl:
+                    del self._entries[key]
+                else:
+                    self._entries.move_to_end(key)
+                    return entry["chunks"]
+
+        entry = self._load_from_disk(key)
+        if entry is None:
+            return None
+        if self.ttl>0 and now-entry["created"]>self.ttl:
+            self._remove_from_disk(key)
+            return None
+        with self._lock:
+            self._store(key, entry)
+        return entry["chunks"]
+
+    def put(self, key:str, chunks:List[str]):
+        entry = {"created": time.time(), "chunks": chunks}
+        with self._lock:
+            self._store(key, entry)
+        if self.disk_path is not None:
+            try:
+                with open(self.disk_path/f"{key}.json", "w", encoding="utf-8") as f:
+                    json.dump(entry, f)
+            except Exception as ex:
+                trace_exception(ex)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.disk_path is not None:
+            for file in self.disk_path.glob("*.json"):
+                file.unlink()
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits/(self.hits+self.misses) if self.hits+self.misses>0 else 0,
+            }
+
+    def generate(
+                    self,
+                    generate_fn:Callable,
+                    prompt:str,
+                    n_predict:int=128,
+                    callback:Callable[[str, MSG_TYPE], bool]=None,
+                    force:bool=False,
+                    model_name:str="",
+                    binding_name:str="",
+                    cancellation_token=None,
+                    **gpt_params
+                ) -> str:
+        """
+        Runs generate_fn(prompt, n_predict, callback=..., **gpt_params) through the cache.
+
+        Only deterministic generations are cached unless force is True. Outputs of
+        canceled requests (see scheduler.CancellationToken) and of generations stopped
+        by the callback (disconnected client, stop sequence...) are never stored.
+        """
+        if not force and not self.is_deterministic(gpt_params):
+            return generate_fn(prompt, n_predict, callback=callback, **gpt_params)
+
+        key = self.make_key(model_name, binding_name, prompt, n_predict, gpt_params)
+        chunks = self.get(key)
+        if chunks is not None:
+            with self._lock:
+                self.hits += 1
+            ASCIIColors.info("Response cache hit")
+            # Replay the cached output exactly like the binding would have streamed it
+            output = ""
+            for chunk in chunks:
+                output += chunk
+                if callback is not None and callback(chunk, MSG_TYPE.MSG_TYPE_CHUNK) is False:
+                    break
+            return output
+
+        with self._lock:
+            self.misses += 1
+        received = []
+        stopped = False
+        def recording_callback(chunk, message_type:MSG_TYPE=MSG_TYPE.MSG_TYPE_CHUNK, *args, **kwargs):
+            nonlocal stopped
+            if chunk is not None and message_type==MSG_TYPE.MSG_TYPE_CHUNK:
+                received.append(chunk)
+            if callback is not None and callback(chunk, message_type, *args, **kwargs) is False:
+                stopped = True
+                return False
+            return True
+        output = generate_fn(prompt, n_predict, callback=recording_callback, **gpt_params)
+        if stopped or (cancellation_token is not None and cancellation_token.canceled):
+            # The output is truncated
+            return output
+        if len(received)==0 and output:
+            received.append(output)
+        self.put(key, received)
+        return output
+
+    def _store(self, key:str, entry:dict):
+        """Lock must be held."""
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries)>self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load_from_disk(self, key:str) -> dict:
+        if self.disk_path is None:
+            return None
+        file = self.disk_path/f"{key}.json"
+        if not file.exists():
+            return None
+        try:
+            with open(file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as ex:
+            trace_exception(ex)
+            return None
+
+    def _remove_from_disk(self, key:str):
+        try:
+            (self.disk_path/f"{key}.json").unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,483 @@
+######
+# Project       : lollms
+# File          : scheduler.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Generation scheduler. Every generation request is queued here instead of
+# being rejected when the binding is busy.
+######
+from lollms.utilities import trace_exception
+from lollms.metrics import metrics
+from concurrent.futures import Future
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+from enum import Enum
+import threading
+import asyncio
+import time
+import uuid
+
+
+class SchedulerLane(Enum):
+    """Scheduler lanes."""
+
+    INTERACTIVE = 0
+    """Chat and API requests. Always served first."""
+
+    BACKGROUND = 1
+    """Background work (discussion summaries, vectorization...). Served when no interactive work is waiting."""
+
+
+class CancellationToken:
+    """
+    Cooperative cancellation flag of a request.
+
+    The token is checked between generated chunks (see LollmsApplication.generate_text
+    and AIPersonality.process), so canceling a request stops it at the next token
+    boundary without touching the other requests or leaving the binding half way.
+    """
+    def __init__(self) -> None:
+        self._event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason:str=None):
+        self.reason = reason
+        self._event.set()
+
+    @property
+    def canceled(self) -> bool:
+        return self._event.is_set()
+
+
+class GenerationJob:
+    """A unit of work queued in the scheduler."""
+    def __init__(
+                    self,
+                    fn:Callable,
+                    args:tuple=(),
+                    kwargs:dict=None,
+                    client_id=None,
+                    lane:SchedulerLane=SchedulerLane.INTERACTIVE,
+                    priority:int=0,
+                    on_position:Callable[["GenerationJob", int], None]=None,
+                    job_id:str=None,
+                    cancellation_token:CancellationToken=None,
+                    on_cancel:Callable[[], None]=None
+                ) -> None:
+        self.id             = job_id if job_id is not None else str(uuid.uuid4())
+        self.cancellation_token = cancellation_token if cancellation_token is not None else CancellationToken()
+        self.fn             = fn
+        self.args           = args
+        self.kwargs         = kwargs if kwargs is not None else {}
+        self.client_id      = client_id
+        self.lane           = lane
+        self.priority       = priority
+        self.on_position    = on_position
+        self.future         = Future()
+        if on_cancel is not None:
+            # fn never runs when the job is canceled before it starts, on_cancel does its cleanup
+            self.future.add_done_callback(lambda future: on_cancel() if future.cancelled() else None)
+        self.position       = -1
+        self.submitted_at   = time.time()
+        self.started_at     = None
+        self.finished_at    = None
+        self.thread         = None
+
+    @property
+    def wait_time(self):
+        """Time spent in the queue (in seconds)."""
+        end = self.started_at if self.started_at is not None else time.time()
+        return end - self.submitted_at
+
+    def result(self, timeout=None):
+        """Blocks until the job is done and returns its result."""
+        return self.future.result(timeout)
+
+
+class GenerationWorkerPool:
+    """
+    Bounded set of named threads running the generation jobs.
+
+    Workers are started on demand up to `max_workers` and then reused, so the thread
+    local state of the bindings survives between jobs. When all the workers are busy,
+    the jobs wait in a FIFO queue.
+
+    Args:
+        max_workers (int): Maximum number of threads.
+        name_prefix (str): Prefix of the thread names.
+    """
+    def __init__(self, max_workers:int=4, name_prefix:str="lollms-generation-worker") -> None:
+        self.max_workers    = max(1, max_workers)
+        self.name_prefix    = name_prefix
+
+        self._lock          = threading.Condition()
+        self._tasks         = deque()
+        self._workers:List[threading.Thread] = []
+        self._nb_idle       = 0
+        self._nb_active     = 0
+        self._nb_started    = 0
+
+    def set_max_workers(self, max_workers:int):
+        """Changes the size of the pool. Extra workers stop once their current job is done."""
+        with self._lock:
+            self.max_workers = max(1, max_workers)
+            self._start_workers()
+            self._lock.notify_all()
+
+    def submit(self, fn:Callable, *args):
+        """Queues fn(*args) for the next free worker."""
+        with self._lock:
+            self._tasks.append((fn, args))
+            self._start_workers()
+            self._lock.notify()
+
+    def _start_workers(self):
+        # Lock must be held
+        while len(self._tasks)>self._nb_idle and len(self._workers)<self.max_workers:
+            self._nb_started += 1
+            worker = threading.Thread(target=self._worker_loop, name=f"{self.name_prefix}-{self._nb_started}", daemon=True)
+            self._workers.append(worker)
+            self._nb_idle += 1
+            worker.start()
+
+    def _worker_loop(self):
+        worker = threading.current_thread()
+        while True:
+            with self._lock:
+                while len(self._tasks)==0 and len(self._workers)<=self.max_workers:
+                    self._lock.wait()
+                if len(self._workers)>self.max_workers:
+                    self._workers.remove(worker)
+                    self._nb_idle -= 1
+                    return
+                fn, args = self._tasks.popleft()
+                self._nb_idle -= 1
+                self._nb_active += 1
+            try:
+                fn(*args)
+            except Exception as ex:
+                trace_exception(ex)
+            finally:
+                with self._lock:
+                    self._nb_active -= 1
+                    self._nb_idle += 1
+
+    @property
+    def active(self) -> int:
+        with self._lock:
+            return self._nb_active
+
+    @property
+    def waiting(self) -> int:
+        with self._lock:
+            return len(self._tasks)
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                "workers": len(self._workers),
+                "max_workers": self.max_workers,
+                "active": self._nb_active,
+                "waiting": len(self._tasks),
+            }
+
+
+class GenerationScheduler:
+    """
+    Queues generation jobs and runs at most `max_concurrent_generations` of them at once.
+
+    Jobs are split in two lanes (interactive and background). Inside a lane, higher
+    priority jobs go first and clients are served round robin so a single client
+    can't starve the others. The jobs are executed by a pool of at least `max_workers`
+    threads, grown to `max_concurrent_generations` so a dispatched job never waits
+    for a worker behind the lanes and priorities.
+    """
+    def __init__(self, max_concurrent_generations:int=1, on_position:Callable[[GenerationJob, int], None]=None, max_workers:int=4) -> None:
+        self.max_concurrent_generations = max(1, max_concurrent_generations)
+        self.on_position                = on_position
+        self.min_workers                = max(1, max_workers)
+        self.workers                    = GenerationWorkerPool(max(self.min_workers, self.max_concurrent_generations))
+
+        self._lock                      = threading.Condition()
+        # lane -> client_id -> deque of jobs
+        self._queues:Dict[SchedulerLane, OrderedDict] = {lane:OrderedDict() for lane in SchedulerLane}
+        self._running:Dict[str, GenerationJob] = {}
+        # Slots taken by the parallel branches of running jobs (see reserve_slots)
+        self._reserved                  = 0
+        self._local                     = threading.local()
+
+        self._nb_processed              = 0
+        self._total_wait_time           = 0.0
+        self._max_wait_time             = 0.0
+
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="lollms-scheduler", daemon=True)
+        self._dispatcher.start()
+
+    # ----------------------------------- Public API -----------------------------------
+    def set_concurrency(self, max_concurrent_generations:int):
+        with self._lock:
+            self.max_concurrent_generations = max(1, max_concurrent_generations)
+            # Every job allowed to run gets a worker
+            self.workers.set_max_workers(max(self.min_workers, self.max_concurrent_generations))
+            self._lock.notify_all()
+
+    def submit(
+                self,
+                fn:Callable,
+                *args,
+                client_id=None,
+                lane:SchedulerLane=SchedulerLane.INTERACTIVE,
+                priority:int=0,
+                on_position:Callable[[GenerationJob, int], None]=None,
+                job_id:str=None,
+                cancellation_token:CancellationToken=None,
+                on_cancel:Callable[[], None]=None,
+                **kwargs
+            ) -> GenerationJob:
+        """
+        Queues a job and returns it immediately.
+
+        on_cancel is called instead of fn when the job is canceled before it starts (to
+        close a stream or release resources taken for the job).
+
+        If the calling thread is already running a scheduler job (a workflow that calls
+        the model again for example), the job is executed inline to avoid deadlocks and
+        shares the cancellation token of the running job.
+        """
+        current_job = self.current_job()
+        if current_job is not None and cancellation_token is None:
+            cancellation_token = current_job.cancellation_token
+        job = GenerationJob(fn, args, kwargs, client_id, lane, priority, on_position, job_id, cancellation_token, on_cancel)
+        if current_job is not None:
+            self._execute(job)
+            return job
+
+        with self._lock:
+            queue = self._queues[lane].setdefault(client_id, deque())
+            queue.append(job)
+            self._lock.notify_all()
+        self._notify_positions()
+        return job
+
+    def run(self, fn:Callable, *args, **kwargs):
+        """Queues a job and blocks until its result is available."""
+        return self.submit(fn, *args, **kwargs).result()
+
+    async def run_async(self, fn:Callable, *args, **kwargs):
+        """
+        Queues a job and awaits its result without blocking the event loop.
+
+        Raises RuntimeError when the job is canceled before it starts (the asyncio
+        CancelledError is kept for the cancellation of the awaiting task itself, which
+        cancels the job: nobody waits for its result anymore).
+        """
+        job = self.submit(fn, *args, **kwargs)
+        try:
+            return await asyncio.wrap_future(job.future)
+        except asyncio.CancelledError:
+            # The scheduler sets the token, a canceled awaiting task doesn't
+            if job.future.cancelled() and job.cancellation_token.canceled:
+                raise RuntimeError(f"Generation {job.id} was canceled") from None
+            self.cancel(job.id, "awaiting task canceled")
+            raise
+
+    def cancel(self, job_id:str, reason:str=None) -> bool:
+        """
+        Cancels a job. A waiting job is removed from the queue, a running one has its
+        cancellation token set and stops at the next generated chunk.
+
+        Returns:
+            bool: False if no waiting or running job has this id.
+        """
+        with self._lock:
+            job = self._remove_queued(job_id)
+            if job is None:
+                job = self._running.get(job_id)
+                if job is None:
+                    return False
+                if not job.cancellation_token.canceled:
+                    metrics.inc("lollms_cancellations_total", reason=reason or "unknown", state="running")
+                job.cancellation_token.cancel(reason)
+                return True
+            metrics.inc("lollms_cancellations_total", reason=reason or "unknown", state="queued")
+            job.cancellation_token.cancel(reason)
+            job.future.cancel()
+            self._lock.notify_all()
+        self._notify_positions()
+        return True
+
+    def cancel_client(self, client_id, reason:str=None) -> int:
+        """Cancels all the waiting and running jobs of a client and returns their number."""
+        with self._lock:
+            job_ids = [job.id for job in self._running.values() if job.client_id==client_id]
+            job_ids += [job.id for lane_queues in self._queues.values() for job in lane_queues.get(client_id, [])]
+        return sum(1 for job_id in job_ids if self.cancel(job_id, reason))
+
+    @contextmanager
+    def reserve_slots(self, wanted:int):
+        """
+        Takes up to `wanted` free generation slots for work that the current job runs in
+        parallel (the choices of an n>1 request for example). The reserved slots count as
+        running jobs until the block exits.
+
+        Yields:
+            int: The number of reserved slots (0 when the other jobs use all of them).
+        """
+        with self._lock:
+            nb_slots = max(0, min(wanted, self.max_concurrent_generations-len(self._running)-self._reserved))
+            self._reserved += nb_slots
+        try:
+            yield nb_slots
+        finally:
+            with self._lock:
+                self._reserved -= nb_slots
+                self._lock.notify_all()
+
+    def current_job(self) -> GenerationJob:
+        """Returns the job executed by the current thread (or None)."""
+        return getattr(self._local, "job", None)
+
+    def current_cancellation_token(self) -> CancellationToken:
+        """Returns the cancellation token of the job executed by the current thread (or None)."""
+        job = getattr(self._local, "job", None)
+        return job.cancellation_token if job is not None else None
+
+    @property
+    def queue_depth(self) -> int:
+        with self._lock:
+            return sum(len(q) for lane_queues in self._queues.values() for q in lane_queues.values())
+
+    @property
+    def busy(self) -> bool:
+        with self._lock:
+            return len(self._running)>0
+
+    def get_status(self) -> dict:
+        """Returns the scheduler state (queue depths and wait times)."""
+        now = time.time()
+        with self._lock:
+            waiting = [job for lane_queues in self._queues.values() for q in lane_queues.values() for job in q]
+            return {
+                "busy": len(self._running)>0,
+                "running": len(self._running),
+                "reserved_slots": self._reserved,
+                "max_concurrent_generations": self.max_concurrent_generations,
+                "queue_depth": len(waiting),
+                "lanes": {
+                    lane.name.lower():sum(len(q) for q in self._queues[lane].values()) for lane in SchedulerLane
+                },
+                "oldest_wait_time": max([now-job.submitted_at for job in waiting], default=0),
+                "average_wait_time": self._total_wait_time/self._nb_processed if self._nb_processed>0 else 0,
+                "max_wait_time": self._max_wait_time,
+                "processed": self._nb_processed,
+                "workers": self.workers.get_status(),
+            }
+
+    # ----------------------------------- Internals -----------------------------------
+    def _ordered_jobs(self) -> List[GenerationJob]:
+        """Returns the waiting jobs in the order they will be served (lock must be held)."""
+        ordered = []
+        for lane in SchedulerLane:
+            # Copy the per client queues and simulate the round robin
+            queues = OrderedDict((client_id, deque(q)) for client_id, q in self._queues[lane].items() if len(q)>0)
+            while len(queues)>0:
+                client_id = max(queues.keys(), key=lambda c: queues[c][0].priority)
+                ordered.append(queues[client_id].popleft())
+                if len(queues[client_id])==0:
+                    del queues[client_id]
+                else:
+                    queues.move_to_end(client_id)
+        return ordered
+
+    def _remove_queued(self, job_id:str) -> GenerationJob:
+        """Removes a waiting job from its queue (lock must be held)."""
+        for lane_queues in self._queues.values():
+            for client_id, queue in lane_queues.items():
+                for job in queue:
+                    if job.id == job_id:
+                        queue.remove(job)
+                        if len(queue)==0:
+                            del lane_queues[client_id]
+                        return job
+        return None
+
+    def _pop_next(self) -> GenerationJob:
+        """Pops the next job to serve (lock must be held)."""
+        for lane in SchedulerLane:
+            lane_queues = self._queues[lane]
+            if len(lane_queues)==0:
+                continue
+            # Highest priority head first, ties go to the client that waited the longest
+            client_id = max(lane_queues.keys(), key=lambda c: lane_queues[c][0].priority)
+            job = lane_queues[client_id].popleft()
+            if len(lane_queues[client_id])==0:
+                del lane_queues[client_id]
+            else:
+                lane_queues.move_to_end(client_id)
+            return job
+        return None
+
+    def _notify_positions(self):
+        # The positions are updated under the lock, the callbacks (socket.io emits) are called outside of it
+        moved = []
+        with self._lock:
+            for position, job in enumerate(self._ordered_jobs()):
+                if job.position != position:
+                    job.position = position
+                    moved.append((job, position))
+        for job, position in moved:
+            callback = job.on_position or self.on_position
+            if callback is not None:
+                try:
+                    callback(job, position)
+                except Exception as ex:
+                    trace_exception(ex)
+
+    def _dispatch_loop(self):
+        while True:
+            with self._lock:
+                while len(self._running)+self._reserved>=self.max_concurrent_generations or self._pop_candidate_count()==0:
+                    self._lock.wait()
+                job = self._pop_next()
+                self._running[job.id] = job
+            self._notify_positions()
+            self.workers.submit(self._run_job, job)
+
+    def _pop_candidate_count(self):
+        return sum(len(lane_queues) for lane_queues in self._queues.values())
+
+    def _run_job(self, job:GenerationJob):
+        try:
+            self._execute(job)
+        finally:
+            with self._lock:
+                del self._running[job.id]
+                self._lock.notify_all()
+
+    def _execute(self, job:GenerationJob):
+        if job.cancellation_token.canceled:
+            # Canceled while waiting for a free worker
+            job.future.cancel()
+        if not job.future.set_running_or_notify_cancel():
+            return
+        job.started_at = time.time()
+        job.thread = threading.current_thread()
+        wait_time = job.wait_time
+        with self._lock:
+            self._nb_processed += 1
+            self._total_wait_time += wait_time
+            self._max_wait_time = max(self._max_wait_time, wait_time)
+        previous_job = self.current_job()
+        self._local.job = job
+        try:
+            job.future.set_result(job.fn(*job.args, **job.kwargs))
+        except BaseException as ex:
+            if not isinstance(ex, SystemExit):
+                trace_exception(ex)
+                metrics.inc("lollms_errors_total", source="scheduler")
+            job.future.set_exception(ex)
+        finally:
+            self._local.job = previous_job
+            job.finished_at = time.time()
@@ -17,6 +17,7 @@ from ascii_colors import ASCIIColors
 import socketio
 import uvicorn
 import argparse
+import asyncio
 from socketio import ASGIApp
 
 
@@ -31,6 +32,9 @@ def main():
         "--host", type=str, default=None, help="the hostname to listen on"
     )
     parser.add_argument("--port", type=int, default=None, help="the port to listen on")
+    parser.add_argument("--binding_name", type=str, default=None, help="the binding to use instead of the configured one (a binding name or a binding folder path)")
+    parser.add_argument("--model_name", type=str, default=None, help="the model to use instead of the configured one")
+    parser.add_argument("--binding_workers", type=int, default=None, help="the number of worker processes hosting the binding (0 runs the binding in the server process)")
 
     args = parser.parse_args()
     root_path = Path(__file__).parent
@@ -40,8 +44,14 @@ def main():
         config.host=args.host
     if args.port:
         config.port=args.port
-
-    LOLLMSElfServer.build_instance(config=config, lollms_paths=lollms_paths, socketio=sio)
+    if args.binding_name:
+        config.binding_name=args.binding_name
+    if args.model_name:
+        config.model_name=args.model_name
+    if args.binding_workers is not None:
+        config.binding_workers=args.binding_workers
+
+    LOLLMSElfServer.build_instance(config=config, lollms_paths=lollms_paths, sio=sio)
     from lollms.server.endpoints.lollms_binding_files_server import router as lollms_binding_files_server_router
     from lollms.server.endpoints.lollms_infos import router as lollms_infos_router
     from lollms.server.endpoints.lollms_hardware_infos import router as lollms_hardware_infos_router
@@ -55,6 +65,7 @@ def main():
 
     
     from lollms.server.endpoints.lollms_generator import router as lollms_generator_router
+    from lollms.server.endpoints.lollms_metrics import router as lollms_metrics_router
     
 
     from lollms.server.events.lollms_generation_events import add_events as lollms_generation_events_add
@@ -73,20 +84,26 @@ def main():
     
     
     app.include_router(lollms_generator_router)
+    app.include_router(lollms_metrics_router)
 
     app.include_router(lollms_configuration_infos_router)
     
 
 
+    @app.on_event("startup")
+    async def attach_emit_bridge():
+        # The generation threads hand their emits to this loop
+        LOLLMSElfServer.get_instance().emit_bridge.attach(asyncio.get_running_loop())
+
     lollms_generation_events_add(sio)
     lollms_personality_events_add(sio)
     lollms_model_events_add(sio)
     lollms_rag_events_add(sio)
 
-    app = ASGIApp(socketio_server=sio, other_asgi_app=app)
+    asgi_app = ASGIApp(socketio_server=sio, other_asgi_app=app)
 
 
-    uvicorn.run(app, host=config.host, port=config.port)
+    uvicorn.run(asgi_app, host=config.host, port=config.port)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -13,7 +13,9 @@ from lollms.personality import AIPersonality
 from pathlib import Path
 from socketio import AsyncServer
 from functools import partial
-from lollms.utilities import trace_exception, run_async
+from lollms.utilities import trace_exception
+from lollms.emit_bridge import EmitBridge
+from lollms.discussion_window import DiscussionWindow
 
 from datetime import datetime
 class LOLLMSElfServer(LollmsApplication):
@@ -38,8 +40,6 @@ class LOLLMSElfServer(LollmsApplication):
                 lollms_paths,
                 load_binding=load_binding,
                 load_model=load_model,
-                load_sd_service=load_sd_service,
-                load_voice_service=load_voice_service,
                 try_select_binding=try_select_binding,
                 try_select_model=try_select_model,
                 callback=callback,
@@ -76,6 +76,15 @@ class LOLLMSElfServer(LollmsApplication):
             raise Exception("This class is a singleton!")
         else:
             LOLLMSElfServer.__instance = self
+        # Emits from the generation threads go through the event loop of the server (text chunks are merged into frames)
+        self.emit_bridge = EmitBridge(
+                                        sio,
+                                        self.config.emit_flush_interval/1000,
+                                        self.config.emit_max_frame_size,
+                                        self.config.emit_max_pending_frames
+                                    )
+        if not hasattr(self, "connections"):
+            self.connections = {}
 
     # Other methods and properties of the LoLLMSWebUI singleton class
     def find_extension(self, path:Path, filename:str, exts:list)->Path:
@@ -94,6 +103,39 @@ class LOLLMSElfServer(LollmsApplication):
         self.nb_received_tokens = 0
         self.start_time = datetime.now()
 
+    def get_discussion_window(self, client_id, binding) -> DiscussionWindow:
+        """
+        Returns the discussion of a socket.io session (created on its first generation).
+
+        Args:
+            client_id: The session.
+            binding (LLMBinding): The model that tokenizes the messages.
+
+        Returns:
+            DiscussionWindow: The messages of the session with their tokens.
+        """
+        connection = self.connections.setdefault(client_id, {})
+        window = connection.get("discussion_window")
+        if window is None:
+            window = connection["discussion_window"] = DiscussionWindow(binding, self.config.discussion_window_max_tokens)
+        else:
+            window.set_binding(binding)
+        return window
+
+    def evict_idle_connections(self):
+        """
+        Evicts the discussions that were not used for discussion_window_idle_timeout seconds.
+        The whole connection is removed when its client is disconnected.
+        """
+        for client_id, connection in list(self.connections.items()):
+            window = connection.get("discussion_window")
+            if window is None or connection.get("is_generating") or window.idle_time()<self.config.discussion_window_idle_timeout:
+                continue
+            if self.sio is not None and self.sio.manager.is_connected(client_id, "/"):
+                del connection["discussion_window"]
+            else:
+                self.connections.pop(client_id, None)
+
     def notify_model_install(self, 
                             installation_path,
                             model_name,
@@ -108,7 +150,7 @@ class LOLLMSElfServer(LollmsApplication):
                             status=True,
                             error="",
                              ):
-        run_async( partial(self.sio.emit,'install_progress',{
+        self.emit_bridge.emit('install_progress',{
                                             'status': status,
                                             'error': error,
                                             'model_name' : model_name,
@@ -121,4 +163,14 @@ class LOLLMSElfServer(LollmsApplication):
                                             'speed': speed,
                                         }, room=client_id
                     )
-        )
+
+    def notify_queue_position(self, job, position:int):
+        if job.client_id is None or self.sio is None or job.client_id not in getattr(self, "connections", {}):
+            return
+        self.emit_bridge.emit('queue_position',{
+                                            'job_id': job.id,
+                                            'position': position,
+                                            'queue_depth': self.scheduler.queue_depth,
+                                            'wait_time': job.wait_time,
+                                        }, room=job.client_id
+                    )
@@ -88,6 +88,11 @@ async def update_setting(request: Request):
 
         elif setting_name == "model_name":
             ASCIIColors.yellow(f"Changing model to: {setting_value}")
+            if lollmsElfServer.model_pool is not None:
+                # The model is loaded in the background, the current one keeps serving until it is ready
+                future = lollmsElfServer.select_model(setting_value)
+                future.add_done_callback(lambda f: lollmsElfServer.config.save_config() if f.exception() is None else None)
+                return {'setting_name': setting_name, "status":True, "loading":not future.done()}
             lollmsElfServer.config["model_name"]=setting_value
             lollmsElfServer.config.save_config()
             try:
@@ -10,20 +10,25 @@ description:
 
 from fastapi import APIRouter, Request, Body, Response
 from lollms.server.elf_server import LOLLMSElfServer
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from starlette.responses import StreamingResponse
 from lollms.types import MSG_TYPE
 from lollms.utilities import detect_antiprompt, remove_text_from_string, trace_exception
-from lollms.generation import RECPTION_MANAGER, ROLE_CHANGE_DECISION, ROLE_CHANGE_OURTPUT
+from lollms.generation import RECPTION_MANAGER, ROLE_CHANGE_DECISION, ROLE_CHANGE_OURTPUT, STREAM_BRIDGE, OPENAI_SSE_ENCODER, TOKEN_USAGE, GENERATION_TIMINGS, track_timings
+from lollms.metrics import metrics
+from lollms.tracing import tracer
+from lollms.binding_workers import BindingWorkersModel
 from ascii_colors import ASCIIColors
 import time
-import threading
 from typing import List, Optional, Union
 import random
 import string
 import json
 from enum import Enum
 import asyncio
+import uuid
+import base64
+import numpy as np
 
 
 def _generate_id(length=10):
@@ -31,6 +36,139 @@ def _generate_id(length=10):
     random_id = ''.join(random.choice(letters_and_digits) for _ in range(length))
     return random_id
 
+CLIENT_ID_HEADER = "X-Client-Id"
+# Maximum number of choices (n and best_of) of a request
+MAX_CHOICES = 16
+
+def _client_key(request:Request):
+    """Identifies the HTTP client so that the scheduler can share the binding fairly between clients.
+
+    Clients identify themselves with the X-Client-Id header (clients behind the same address,
+    proxy or NAT are told apart). Without it, the clients are identified by their address.
+    """
+    client_id = request.headers.get(CLIENT_ID_HEADER)
+    if client_id:
+        return f"http:{client_id}"
+    return f"http:{request.client.host if request.client is not None else 'unknown'}"
+
+def _routed(model_name:str) -> bool:
+    """True if the request asks for another model than the active one and the model pool can serve it."""
+    return getattr(elf_server, "model_pool", None) is not None and bool(model_name) and model_name!=elf_server.config.model_name
+
+async def _acquire_model(model_name:str):
+    """Returns the model pool entry of the requested model, or None to use the active model.
+
+    Every returned entry must be given back with `elf_server.model_pool.release(entry)`.
+    """
+    if not _routed(model_name):
+        return None
+    try:
+        return await elf_server.model_pool.acquire_async(model_name)
+    except Exception as ex:
+        ASCIIColors.warning(f"Couldn't route the request to {model_name}, using {elf_server.config.model_name} instead ({ex})")
+        return None
+
+def _use_model(model_name:str):
+    """Same as _acquire_model from a generation job: the model is only taken once the job runs."""
+    if not _routed(model_name):
+        return None
+    try:
+        return elf_server.model_pool.acquire(model_name)
+    except Exception as ex:
+        ASCIIColors.warning(f"Couldn't route the request to {model_name}, using {elf_server.config.model_name} instead ({ex})")
+        return None
+
+def _count_prompt_tokens(choices:list, binding, prompt:str, timings:GENERATION_TIMINGS=None):
+    """Sets the prompt tokens of the choices (called from the generation job once the model is known)."""
+    with track_timings(timings):
+        prompt_tokens = len(binding.tokenizer_cache.tokenize(prompt))
+    for choice in choices:
+        choice.usage.prompt_tokens = prompt_tokens
+
+class _GenerationChoice:
+    """Reception state of one choice of a request (requests with n>1 generate several choices in parallel).
+
+    When a bridge is given, the emittable text is sent to it as (index, text) tuples and
+    (index, None) marks the end of the choice. The generated tokens are counted in `usage`
+    by the generation pipeline and, when `timings` is given, the stop sequence detection
+    is recorded in it.
+    """
+    def __init__(self, index:int, n_predict:int, stop_sequences:list=None, bridge:STREAM_BRIDGE=None, prompt_tokens:int=0, timings:GENERATION_TIMINGS=None) -> None:
+        self.index              = index
+        self.n_predict          = n_predict
+        self.reception_manager  = RECPTION_MANAGER(stop_sequences)
+        self.bridge             = bridge
+        self.usage              = TOKEN_USAGE(prompt_tokens)
+        self.timings            = timings
+
+    @property
+    def text(self) -> str:
+        return self.reception_manager.reception_buffer
+
+    @property
+    def finish_reason(self) -> str:
+        return "length" if self.reception_manager.stop_sequence is None and self.usage.completion_tokens>=self.n_predict else "stop"
+
+    def callback(self, chunk, chunk_type:MSG_TYPE=MSG_TYPE.MSG_TYPE_CHUNK):
+        if chunk is None:
+            return True
+
+        if self.timings is not None:
+            with self.timings.span("stop_processing"):
+                rx = self.reception_manager.new_chunk(chunk)
+        else:
+            rx = self.reception_manager.new_chunk(chunk)
+        if self.bridge is None:
+            return rx.status!=ROLE_CHANGE_DECISION.ROLE_CHANGED
+        if rx.status==ROLE_CHANGE_DECISION.PROGRESSING:
+            return True
+        elif rx.status==ROLE_CHANGE_DECISION.ROLE_CHANGED:
+            if rx.value:
+                self.bridge.put((self.index, rx.value))
+            return False
+
+        # Send the chunk to the response (blocks if the client is too slow)
+        return self.bridge.put((self.index, rx.value))
+
+    def finish(self):
+        """Releases the held back text once the generation of the choice is over."""
+        if not self.reception_manager.done and self.reception_manager.flush() and self.bridge is not None:
+            self.bridge.put((self.index, self.reception_manager.chunk))
+        self.reception_manager.done = True
+        if self.bridge is not None:
+            self.bridge.put((self.index, None))
+
+def _best_choices(choices:List[_GenerationChoice], n:int) -> List[_GenerationChoice]:
+    """Keeps n of the best_of choices and renumbers them.
+
+    Bindings don't report log probabilities so the choices that reached a natural end
+    are preferred to the truncated ones, in generation order.
+    """
+    best = sorted(choices, key=lambda choice: choice.finish_reason!="stop")[:n]
+    for index, choice in enumerate(best):
+        choice.index = index
+    return best
+
+def _usage(choices:List[_GenerationChoice]) -> dict:
+    """Usage of a request (the prompt is shared by all the choices)."""
+    prompt_tokens = choices[0].usage.prompt_tokens if len(choices)>0 else 0
+    completion_tokens = sum(choice.usage.completion_tokens for choice in choices)
+    return {"prompt_tokens":prompt_tokens, "completion_tokens":completion_tokens, "total_tokens":prompt_tokens+completion_tokens}
+
+async def _count_tokens(binding, prompt:str, timings:GENERATION_TIMINGS=None) -> int:
+    """Number of tokens of the prompt, without blocking the event loop (the tokenization is recorded in the timings of the request if any)."""
+    if timings is None:
+        return len(await binding.tokenizer_cache.atokenize(prompt))
+    with timings.span("tokenization"):
+        return len(await binding.tokenizer_cache.atokenize(prompt))
+
+def _serialize(timings:GENERATION_TIMINGS, encode, *args):
+    """Calls the response encoder, recording the time spent in the timings of the request if any."""
+    if timings is None:
+        return encode(*args)
+    with timings.span("serialization"):
+        return encode(*args)
+
 # ----------------------- Defining router and main class ------------------------------
 
 router = APIRouter()
@@ -41,7 +179,23 @@ elf_server = LOLLMSElfServer.get_instance()
 
 @router.get("/get_generation_status")
 def get_generation_status():
-    return {"status":elf_server.busy}
+    status = elf_server.scheduler.get_status()
+    response = {"status":status["busy"], "scheduler":status}
+    if getattr(elf_server, "response_cache", None) is not None:
+        response["response_cache"] = elf_server.response_cache.get_status()
+    if getattr(elf_server, "model_pool", None) is not None:
+        response["model_pool"] = elf_server.model_pool.get_status()
+    if getattr(elf_server, "speculative_decoder", None) is not None:
+        response["speculative_decoding"] = elf_server.speculative_decoder.get_status()
+    if getattr(elf_server, "embedding_batcher", None) is not None:
+        response["embeddings"] = elf_server.embedding_batcher.get_status()
+    if tracer.enabled:
+        response["tracing"] = tracer.get_status()
+    if getattr(elf_server, "emit_bridge", None) is not None:
+        response["socketio_streaming"] = elf_server.emit_bridge.get_status()
+    if isinstance(elf_server.model, BindingWorkersModel):
+        response["binding_workers"] = elf_server.model.pool.get_status()
+    return response
 
 
 # ----------------------------------- Generation -----------------------------------------
@@ -58,9 +212,12 @@ class LollmsGenerateRequest(BaseModel):
     repeat_last_n: Optional[int] = 40
     seed: Optional[int] = None
     n_threads: Optional[int] = 8
+    n: Optional[int] = Field(1, ge=1, le=MAX_CHOICES)
+    best_of: Optional[int] = Field(None, ge=1, le=MAX_CHOICES)
+    timings: Optional[bool] = False
 
 @router.post("/lollms_generate")
-async def lollms_generate(request: LollmsGenerateRequest):
+async def lollms_generate(request: LollmsGenerateRequest, http_request: Request, response: Response):
     """ Endpoint for generating text from prompts using the LoLLMs fastAPI server.
 
     Args:
@@ -78,104 +235,107 @@ async def lollms_generate(request: LollmsGenerateRequest):
     - repeat_last_n: int representing the repeat_last_n parameter for text generation.
     - seed: int representing the seed for text generation.
     - n_threads: int representing the number of threads for text generation.
+    - n: int representing the number of choices to generate, up to 16 (the prompt is prefilled once and the choices are sampled in parallel).
+    - best_of: int representing the number of choices to generate before keeping the n best ones, up to 16 (ignored when streaming).
+    - timings: bool indicating whether to return the time spent in each stage of the generation (queue, tokenization, prompt building, prefill, decode, stop processing, serialization).
 
     Returns:
     - If the elf_server binding is not None:
-    - If stream is True, returns a StreamingResponse of generated text chunks.
-    - If stream is False, returns the generated text as a string.
+    - If stream is True, returns a StreamingResponse of generated text chunks (JSON lines with the choice index when n>1). When timings is True, a last {"timings":{...}} JSON line is sent.
+    - If stream is False, returns the generated text as a string (a list of {index, text, finish_reason} when n>1). When timings is True, returns {"text":..., "timings":{...}} ({"choices":[...], "timings":{...}} when n>1).
     - If the elf_server binding is None, returns None.
     """
 
+    metrics.inc("lollms_requests_total", endpoint="/lollms_generate")
     try:
-        reception_manager=RECPTION_MANAGER()
         prompt = request.prompt
         n_predict = request.n_predict if request.n_predict>0 else 1024
         stream = request.stream
-        prompt_tokens = len(elf_server.binding.tokenize(prompt))
+        n = max(1, request.n or 1)
+        timings = GENERATION_TIMINGS() if request.timings else None
         if elf_server.binding is not None:
+            # Can be used to cancel this request with /stop_gen/{request_id}
+            request_id = str(uuid.uuid4())
             if stream:
-                new_output={"new_values":[]}
                 async def generate_chunks():
-                    lk = threading.Lock()
+                    bridge = STREAM_BRIDGE(asyncio.get_running_loop())
+                    choices = [_GenerationChoice(index, n_predict, bridge=bridge, timings=timings) for index in range(n)]
 
-                    def callback(chunk, chunk_type:MSG_TYPE=MSG_TYPE.MSG_TYPE_CHUNK):
-                        if elf_server.cancel_gen:
-                            return False
-                        
-                        if chunk is None:
-                            return
-
-                        rx = reception_manager.new_chunk(chunk)
-                        if rx.status!=ROLE_CHANGE_DECISION.MOVE_ON:
-                            if rx.status==ROLE_CHANGE_DECISION.PROGRESSING:
-                                return True
-                            elif rx.status==ROLE_CHANGE_DECISION.ROLE_CHANGED:
-                                return False
-                            else:
-                                chunk = chunk + rx.value
-
-                        # Yield each chunk of data
-                        lk.acquire()
+                    def finish():
+                        for choice in choices:
+                            choice.finish()
+                        bridge.finish()
+
+                    def chunks_builder():
+                        entry = None
                         try:
-                            new_output["new_values"].append(reception_manager.chunk)
-                            lk.release()
-                            return True
+                            entry = _use_model(request.model_name)
+                            elf_server.generate_choices(
+                                                    prompt, 
+                                                    n_predict, 
+                                                    callbacks=[choice.callback for choice in choices], 
+                                                    usages=[choice.usage for choice in choices],
+                                                    temperature=request.temperature if request.temperature is not None else elf_server.config.temperature,
+                                                    seed=request.seed,
+                                                    model=entry.model if entry is not None else None,
+                                                    timings=timings
+                                                )
                         except Exception as ex:
                             trace_exception(ex)
-                            lk.release()
-                            return False
-                        
-                    def chunks_builder():
-                        elf_server.binding.generate(
-                                                prompt, 
-                                                n_predict, 
-                                                callback=callback, 
-                                                temperature=request.temperature or elf_server.config.temperature
-                                            )
-                        reception_manager.done = True
-                    thread = threading.Thread(target=chunks_builder)
-                    thread.start()
-                    current_index = 0
-                    while (not reception_manager.done and elf_server.cancel_gen == False):
-                        while (not reception_manager.done and len(new_output["new_values"])==0):
-                            time.sleep(0.001)
-                        lk.acquire()
-                        for i in range(len(new_output["new_values"])):
-                            current_index += 1                        
-                            yield (new_output["new_values"][i] + '\n')
-                        new_output["new_values"]=[]
-                        lk.release()
-                    elf_server.cancel_gen = False         
-                return StreamingResponse(generate_chunks(), media_type="text/plain")
-            else:
-                def callback(chunk, chunk_type:MSG_TYPE=MSG_TYPE.MSG_TYPE_CHUNK):
-                    # Yield each chunk of data
-                    if chunk is None:
-                        return True
-
-                    rx = reception_manager.new_chunk(chunk)
-                    if rx.status!=ROLE_CHANGE_DECISION.MOVE_ON:
-                        if rx.status==ROLE_CHANGE_DECISION.PROGRESSING:
-                            return True
-                        elif rx.status==ROLE_CHANGE_DECISION.ROLE_CHANGED:
-                            return False
+                        finally:
+                            if entry is not None:
+                                elf_server.model_pool.release(entry)
+                            finish()
+                    # A job canceled while it is queued never runs chunks_builder
+                    elf_server.scheduler.submit(chunks_builder, client_id=_client_key(http_request), job_id=request_id, on_cancel=finish)
+                    async for index, chunk in bridge:
+                        if n==1:
+                            if chunk is not None:
+                                yield (chunk + '\n')
+                        elif chunk is None:
+                            yield _serialize(timings, json.dumps, {"index":index, "finish_reason":choices[index].finish_reason}) + '\n'
                         else:
-                            chunk = chunk + rx.value
-
-
-                    return True
-                elf_server.binding.generate(
-                                                prompt, 
-                                                n_predict, 
-                                                callback=callback,
-                                                temperature=request.temperature or elf_server.config.temperature
-                                            )
-                completion_tokens = len(elf_server.binding.tokenize(reception_manager.reception_buffer))
-                return reception_manager.reception_buffer
+                            yield _serialize(timings, json.dumps, {"index":index, "chunk":chunk}) + '\n'
+                    if timings is not None:
+                        yield json.dumps({"timings":timings.to_dict()}) + '\n'
+                return StreamingResponse(generate_chunks(), media_type="text/plain", headers={"X-Request-ID": request_id})
+            else:
+                response.headers["X-Request-ID"] = request_id
+                choices = [_GenerationChoice(index, n_predict, timings=timings) for index in range(max(n, request.best_of or 0))]
+                entry = await _acquire_model(request.model_name)
+                try:
+                    await elf_server.scheduler.run_async(
+                                                    elf_server.generate_choices,
+                                                    prompt, 
+                                                    n_predict, 
+                                                    callbacks=[choice.callback for choice in choices],
+                                                    usages=[choice.usage for choice in choices],
+                                                    temperature=request.temperature if request.temperature is not None else elf_server.config.temperature,
+                                                    seed=request.seed,
+                                                    model=entry.model if entry is not None else None,
+                                                    timings=timings,
+                                                    client_id=_client_key(http_request),
+                                                    job_id=request_id
+                                                )
+                finally:
+                    if entry is not None:
+                        elf_server.model_pool.release(entry)
+                for choice in choices:
+                    choice.finish()
+                choices = _best_choices(choices, n)
+                if n==1:
+                    if timings is not None:
+                        return {"text":choices[0].text, "timings":timings.to_dict()}
+                    return choices[0].text
+                choices = [{"index":choice.index, "text":choice.text, "finish_reason":choice.finish_reason} for choice in choices]
+                if timings is not None:
+                    return {"choices":choices, "timings":timings.to_dict()}
+                return choices
         else:
             return None
     except Exception as ex:
         trace_exception(ex)
+        metrics.inc("lollms_errors_total", source="/lollms_generate")
         elf_server.error(ex)
         return {"status":False,"error":str(ex)}
 
@@ -199,9 +359,9 @@ class Choices(BaseModel):
 
 
 class Usage(BaseModel):
-    prompt_tokens: Optional[int]=0,
-    completion_tokens : Optional[int]=0,
-    completion_tokens : Optional[int]=0,
+    prompt_tokens: Optional[int]=0
+    completion_tokens : Optional[int]=0
+    total_tokens : Optional[int]=0
 
 
 class StreamingChoices(BaseModel):
@@ -262,6 +422,9 @@ class ModelResponse(BaseModel):
     usage: Optional[Usage] = None
     """Usage statistics for the completion request."""
 
+    timings: Optional[dict] = None
+    """Time spent in each stage of the generation (only when the request asked for it)."""
+
 
 class GenerationRequest(BaseModel):
     model: str = ""
@@ -269,12 +432,27 @@ class GenerationRequest(BaseModel):
     max_tokens: Optional[int] = 1024
     stream: Optional[bool] = False
     temperature: Optional[float] = 0.1
+    seed: Optional[int] = None
+    n: Optional[int] = Field(1, ge=1, le=MAX_CHOICES)
+    best_of: Optional[int] = Field(None, ge=1, le=MAX_CHOICES)
+    timings: Optional[bool] = False
 
 
 @router.post("/v1/chat/completions")
-async def v1_chat_completions(request: GenerationRequest):
+async def v1_chat_completions(request: GenerationRequest, http_request: Request, response: Response):
+    """
+    OpenAI compatible chat completion.
+
+    With n>1 the prompt is prefilled once and the n choices are sampled in parallel, each
+    one with its own index and finish_reason. best_of choices are generated and the n best
+    are returned (best_of is ignored when streaming). n and best_of are limited to MAX_CHOICES.
+    With a seed, choice i is sampled with seed+i.
+
+    With timings=true, the time spent in each stage of the generation is returned in the
+    `timings` field of the response (of the final usage chunk when streaming).
+    """
+    metrics.inc("lollms_requests_total", endpoint="/v1/chat/completions")
     try:
-        reception_manager=RECPTION_MANAGER()
         messages = request.messages
         prompt = ""
         roles= False
@@ -288,169 +466,251 @@ async def v1_chat_completions(request: GenerationRequest):
             prompt += "!@>assistant:"
         n_predict = request.max_tokens if request.max_tokens>0 else 1024
         stream = request.stream
-        prompt_tokens = len(elf_server.binding.tokenize(prompt))
+        n = max(1, request.n or 1)
+        timings = GENERATION_TIMINGS() if request.timings else None
         if elf_server.binding is not None:
+            # Can be used to cancel this request with /stop_gen/{request_id}
+            request_id = str(uuid.uuid4())
             if stream:
-                new_output={"new_values":[]}
                 async def generate_chunks():
-                    lk = threading.Lock()
+                    bridge = STREAM_BRIDGE(asyncio.get_running_loop())
+                    encoder = OPENAI_SSE_ENCODER(f"chatcmpl-{_generate_id(24)}", request.model if _routed(request.model) else elf_server.config.model_name, chat=True)
+                    choices = [_GenerationChoice(index, n_predict, bridge=bridge, timings=timings) for index in range(n)]
 
-                    def callback(chunk, chunk_type:MSG_TYPE=MSG_TYPE.MSG_TYPE_CHUNK):
-                        if elf_server.cancel_gen:
-                            return False
-                        
-                        if chunk is None:
-                            return
-
-                        rx = reception_manager.new_chunk(chunk)
-                        if rx.status!=ROLE_CHANGE_DECISION.MOVE_ON:
-                            if rx.status==ROLE_CHANGE_DECISION.PROGRESSING:
-                                return True
-                            elif rx.status==ROLE_CHANGE_DECISION.ROLE_CHANGED:
-                                return False
-                            else:
-                                chunk = chunk + rx.value
-
-                        # Yield each chunk of data
-                        lk.acquire()
+                    def finish():
+                        for choice in choices:
+                            choice.finish()
+                        bridge.finish()
+
+                    def chunks_builder():
+                        entry = None
                         try:
-                            new_output["new_values"].append(reception_manager.chunk)
-                            lk.release()
-                            return True
+                            entry = _use_model(request.model)
+                            _count_prompt_tokens(choices, entry.binding if entry is not None else elf_server.model, prompt, timings)
+                            elf_server.generate_choices(
+                                                    prompt, 
+                                                    n_predict, 
+                                                    callbacks=[choice.callback for choice in choices], 
+                                                    usages=[choice.usage for choice in choices],
+                                                    temperature=request.temperature if request.temperature is not None else elf_server.config.temperature,
+                                                    seed=request.seed,
+                                                    model=entry.model if entry is not None else None,
+                                                    timings=timings
+                                                )
                         except Exception as ex:
                             trace_exception(ex)
-                            lk.release()
-                            return False
-                        
-                    def chunks_builder():
-                        elf_server.binding.generate(
-                                                prompt, 
-                                                n_predict, 
-                                                callback=callback, 
-                                                temperature=request.temperature or elf_server.config.temperature
-                                            )
-                        reception_manager.done = True
-                    thread = threading.Thread(target=chunks_builder)
-                    thread.start()
-                    current_index = 0
-                    while (not reception_manager.done and elf_server.cancel_gen == False):
-                        while (not reception_manager.done and len(new_output["new_values"])==0):
-                            time.sleep(0.001)
-                        lk.acquire()
-                        for i in range(len(new_output["new_values"])):
-                            output_val = StreamingModelResponse(
-                                id = _generate_id(), 
-                                choices = [StreamingChoices(index= current_index, delta=Delta(content=new_output["new_values"][i]))], 
-                                created=int(time.time()),
-                                model=elf_server.config.model_name,
-                                object="chat.completion.chunk",
-                                usage=Usage(prompt_tokens= prompt_tokens, completion_tokens= 1)
-                                )
-                            current_index += 1                        
-                            yield (output_val.json() + '\n')
-                        new_output["new_values"]=[]
-                        lk.release()
-                    elf_server.cancel_gen = False         
-                return StreamingResponse(generate_chunks(), media_type="application/json")
-            else:
-                def callback(chunk, chunk_type:MSG_TYPE=MSG_TYPE.MSG_TYPE_CHUNK):
-                    # Yield each chunk of data
-                    if chunk is None:
-                        return True
-
-                    rx = reception_manager.new_chunk(chunk)
-                    if rx.status!=ROLE_CHANGE_DECISION.MOVE_ON:
-                        if rx.status==ROLE_CHANGE_DECISION.PROGRESSING:
-                            return True
-                        elif rx.status==ROLE_CHANGE_DECISION.ROLE_CHANGED:
-                            return False
+                        finally:
+                            if entry is not None:
+                                elf_server.model_pool.release(entry)
+                            finish()
+                    # A job canceled while it is queued never runs chunks_builder
+                    elf_server.scheduler.submit(chunks_builder, client_id=_client_key(http_request), job_id=request_id, on_cancel=finish)
+                    for choice in choices:
+                        yield encoder.role(choice.index)
+                    async for index, chunk in bridge:
+                        if chunk is None:
+                            yield encoder.finish(choices[index].finish_reason, index)
                         else:
-                            chunk = chunk + rx.value
-
-
-                    return True
-                elf_server.binding.generate(
-                                                prompt, 
-                                                n_predict, 
-                                                callback=callback,
-                                                temperature=request.temperature or elf_server.config.temperature
-                                            )
-                completion_tokens = len(elf_server.binding.tokenize(reception_manager.reception_buffer))
-                return ModelResponse(id = _generate_id(), choices = [Choices(message=Message(role="assistant", content=reception_manager.reception_buffer), finish_reason="stop", index=0)], created=int(time.time()), model=request.model,usage=Usage(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens))
+                            yield _serialize(timings, encoder.chunk, chunk, index)
+                    usage = _usage(choices)
+                    yield encoder.usage(usage["prompt_tokens"], usage["completion_tokens"], timings.to_dict() if timings is not None else None)
+                    yield OPENAI_SSE_ENCODER.DONE
+                return StreamingResponse(generate_chunks(), media_type="text/event-stream", headers={"X-Request-ID": request_id})
+            else:
+                response.headers["X-Request-ID"] = request_id
+                entry = await _acquire_model(request.model)
+                binding = entry.binding if entry is not None else elf_server.model
+                try:
+                    prompt_tokens = await _count_tokens(binding, prompt, timings)
+                    choices = [_GenerationChoice(index, n_predict, prompt_tokens=prompt_tokens, timings=timings) for index in range(max(n, request.best_of or 0))]
+                    await elf_server.scheduler.run_async(
+                                                    elf_server.generate_choices,
+                                                    prompt, 
+                                                    n_predict, 
+                                                    callbacks=[choice.callback for choice in choices],
+                                                    usages=[choice.usage for choice in choices],
+                                                    temperature=request.temperature if request.temperature is not None else elf_server.config.temperature,
+                                                    seed=request.seed,
+                                                    model=entry.model if entry is not None else None,
+                                                    timings=timings,
+                                                    client_id=_client_key(http_request),
+                                                    job_id=request_id
+                                                )
+                    for choice in choices:
+                        choice.finish()
+                finally:
+                    if entry is not None:
+                        elf_server.model_pool.release(entry)
+                return ModelResponse(
+                                        id = _generate_id(),
+                                        choices = [Choices(message=Message(role="assistant", content=choice.text), finish_reason=choice.finish_reason, index=choice.index) for choice in _best_choices(choices, n)],
+                                        created=int(time.time()),
+                                        model=request.model,
+                                        usage=Usage(**_usage(choices)),
+                                        timings=timings.to_dict() if timings is not None else None
+                                    )
         else:
             return None
     except Exception as ex:
         trace_exception(ex)
+        metrics.inc("lollms_errors_total", source="/v1/chat/completions")
         elf_server.error(ex)
         return {"status":False,"error":str(ex)}
 
 
 @router.post("/v1/completions")
-async def v1_completion(request: Request):
+async def v1_completion(request: Request, response: Response):
     """
-    Executes Python code and returns the output.
+    OpenAI compatible text completion.
 
-    :param request: The HTTP request object.
-    :return: A JSON response with the status of the operation.
+    :param request: The HTTP request object (prompt, max_tokens, stream, stop, temperature, timings).
+    :return: The generated text ({"text", "timings"} if timings is true), or a text/event-stream of text_completion chunks if stream is true (the timings are sent with the usage).
     """
 
+    metrics.inc("lollms_requests_total", endpoint="/v1/completions")
     try:
         data = (await request.json())
         text = data.get("prompt")
-        n_predict = data.get("max_tokens")
+        n_predict = data.get("max_tokens") or 1024
         stream = data.get("stream")
+        stop = data.get("stop") or []
+        stop_sequences = ["!@>"] + ([stop] if isinstance(stop, str) else list(stop))
+        timings = GENERATION_TIMINGS() if data.get("timings") else None
         
         if elf_server.binding is not None:
+            # Can be used to cancel this request with /stop_gen/{request_id}
+            request_id = str(uuid.uuid4())
             if stream:
-                output = {"text":""}
-                def generate_chunks():
-                    def callback(chunk, chunk_type:MSG_TYPE=MSG_TYPE.MSG_TYPE_CHUNK):
-                        # Yield each chunk of data
-                        output["text"] += chunk
-                        antiprompt = detect_antiprompt(output["text"])
-                        if antiprompt:
-                            ASCIIColors.warning(f"\nDetected hallucination with antiprompt: {antiprompt}")
-                            output["text"] = remove_text_from_string(output["text"],antiprompt)
-                            return False
-                        else:
-                            yield chunk
-                            return True
-                    return iter(elf_server.binding.generate(
-                                                text, 
-                                                n_predict, 
-                                                callback=callback, 
-                                                temperature=data.get("temperature", elf_server.config.temperature)
-                                            ))
-                
-                return StreamingResponse(generate_chunks())
+                async def generate_chunks():
+                    bridge = STREAM_BRIDGE(asyncio.get_running_loop())
+                    encoder = OPENAI_SSE_ENCODER(f"cmpl-{_generate_id(24)}", data.get("model") if _routed(data.get("model")) else elf_server.config.model_name, chat=False)
+                    choice = _GenerationChoice(0, n_predict, stop_sequences, bridge, timings=timings)
+
+                    def finish():
+                        choice.finish()
+                        bridge.finish()
+
+                    def chunks_builder():
+                        entry = None
+                        try:
+                            entry = _use_model(data.get("model"))
+                            _count_prompt_tokens([choice], entry.binding if entry is not None else elf_server.model, text, timings)
+                            elf_server.generate_text(
+                                                    text, 
+                                                    n_predict, 
+                                                    callback=choice.callback, 
+                                                    temperature=data["temperature"] if data.get("temperature") is not None else elf_server.config.temperature,
+                                                    model=entry.model if entry is not None else None,
+                                                    usage=choice.usage,
+                                                    timings=timings
+                                                )
+                        except Exception as ex:
+                            trace_exception(ex)
+                        finally:
+                            if entry is not None:
+                                elf_server.model_pool.release(entry)
+                            finish()
+                    # A job canceled while it is queued never runs chunks_builder
+                    elf_server.scheduler.submit(chunks_builder, client_id=_client_key(request), job_id=request_id, on_cancel=finish)
+                    async for index, chunk in bridge:
+                        if chunk is not None:
+                            yield _serialize(timings, encoder.chunk, chunk)
+                    yield encoder.finish(choice.finish_reason)
+                    yield encoder.usage(choice.usage.prompt_tokens, choice.usage.completion_tokens, timings.to_dict() if timings is not None else None)
+                    yield OPENAI_SSE_ENCODER.DONE
+
+                return StreamingResponse(generate_chunks(), media_type="text/event-stream", headers={"X-Request-ID": request_id})
             else:
-                output = {"text":""}
-                def callback(chunk, chunk_type:MSG_TYPE=MSG_TYPE.MSG_TYPE_CHUNK):
-                    # Yield each chunk of data
-                    output["text"] += chunk
-                    antiprompt = detect_antiprompt(output["text"])
-                    if antiprompt:
-                        ASCIIColors.warning(f"\nDetected hallucination with antiprompt: {antiprompt}")
-                        output["text"] = remove_text_from_string(output["text"],antiprompt)
-                        return False
-                    else:
-                        return True
-                elf_server.binding.generate(
-                                                text, 
-                                                n_predict, 
-                                                callback=callback,
-                                                temperature=data.get("temperature", elf_server.config.temperature)
-                                            )
-                return output["text"]
+                response.headers["X-Request-ID"] = request_id
+                choice = _GenerationChoice(0, n_predict, stop_sequences, timings=timings)
+                entry = await _acquire_model(data.get("model"))
+                try:
+                    await elf_server.scheduler.run_async(
+                                                    elf_server.generate_text,
+                                                    text, 
+                                                    n_predict, 
+                                                    callback=choice.callback,
+                                                    temperature=data["temperature"] if data.get("temperature") is not None else elf_server.config.temperature,
+                                                    model=entry.model if entry is not None else None,
+                                                    timings=timings,
+                                                    client_id=_client_key(request),
+                                                    job_id=request_id
+                                                )
+                finally:
+                    if entry is not None:
+                        elf_server.model_pool.release(entry)
+                choice.finish()
+                if timings is not None:
+                    return {"text":choice.text, "timings":timings.to_dict()}
+                return choice.text
         else:
             return None
     except Exception as ex:
         trace_exception(ex)
+        metrics.inc("lollms_errors_total", source="/v1/completions")
+        elf_server.error(ex)
+        return {"status":False,"error":str(ex)}
+
+
+class EmbeddingsRequest(BaseModel):
+    input: Union[str, List[str], List[int], List[List[int]]]
+    model: Optional[str] = None
+    encoding_format: Optional[str] = "float"
+
+@router.post("/v1/embeddings")
+async def v1_embeddings(request: EmbeddingsRequest):
+    """
+    OpenAI compatible embeddings.
+
+    The texts of the concurrent requests are merged by the embedding batcher into a
+    single embed_batch call of the binding.
+
+    :param request: The texts (or token lists) to embed, the model and the encoding format (float or base64).
+    :return: A list of embedding objects with their usage.
+    """
+    metrics.inc("lollms_requests_total", endpoint="/v1/embeddings")
+    try:
+        if elf_server.binding is None:
+            return None
+        entry = await _acquire_model(request.model)
+        binding = entry.binding if entry is not None else elf_server.model
+        try:
+            inputs = request.input
+            if isinstance(inputs, str) or (len(inputs)>0 and isinstance(inputs[0], int)):
+                inputs = [inputs]
+            texts = [text if isinstance(text, str) else await binding.tokenizer_cache.adetokenize(text) for text in inputs]
+            embeddings = await elf_server.embedding_batcher.aembed(binding, texts)
+            prompt_tokens = sum([len(await binding.tokenizer_cache.atokenize(text)) for text in texts])
+        finally:
+            if entry is not None:
+                elf_server.model_pool.release(entry)
+        data = []
+        for index, embedding in enumerate(embeddings):
+            if request.encoding_format=="base64":
+                embedding = base64.b64encode(np.asarray(embedding, dtype="<f4").tobytes()).decode("ascii")
+            else:
+                embedding = np.asarray(embedding, dtype=float).tolist()
+            data.append({"object":"embedding", "index":index, "embedding":embedding})
+        return {
+            "object":"list",
+            "data":data,
+            "model":entry.model_name if entry is not None else elf_server.config.model_name,
+            "usage":{"prompt_tokens":prompt_tokens, "total_tokens":prompt_tokens}
+        }
+    except Exception as ex:
+        trace_exception(ex)
+        metrics.inc("lollms_errors_total", source="/v1/embeddings")
         elf_server.error(ex)
         return {"status":False,"error":str(ex)}
 
 
 @router.post("/stop_gen")
-def stop_gen():
-    elf_server.cancel_gen = True
-    return {"status": True} 
+def stop_gen(request: Request):
+    """Cancels the generations of the calling client (X-Client-Id header, or address without it). The other clients are not affected."""
+    nb_canceled = elf_server.scheduler.cancel_client(_client_key(request), "stop_gen")
+    return {"status": nb_canceled>0, "canceled": nb_canceled}
+
+@router.post("/stop_gen/{request_id}")
+def stop_gen_request(request_id: str):
+    """Cancels a generation using the request id returned in the X-Request-ID header of the responses."""
+    return {"status": elf_server.scheduler.cancel(request_id, "stop_gen")} 
@@ -0,0 +1,25 @@
+"""
+project: lollms
+file: lollms_metrics.py 
+author: ParisNeo
+description: 
+    This module contains a set of FastAPI routes that provide information about the Lord of Large Language and Multimodal Systems (LoLLMs) Web UI
+    application. These routes are specific to the server metrics (Prometheus format)
+
+"""
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from lollms.server.elf_server import LOLLMSElfServer
+from lollms.metrics import metrics
+
+# ----------------------- Defining router and main class ------------------------------
+router = APIRouter()
+lollmsElfServer = LOLLMSElfServer.get_instance()
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Returns the generation server metrics (requests, queue depth, latencies, tokens, cancellations and errors)
+    in the Prometheus text exposition format.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
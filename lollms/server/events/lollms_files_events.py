@@ -18,7 +18,7 @@ from ascii_colors import ASCIIColors
 from lollms.personality import MSG_TYPE, AIPersonality
 from lollms.types import MSG_TYPE, SENDER_TYPES
 from lollms.utilities import load_config, trace_exception, gc
-from lollms.utilities import find_first_available_file_index, convert_language_name, run_async
+from lollms.utilities import find_first_available_file_index, convert_language_name
 from lollms_webui import LOLLMSWebUI
 from pathlib import Path
 from typing import List
@@ -49,16 +49,16 @@ def add_events(sio:socketio):
                 file.save(save_path)
                 lollmsElfServer.personality.processor.add_file(save_path, partial(lollmsElfServer.process_chunk, client_id = sid))
                 # File saved successfully
-                run_async(partial(sio.emit,'progress', {'status':True, 'progress': 100}))
+                lollmsElfServer.emit_bridge.emit('progress', {'status':True, 'progress': 100})
 
             else:
                 file.save(save_path)
                 lollmsElfServer.personality.add_file(save_path, partial(lollmsElfServer.process_chunk, client_id = sid))
                 # File saved successfully
-                run_async(partial(sio.emit,'progress', {'status':True, 'progress': 100}))
+                lollmsElfServer.emit_bridge.emit('progress', {'status':True, 'progress': 100})
         except Exception as e:
             # Error occurred while saving the file
-            run_async(partial(sio.emit,'progress', {'status':False, 'error': str(e)}))
+            lollmsElfServer.emit_bridge.emit('progress', {'status':False, 'error': str(e)})
                     
         """
  
\ No newline at end of file
@@ -16,13 +16,12 @@ from lollms.binding import BindingBuilder, InstallOption
 from ascii_colors import ASCIIColors
 from lollms.personality import MSG_TYPE, AIPersonality
 from lollms.types import SENDER_TYPES
-from lollms.utilities import load_config, trace_exception, gc, terminate_thread, run_async
+from lollms.utilities import load_config, trace_exception, gc
 from pathlib import Path
 from typing import List
 import socketio
 import os
 from functools import partial
-import threading
 lollmsElfServer = LOLLMSElfServer.get_instance()
 
 
@@ -31,12 +30,12 @@ def add_events(sio:socketio):
     @sio.on('cancel_generation')
     def cancel_generation(sid):
         client_id = sid
-        lollmsElfServer.cancel_gen = True
-        #kill thread
         ASCIIColors.error(f'Client {sid} requested cancelling generation')
-        terminate_thread(lollmsElfServer.connections[client_id]['generation_thread'])
+        # Only this client's generation is stopped (at the next generated chunk)
+        job = lollmsElfServer.connections[client_id].get('generation_job')
+        if job is not None:
+            lollmsElfServer.scheduler.cancel(job.id, "cancel_generation")
         ASCIIColors.error(f'Client {sid} canceled generation')
-        lollmsElfServer.busy=False
     
     
     @sio.on('cancel_text_generation')
@@ -44,23 +43,21 @@ def add_events(sio:socketio):
         client_id = sid
         lollmsElfServer.connections[client_id]["requested_stop"]=True
         print(f"Client {client_id} requested canceling generation")
-        run_async(partial(lollmsElfServer.sio.emit,"generation_canceled", {"message":"Generation is canceled."}, to=client_id))
-        lollmsElfServer.busy = False
+        job = lollmsElfServer.connections[client_id].get('generation_job')
+        if job is not None:
+            lollmsElfServer.scheduler.cancel(job.id, "cancel_text_generation")
+        lollmsElfServer.emit_bridge.emit("generation_canceled", {"message":"Generation is canceled."}, to=client_id)
 
 
     # A copy of the original lollms-server generation code needed for playground
     @sio.on('generate_text')
     def handle_generate_text(sid, data):
         client_id = sid
-        lollmsElfServer.cancel_gen = False
         ASCIIColors.info(f"Text generation requested by client: {client_id}")
-        if lollmsElfServer.busy:
-            run_async(partial(lollmsElfServer.sio.emit,"busy", {"message":"I am busy. Come back later."}, to=client_id))
-            ASCIIColors.warning(f"OOps request {client_id}  refused!! Server busy")
-            return
-        lollmsElfServer.busy = True
         try:
+            lollmsElfServer.evict_idle_connections()
             model = lollmsElfServer.model
+            lollmsElfServer.connections.setdefault(client_id, {})
             lollmsElfServer.connections[client_id]["is_generating"]=True
             lollmsElfServer.connections[client_id]["requested_stop"]=False
             prompt          = data['prompt']
@@ -89,7 +86,7 @@ def add_events(sio:socketio):
                             ASCIIColors.success(f"generated: {len(lollmsElfServer.answer['full_text'].split())} words", end='\r')
                             if text is not None:
                                 lollmsElfServer.answer["full_text"] = lollmsElfServer.answer["full_text"] + text
-                                run_async(partial(lollmsElfServer.sio.emit,'text_chunk', {'chunk': text, 'type':MSG_TYPE.MSG_TYPE_CHUNK.value}, to=client_id))
+                                lollmsElfServer.emit_bridge.emit_chunk('text_chunk', {'chunk': text, 'type':MSG_TYPE.MSG_TYPE_CHUNK.value}, to=client_id)
                         if client_id in lollmsElfServer.connections:# Client disconnected                      
                             if lollmsElfServer.connections[client_id]["requested_stop"]:
                                 return False
@@ -105,7 +102,7 @@ def add_events(sio:socketio):
                     try:
                         ASCIIColors.print("warming up", ASCIIColors.color_bright_cyan)
                         
-                        generated_text = model.generate(fd, 
+                        generated_text = lollmsElfServer.generate_text(fd, 
                                                         n_predict=n_predicts, 
                                                         callback=callback,
                                                         temperature = parameters["temperature"],
@@ -120,24 +117,24 @@ def add_events(sio:socketio):
                         if client_id in lollmsElfServer.connections:
                             if not lollmsElfServer.connections[client_id]["requested_stop"]:
                                 # Emit the generated text to the client
-                                run_async(partial(lollmsElfServer.sio.emit,'text_generated', {'text': generated_text}, to=client_id))   
+                                lollmsElfServer.emit_bridge.emit('text_generated', {'text': generated_text}, to=client_id)
                     except Exception as ex:
-                        run_async(partial(lollmsElfServer.sio.emit,'generation_error', {'error': str(ex)}, to=client_id))
+                        lollmsElfServer.emit_bridge.emit('generation_error', {'error': str(ex)}, to=client_id)
                         ASCIIColors.error(f"\ndone")
-                    lollmsElfServer.busy = False
                 else:
                     try:
                         personality: AIPersonality = lollmsElfServer.personalities[personality_id]
                         ump = lollmsElfServer.config.discussion_prompt_separator +lollmsElfServer.config.user_name.strip() if lollmsElfServer.config.use_user_name_in_discussions else lollmsElfServer.personality.user_message_prefix
                         personality.model = model
-                        cond_tk = personality.model.tokenize(personality.personality_conditioning)
+                        cond_tk = personality.model.tokenizer_cache.tokenize(personality.personality_conditioning)
                         n_cond_tk = len(cond_tk)
                         # Placeholder code for text generation
                         # Replace this with your actual text generation logic
                         print(f"Text generation requested by client: {client_id}")
 
                         lollmsElfServer.answer["full_text"] = ''
-                        full_discussion_blocks = lollmsElfServer.connections[client_id]["full_discussion_blocks"]
+                        # Only the new messages are tokenized, the context is made of the last messages that fit
+                        discussion_window = lollmsElfServer.get_discussion_window(client_id, personality.model)
 
                         if prompt != '':
                             if personality.processor is not None and personality.processor_cfg["process_model_input"]:
@@ -146,22 +143,16 @@ def add_events(sio:socketio):
                                 preprocessed_prompt = prompt
                             
                             if personality.processor is not None and personality.processor_cfg["custom_workflow"]:
-                                full_discussion_blocks.append(ump)
-                                full_discussion_blocks.append(preprocessed_prompt)
+                                discussion_window.append(ump + preprocessed_prompt)
                         
                             else:
 
-                                full_discussion_blocks.append(ump)
-                                full_discussion_blocks.append(preprocessed_prompt)
-                                full_discussion_blocks.append(personality.link_text)
-                                full_discussion_blocks.append(personality.ai_message_prefix)
-
-                        full_discussion = personality.personality_conditioning + ''.join(full_discussion_blocks)
+                                discussion_window.append(ump + preprocessed_prompt + personality.link_text + personality.ai_message_prefix)
 
                         def callback(text, message_type: MSG_TYPE, metadata:dict={}):
                             if message_type == MSG_TYPE.MSG_TYPE_CHUNK:
                                 lollmsElfServer.answer["full_text"] = lollmsElfServer.answer["full_text"] + text
-                                run_async(partial(lollmsElfServer.sio.emit,'text_chunk', {'chunk': text}, to=client_id))
+                                lollmsElfServer.emit_bridge.emit_chunk('text_chunk', {'chunk': text}, to=client_id)
                             try:
                                 if lollmsElfServer.connections[client_id]["requested_stop"]:
                                     return False
@@ -170,16 +161,14 @@ def add_events(sio:socketio):
                             except: # If the client is disconnected then we stop talking to it
                                 return False
 
-                        tk = personality.model.tokenize(full_discussion)
-                        n_tokens = len(tk)
-                        fd = personality.model.detokenize(tk[-min(lollmsElfServer.config.ctx_size-n_cond_tk-personality.model_n_predicts,n_tokens):])
+                        fd, _ = discussion_window.build(lollmsElfServer.config.ctx_size-n_cond_tk-personality.model_n_predicts)
                         
                         if personality.processor is not None and personality.processor_cfg["custom_workflow"]:
                             ASCIIColors.info("processing...")
                             generated_text = personality.processor.run_workflow(prompt, previous_discussion_text=personality.personality_conditioning+fd, callback=callback)
                         else:
                             ASCIIColors.info("generating...")
-                            generated_text = personality.model.generate(
+                            generated_text = lollmsElfServer.generate_text(
                                                                         personality.personality_conditioning+fd, 
                                                                         n_predict=personality.model_n_predicts, 
                                                                         callback=callback)
@@ -187,26 +176,23 @@ def add_events(sio:socketio):
                         if personality.processor is not None and personality.processor_cfg["process_model_output"]: 
                             generated_text = personality.processor.process_model_output(generated_text)
 
-                        full_discussion_blocks.append(generated_text.strip())
+                        discussion_window.append(generated_text.strip())
                         ASCIIColors.success("\ndone")
 
                         # Emit the generated text to the client
-                        run_async(partial(lollmsElfServer.sio.emit,'text_generated', {'text': generated_text}, to=client_id))
+                        lollmsElfServer.emit_bridge.emit('text_generated', {'text': generated_text}, to=client_id)
                     except Exception as ex:
-                        run_async(partial(lollmsElfServer.sio.emit,'generation_error', {'error': str(ex)}, to=client_id))
+                        lollmsElfServer.emit_bridge.emit('generation_error', {'error': str(ex)}, to=client_id)
                         ASCIIColors.error(f"\ndone")
-                    lollmsElfServer.busy = False
+                if client_id in lollmsElfServer.connections:
+                    lollmsElfServer.connections[client_id]["is_generating"]=False
 
-            lollmsElfServer.connections[client_id]['generation_thread'] = threading.Thread(target=do_generation)
-            lollmsElfServer.connections[client_id]['generation_thread'].start()
-            ASCIIColors.info("Started generation task")
-            lollmsElfServer.busy=True
+            lollmsElfServer.connections[client_id]['generation_job'] = lollmsElfServer.scheduler.submit(do_generation, client_id=client_id)
+            ASCIIColors.info("Queued generation task")
 
         except Exception as ex:
-            lollmsElfServer.busy=False
             trace_exception(ex)
-            run_async(partial(lollmsElfServer.sio.emit,'generation_error', {'error': str(ex)}, to=client_id))
-            lollmsElfServer.busy = False
+            lollmsElfServer.emit_bridge.emit('generation_error', {'error': str(ex)}, to=client_id)
 
 
 
@@ -214,7 +200,6 @@ def add_events(sio:socketio):
     @sio.on('generate_msg')
     def generate_msg(sid, data):
         client_id = sid
-        lollmsElfServer.cancel_gen = False
         lollmsElfServer.connections[client_id]["generated_text"]=""
         lollmsElfServer.connections[client_id]["cancel_generation"]=False
         lollmsElfServer.connections[client_id]["continuing"]=False
@@ -227,38 +212,30 @@ def add_events(sio:socketio):
             lollmsElfServer.error("Model not selected. Please select a model", client_id=client_id)
             return
 
-        if not lollmsElfServer.busy:
-            if lollmsElfServer.connections[client_id]["current_discussion"] is None:
-                if lollmsElfServer.db.does_last_discussion_have_messages():
-                    lollmsElfServer.connections[client_id]["current_discussion"] = lollmsElfServer.db.create_discussion()
-                else:
-                    lollmsElfServer.connections[client_id]["current_discussion"] = lollmsElfServer.db.load_last_discussion()
-
-            prompt = data["prompt"]
-            ump = lollmsElfServer.config.discussion_prompt_separator +lollmsElfServer.config.user_name.strip() if lollmsElfServer.config.use_user_name_in_discussions else lollmsElfServer.personality.user_message_prefix
-            message = lollmsElfServer.connections[client_id]["current_discussion"].add_message(
-                message_type    = MSG_TYPE.MSG_TYPE_FULL.value,
-                sender_type     = SENDER_TYPES.SENDER_TYPES_USER.value,
-                sender          = ump.replace(lollmsElfServer.config.discussion_prompt_separator,"").replace(":",""),
-                content=prompt,
-                metadata=None,
-                parent_message_id=lollmsElfServer.message_id
-            )
-
-            ASCIIColors.green("Starting message generation by "+lollmsElfServer.personality.name)
-            lollmsElfServer.connections[client_id]['generation_thread'] = threading.Thread(target=lollmsElfServer.start_message_generation, args=(message, message.id, client_id))
-            lollmsElfServer.connections[client_id]['generation_thread'].start()
-            ASCIIColors.info("Started generation task")
-            lollmsElfServer.busy=True
-            #tpe = threading.Thread(target=lollmsElfServer.start_message_generation, args=(message, message_id, client_id))
-            #tpe.start()
-        else:
-            lollmsElfServer.error("I am busy. Come back later.", client_id=client_id)
+        if lollmsElfServer.connections[client_id]["current_discussion"] is None:
+            if lollmsElfServer.db.does_last_discussion_have_messages():
+                lollmsElfServer.connections[client_id]["current_discussion"] = lollmsElfServer.db.create_discussion()
+            else:
+                lollmsElfServer.connections[client_id]["current_discussion"] = lollmsElfServer.db.load_last_discussion()
+
+        prompt = data["prompt"]
+        ump = lollmsElfServer.config.discussion_prompt_separator +lollmsElfServer.config.user_name.strip() if lollmsElfServer.config.use_user_name_in_discussions else lollmsElfServer.personality.user_message_prefix
+        message = lollmsElfServer.connections[client_id]["current_discussion"].add_message(
+            message_type    = MSG_TYPE.MSG_TYPE_FULL.value,
+            sender_type     = SENDER_TYPES.SENDER_TYPES_USER.value,
+            sender          = ump.replace(lollmsElfServer.config.discussion_prompt_separator,"").replace(":",""),
+            content=prompt,
+            metadata=None,
+            parent_message_id=lollmsElfServer.message_id
+        )
+
+        ASCIIColors.green("Starting message generation by "+lollmsElfServer.personality.name)
+        lollmsElfServer.connections[client_id]['generation_job'] = lollmsElfServer.scheduler.submit(lollmsElfServer.start_message_generation, message, message.id, client_id, client_id=client_id)
+        ASCIIColors.info("Queued generation task")
 
     @sio.on('generate_msg_from')
     def generate_msg_from(sid, data):
         client_id = sid
-        lollmsElfServer.cancel_gen = False
         lollmsElfServer.connections[client_id]["continuing"]=False
         lollmsElfServer.connections[client_id]["first_chunk"]=True
         
@@ -274,13 +251,11 @@ def add_events(sio:socketio):
             message = lollmsElfServer.connections[client_id]["current_discussion"].load_message(id_)
         if message is None:
             return            
-        lollmsElfServer.connections[client_id]['generation_thread'] = threading.Thread(target=lollmsElfServer.start_message_generation, args=(message, message.id, client_id, False, generation_type))
-        lollmsElfServer.connections[client_id]['generation_thread'].start()
+        lollmsElfServer.connections[client_id]['generation_job'] = lollmsElfServer.scheduler.submit(lollmsElfServer.start_message_generation, message, message.id, client_id, False, generation_type, client_id=client_id)
 
     @sio.on('continue_generate_msg_from')
     def handle_connection(sid, data):
         client_id = sid
-        lollmsElfServer.cancel_gen = False
         lollmsElfServer.connections[client_id]["continuing"]=True
         lollmsElfServer.connections[client_id]["first_chunk"]=True
         
@@ -295,5 +270,4 @@ def add_events(sio:socketio):
             message = lollmsElfServer.connections[client_id]["current_discussion"].load_message(id_)
 
         lollmsElfServer.connections[client_id]["generated_text"]=message.content
-        lollmsElfServer.connections[client_id]['generation_thread'] = threading.Thread(target=lollmsElfServer.start_message_generation, args=(message, message.id, client_id, True))
-        lollmsElfServer.connections[client_id]['generation_thread'].start()
+        lollmsElfServer.connections[client_id]['generation_job'] = lollmsElfServer.scheduler.submit(lollmsElfServer.start_message_generation, message, message.id, client_id, True, client_id=client_id)
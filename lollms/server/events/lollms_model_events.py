@@ -15,7 +15,7 @@ from fastapi.responses import FileResponse
 from lollms.binding import BindingBuilder, InstallOption
 from ascii_colors import ASCIIColors
 from lollms.personality import MSG_TYPE, AIPersonality
-from lollms.utilities import load_config, trace_exception, gc, terminate_thread, run_async
+from lollms.utilities import load_config, trace_exception, gc, terminate_thread
 from pathlib import Path
 from typing import List
 import socketio
@@ -55,13 +55,12 @@ def add_events(sio:socketio):
         model_name = filename
 
         if not installation_path.exists():
-            run_async( partial(sio.emit,'uninstall_progress',{
+            lollmsElfServer.emit_bridge.emit('uninstall_progress',{
                                                 'status': False,
                                                 'error': 'The model does not exist',
                                                 'model_name' : model_name,
                                                 'binding_folder' : binding_folder
                                             }, room=sid)
-            )
         try:
             if not installation_path.exists():
                 # Try to find a version
@@ -75,23 +74,21 @@ def add_events(sio:socketio):
                 shutil.rmtree(installation_path)
             else:
                 installation_path.unlink()
-            run_async( partial(sio.emit,'uninstall_progress',{
+            lollmsElfServer.emit_bridge.emit('uninstall_progress',{
                                                 'status': True, 
                                                 'error': '',
                                                 'model_name' : model_name,
                                                 'binding_folder' : binding_folder
                                             }, room=sid)
-            )
         except Exception as ex:
             trace_exception(ex)
             ASCIIColors.error(f"Couldn't delete {installation_path}, please delete it manually and restart the app")
-            run_async( partial(sio.emit,'uninstall_progress',{
+            lollmsElfServer.emit_bridge.emit('uninstall_progress',{
                                                 'status': False, 
                                                 'error': f"Couldn't delete {installation_path}, please delete it manually and restart the app",
                                                 'model_name' : model_name,
                                                 'binding_folder' : binding_folder
                                             }, room=sid)
-            )
 
 
     @sio.on('cancel_install')
@@ -103,18 +100,16 @@ def add_events(sio:socketio):
             signature = f"{model_name}_{binding_folder}_{model_url}"
             lollmsElfServer.download_infos[signature]["cancel"]=True
 
-            run_async( partial(sio.emit,'canceled', {
+            lollmsElfServer.emit_bridge.emit('canceled', {
                                             'status': True
                                             },
                                             room=sid 
-                                ) 
-            )           
+                                )
         except Exception as ex:
             trace_exception(ex)
-            run_async( partial(sio.emit,'canceled', {
+            lollmsElfServer.emit_bridge.emit('canceled', {
                                             'status': False,
                                             'error':str(ex)
                                             },
                                             room=sid 
-                                )     
-            )       
+                                )       
@@ -16,7 +16,7 @@ from fastapi.responses import FileResponse
 from lollms.binding import BindingBuilder, InstallOption
 from ascii_colors import ASCIIColors
 from lollms.personality import MSG_TYPE, AIPersonality
-from lollms.utilities import load_config, trace_exception, gc, terminate_thread, run_async
+from lollms.utilities import load_config, trace_exception, gc, terminate_thread
 from pathlib import Path
 from typing import List
 import socketio
@@ -92,15 +92,14 @@ def add_events(sio:socketio):
                 result = lollmsElfServer.personality.add_file(file_path, partial(lollmsElfServer.process_chunk, client_id=client_id))
 
             ASCIIColors.success('File processed successfully')
-            run_async(partial(sio.emit,'file_received', {'status': True, 'filename': filename}))
+            lollmsElfServer.emit_bridge.emit('file_received', {'status': True, 'filename': filename})
         else:
-            run_async(partial(sio.emit,'request_next_chunk', {'offset': offset + len(chunk)}))
+            lollmsElfServer.emit_bridge.emit('request_next_chunk', {'offset': offset + len(chunk)})
 
 
     @sio.on('execute_command')
     def execute_command(sid, data):
         client_id = sid
-        lollmsElfServer.cancel_gen = False
         lollmsElfServer.connections[client_id]["generated_text"]=""
         lollmsElfServer.connections[client_id]["cancel_generation"]=False
         lollmsElfServer.connections[client_id]["continuing"]=False
@@ -111,27 +110,25 @@ def add_events(sio:socketio):
             lollmsElfServer.error("Model not selected. Please select a model", client_id=client_id)
             return
 
-        if not lollmsElfServer.busy:
-            if lollmsElfServer.connections[client_id]["current_discussion"] is None:
-                if lollmsElfServer.db.does_last_discussion_have_messages():
-                    lollmsElfServer.connections[client_id]["current_discussion"] = lollmsElfServer.db.create_discussion()
-                else:
-                    lollmsElfServer.connections[client_id]["current_discussion"] = lollmsElfServer.db.load_last_discussion()
-
-            ump = lollmsElfServer.config.discussion_prompt_separator +lollmsElfServer.config.user_name.strip() if lollmsElfServer.config.use_user_name_in_discussions else lollmsElfServer.personality.user_message_prefix
-            message = lollmsElfServer.connections[client_id]["current_discussion"].add_message(
-                message_type    = MSG_TYPE.MSG_TYPE_FULL.value,
-                sender_type     = SENDER_TYPES.SENDER_TYPES_USER.value,
-                sender          = ump.replace(lollmsElfServer.config.discussion_prompt_separator,"").replace(":",""),
-                content="",
-                metadata=None,
-                parent_message_id=lollmsElfServer.message_id
-            )
-            lollmsElfServer.busy=True
-
-            client_id = sid
-            command = data["command"]
-            parameters = data["parameters"]
+        if lollmsElfServer.connections[client_id]["current_discussion"] is None:
+            if lollmsElfServer.db.does_last_discussion_have_messages():
+                lollmsElfServer.connections[client_id]["current_discussion"] = lollmsElfServer.db.create_discussion()
+            else:
+                lollmsElfServer.connections[client_id]["current_discussion"] = lollmsElfServer.db.load_last_discussion()
+
+        ump = lollmsElfServer.config.discussion_prompt_separator +lollmsElfServer.config.user_name.strip() if lollmsElfServer.config.use_user_name_in_discussions else lollmsElfServer.personality.user_message_prefix
+        message = lollmsElfServer.connections[client_id]["current_discussion"].add_message(
+            message_type    = MSG_TYPE.MSG_TYPE_FULL.value,
+            sender_type     = SENDER_TYPES.SENDER_TYPES_USER.value,
+            sender          = ump.replace(lollmsElfServer.config.discussion_prompt_separator,"").replace(":",""),
+            content="",
+            metadata=None,
+            parent_message_id=lollmsElfServer.message_id
+        )
+
+        command = data["command"]
+        parameters = data["parameters"]
+        def do_command():
             lollmsElfServer.prepare_reception(client_id)
             if lollmsElfServer.personality.processor is not None:
                 lollmsElfServer.start_time = datetime.now()
@@ -140,13 +137,5 @@ def add_events(sio:socketio):
             else:
                 lollmsElfServer.warning("Non scripted personalities do not support commands",client_id=client_id)
             lollmsElfServer.close_message(client_id)
-            lollmsElfServer.busy=False
-
-            #tpe = threading.Thread(target=lollmsElfServer.start_message_generation, args=(message, message_id, client_id))
-            #tpe.start()
-        else:
-            lollmsElfServer.error("I am busy. Come back later.", client_id=client_id)
-
-        lollmsElfServer.busy=False
 
-    
\ No newline at end of file
+        lollmsElfServer.connections[client_id]['generation_job'] = lollmsElfServer.scheduler.submit(do_command, client_id=client_id)
@@ -15,7 +15,10 @@ from fastapi.responses import FileResponse
 from lollms.binding import BindingBuilder, InstallOption
 from ascii_colors import ASCIIColors
 from lollms.personality import MSG_TYPE, AIPersonality
-from lollms.utilities import load_config, trace_exception, gc, terminate_thread, run_async
+from lollms.utilities import load_config, trace_exception, gc, terminate_thread
+from lollms.embeddings import index_vectorizer
+from lollms.tracing import tracer
+from lollms.scheduler import SchedulerLane
 from pathlib import Path
 from typing import List
 import socketio
@@ -35,7 +38,7 @@ def add_events(sio:socketio):
     def upgrade_vectorization():
         if lollmsElfServer.config.data_vectorization_activate and lollmsElfServer.config.activate_ltm:
             try:
-                run_async(partial(sio.emit,'show_progress'))
+                lollmsElfServer.emit_bridge.emit('show_progress')
                 lollmsElfServer.sio.sleep(0)
                 ASCIIColors.yellow("0- Detected discussion vectorization request")
                 folder = lollmsElfServer.lollms_paths.personal_discussions_path/"vectorized_dbs"
@@ -48,14 +51,15 @@ def add_events(sio:socketio):
                 index = 0
                 nb_discussions = len(discussions)
                 for (title,discussion) in tqdm(discussions):
-                    run_async(partial(sio.emit,'update_progress',{'value':int(100*(index/nb_discussions))}))
+                    lollmsElfServer.emit_bridge.emit('update_progress',{'value':int(100*(index/nb_discussions))})
                     lollmsElfServer.sio.sleep(0)
                     index += 1
                     if discussion!='':
-                        skill = lollmsElfServer.learn_from_discussion(title, discussion)
-                        lollmsElfServer.long_term_memory.add_document(title, skill, chunk_size=lollmsElfServer.config.data_vectorization_chunk_size, overlap_size=lollmsElfServer.config.data_vectorization_overlap_size, force_vectorize=False, add_as_a_bloc=False)
+                        skill = lollmsElfServer.learn_from_discussion(title, discussion, lane=SchedulerLane.BACKGROUND)
+                        with tracer.span("vectorizer.add_document", document=title):
+                            lollmsElfServer.long_term_memory.add_document(title, skill, chunk_size=lollmsElfServer.config.data_vectorization_chunk_size, overlap_size=lollmsElfServer.config.data_vectorization_overlap_size, force_vectorize=False, add_as_a_bloc=False)
                 ASCIIColors.yellow("3- Indexing database")
-                lollmsElfServer.long_term_memory.index()
+                index_vectorizer(lollmsElfServer.long_term_memory, lollmsElfServer.config.embedding_batch_size, lollmsElfServer.embedding_batcher)
                 ASCIIColors.yellow("4- Saving database")
                 lollmsElfServer.long_term_memory.save_to_json()
                 
@@ -64,5 +68,5 @@ def add_events(sio:socketio):
                 ASCIIColors.yellow("Ready")
             except Exception as ex:
                 ASCIIColors.error(f"Couldn't vectorize database:{ex}")
-        run_async(partial(sio.emit,'hide_progress'))     
+        lollmsElfServer.emit_bridge.emit('hide_progress')
         lollmsElfServer.sio.sleep(0)
\ No newline at end of file
@@ -29,6 +29,7 @@ from typing import List, Dict, Any
 from ascii_colors import ASCIIColors, trace_exception
 from lollms.paths import LollmsPaths
 from lollms.utilities import git_pull
+from lollms.tracing import trace_http, traced_session
 import subprocess
 
 
@@ -273,7 +274,7 @@ class LollmsSD:
         self.default_sampler = sampler
         self.default_steps = steps
 
-        self.session = requests.Session()
+        self.session = traced_session("sd")
 
         if username and password:
             self.set_auth(username, password)
@@ -1389,7 +1390,9 @@ class ControlNetInterface:
         }
 
         try:
-            response = requests.post(url, json=data, headers=headers)
+            with trace_http("sd", "POST", url) as span:
+                response = requests.post(url, json=data, headers=headers)
+                span.set_attribute("http.status_code", response.status_code)
 
             # Check if the request was successful (status code 200)
             if response.status_code == 200:
@@ -1490,7 +1493,9 @@ class ControlNetInterface:
         }
 
         try:
-            response = requests.post(url, json=data, headers=headers)
+            with trace_http("sd", "POST", url) as span:
+                response = requests.post(url, json=data, headers=headers)
+                span.set_attribute("http.status_code", response.status_code)
 
             # Check if the request was successful (status code 200)
             if response.status_code == 200:
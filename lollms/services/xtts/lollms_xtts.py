@@ -30,6 +30,7 @@ from typing import List, Dict, Any
 from ascii_colors import ASCIIColors, trace_exception
 from lollms.paths import LollmsPaths
 from lollms.utilities import git_pull
+from lollms.tracing import trace_http
 import subprocess
 import platform
 
@@ -179,7 +180,9 @@ class LollmsXTTS:
         }
 
         # Send the POST request
-        response = requests.post(url, json=payload)
+        with trace_http("xtts", "POST", url) as span:
+            response = requests.post(url, json=payload)
+            span.set_attribute("http.status_code", response.status_code)
 
         # Check the response status code
         if response.status_code == 200:
@@ -206,7 +209,9 @@ class LollmsXTTS:
         }
 
         # Send the POST request
-        response =  requests.post(url, headers=headers, data=json.dumps(payload))
+        with trace_http("xtts", "POST", url) as span:
+            response =  requests.post(url, headers=headers, data=json.dumps(payload))
+            span.set_attribute("http.status_code", response.status_code)
 
         # Check the response status code
         if response.status_code == 200:
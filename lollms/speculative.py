@@ -0,0 +1,234 @@
+######
+# Project       : lollms
+# File          : speculative.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Speculative decoding. A small draft model proposes a few tokens and the main
+# model verifies all of them in one forward pass. Every emitted token is the
+# one the main model picks, the draft model only saves main model passes when
+# it guesses right.
+######
+from ascii_colors import ASCIIColors
+from lollms.main_config import LOLLMSConfig
+from lollms.binding import LLMBinding, BindingBuilder, ModelBuilder
+from lollms.types import MSG_TYPE
+from lollms.generation import TOKEN_USAGE, track_usage
+from collections import deque
+from typing import Callable
+import threading
+import time
+
+# Number of already emitted tokens detokenized again with the new ones (a character can
+# span several tokens and some tokenizers change the spacing of a token depending on
+# the previous one)
+DETOKENIZE_LOOKBACK = 4
+
+
+def build_draft_binding(app, binding_name:str, model_name:str) -> LLMBinding:
+    """
+    Builds the binding of the draft model and loads the model.
+
+    Args:
+        app (LollmsApplication): The application (provides the configuration and paths).
+        binding_name (str): Binding of the draft model (None to use the binding of the main model).
+        model_name (str): Name of the draft model.
+
+    Returns:
+        LLMBinding: The draft binding with its model loaded.
+    """
+    # The binding reads the model name from its configuration so it needs its own copy
+    config = LOLLMSConfig(lollms_paths=app.lollms_paths)
+    config.config = dict(app.config.config)
+    config["binding_name"] = binding_name or app.config.binding_name
+    config["model_name"] = model_name
+    binding = BindingBuilder().build_binding(config, app.lollms_paths, lollmsCom=app)
+    if ModelBuilder(binding).get_model() is None:
+        raise RuntimeError(f"Binding {config.binding_name} couldn't build draft model {model_name}")
+    return binding
+
+
+class SpeculativeDecoder:
+    """
+    Generates text with a main binding and a draft binding sharing the same tokenizer.
+
+    When the acceptance rate of the draft tokens falls below `min_acceptance_rate`, the
+    decoder falls back to the plain generation of the main binding for `fallback_duration`
+    seconds before trying again.
+
+    The draft model is called through score_tokens with the whole context for each
+    proposed token, and the main model with the whole context for each verification
+    pass. The speedup relies on the bindings reusing the KV cache of the prefix they
+    processed in their previous call (as llama.cpp based bindings do). A binding that
+    processes the full context on every score_tokens call makes each draft token cost
+    a full prefill and is slower with speculative decoding than without it.
+
+    Args:
+        binding (LLMBinding): The main model (must support token scoring).
+        draft_binding (LLMBinding): The draft model (must support token scoring).
+        nb_draft_tokens (int): Number of tokens proposed by the draft model per verification pass.
+        min_acceptance_rate (float): Acceptance rate under which speculative decoding is disabled.
+        window (int): Number of recent draft tokens used to compute the acceptance rate.
+        fallback_duration (float): Time in seconds during which the plain generation is used after a fallback.
+    """
+    def __init__(
+                    self,
+                    binding:LLMBinding,
+                    draft_binding:LLMBinding,
+                    nb_draft_tokens:int=4,
+                    min_acceptance_rate:float=0.4,
+                    window:int=200,
+                    fallback_duration:float=300
+                ) -> None:
+        self.binding                = binding
+        self.draft_binding          = draft_binding
+        self.nb_draft_tokens        = max(1, nb_draft_tokens)
+        self.min_acceptance_rate    = min_acceptance_rate
+        self.fallback_duration      = fallback_duration
+
+        self.proposed_tokens        = 0
+        self.accepted_tokens        = 0
+        self.verification_passes    = 0
+        self.fallbacks              = 0
+        self.fallback_until         = 0
+        # 1 for accepted draft tokens, 0 for rejected ones
+        self._recent                = deque(maxlen=window)
+        self._lock                  = threading.Lock()
+
+    @property
+    def acceptance_rate(self) -> float:
+        with self._lock:
+            return sum(self._recent)/len(self._recent) if len(self._recent)>0 else 1.0
+
+    @property
+    def active(self) -> bool:
+        return time.time()>=self.fallback_until
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                "active": time.time()>=self.fallback_until,
+                "nb_draft_tokens": self.nb_draft_tokens,
+                "proposed_tokens": self.proposed_tokens,
+                "accepted_tokens": self.accepted_tokens,
+                "verification_passes": self.verification_passes,
+                "acceptance_rate": sum(self._recent)/len(self._recent) if len(self._recent)>0 else 1.0,
+                "total_acceptance_rate": self.accepted_tokens/self.proposed_tokens if self.proposed_tokens>0 else 0,
+                "fallbacks": self.fallbacks,
+            }
+
+    def _record(self, nb_proposed:int, nb_accepted:int) -> bool:
+        """Updates the statistics and returns False if the decoder must fall back."""
+        with self._lock:
+            self.proposed_tokens += nb_proposed
+            self.accepted_tokens += nb_accepted
+            self.verification_passes += 1
+            self._recent.extend([1]*nb_accepted + [0]*(nb_proposed-nb_accepted))
+            if len(self._recent)==self._recent.maxlen and sum(self._recent)/len(self._recent)<self.min_acceptance_rate:
+                self.fallbacks += 1
+                self.fallback_until = time.time() + self.fallback_duration
+                self._recent.clear()
+                return False
+        return True
+
+    def generate(self, prompt:str, n_predict:int=128, callback:Callable[[str, MSG_TYPE], bool]=None, verbose:bool=False, **gpt_params) -> str:
+        """
+        Same contract as LLMBinding.generate.
+        """
+        if not self.active:
+            return self.binding.generate(prompt, n_predict, callback=callback, verbose=verbose, **gpt_params)
+
+        prompt_tokens = self.binding.tokenize(prompt)
+        output, nb_tokens = self._generate(prompt, prompt_tokens, n_predict, callback, verbose, **gpt_params)
+        if nb_tokens is not None:
+            self.binding.report_usage(len(prompt_tokens), nb_tokens)
+        return output
+
+    def _generate(self, prompt:str, prompt_tokens:list, n_predict:int, callback:Callable[[str, MSG_TYPE], bool], verbose:bool, **gpt_params):
+        """Returns the output and the number of generated tokens (None if unknown)."""
+        generated = []
+        output = ""
+        detokenizer = IncrementalDetokenizer(self.binding)
+        while len(generated)<n_predict:
+            # The draft model proposes tokens one by one (see the class docstring for the cost of each call)
+            context = prompt_tokens + generated
+            candidates = []
+            for _ in range(min(self.nb_draft_tokens, n_predict-len(generated))):
+                token = self.draft_binding.score_tokens(context + candidates, 0, **gpt_params)[0]
+                if token is None:
+                    break
+                candidates.append(token)
+
+            # The main model verifies them in one pass
+            predictions = self.binding.score_tokens(context + candidates, len(candidates), **gpt_params)
+            nb_accepted = 0
+            while nb_accepted<len(candidates) and predictions[nb_accepted]==candidates[nb_accepted]:
+                nb_accepted += 1
+            # The main model's token at the first mismatch (or after the last candidate) comes for free
+            new_tokens = candidates[:nb_accepted] + [predictions[nb_accepted]]
+            keep_going = self._record(len(candidates), nb_accepted) if len(candidates)>0 else True
+
+            for token in new_tokens:
+                if token is None or len(generated)>=n_predict:
+                    return self._flush(detokenizer, output, callback), len(generated)
+                generated.append(token)
+                chunk = detokenizer.add(token)
+                output += chunk
+                if callback is not None and chunk and callback(chunk, MSG_TYPE.MSG_TYPE_CHUNK) is False:
+                    return output, len(generated)
+
+            if not keep_going:
+                output = self._flush(detokenizer, output, callback)
+                ASCIIColors.warning(f"Speculative decoding: acceptance rate too low, falling back to plain decoding for {self.fallback_duration}s")
+                # Finish this generation with the optimized generate of the main binding
+                remaining = TOKEN_USAGE()
+                with track_usage(remaining):
+                    output += self.binding.generate(prompt + output, n_predict-len(generated), callback=callback, verbose=verbose, **gpt_params)
+                return output, len(generated)+remaining.completion_tokens if remaining.exact else None
+        return output, len(generated)
+
+    def _flush(self, detokenizer:"IncrementalDetokenizer", output:str, callback:Callable[[str, MSG_TYPE], bool]) -> str:
+        """Sends the text held back by the detokenizer and returns the complete output."""
+        chunk = detokenizer.flush()
+        if callback is not None and chunk:
+            callback(chunk, MSG_TYPE.MSG_TYPE_CHUNK)
+        return output + chunk
+
+
+class IncrementalDetokenizer:
+    """
+    Turns a stream of tokens into text chunks without detokenizing the whole output for
+    every token: only the new tokens and the last DETOKENIZE_LOOKBACK emitted ones are
+    detokenized. Tokens ending with an incomplete character are held back until the
+    character is complete.
+
+    Args:
+        binding (LLMBinding): The binding whose detokenize is used.
+    """
+    def __init__(self, binding:LLMBinding) -> None:
+        self.binding        = binding
+        self.tokens         = []
+        # tokens[prefix_offset:read_offset] were emitted and are only detokenized again as context
+        self.prefix_offset  = 0
+        self.read_offset    = 0
+
+    def add(self, token) -> str:
+        """Adds a token and returns the text that can be emitted (possibly empty)."""
+        self.tokens.append(token)
+        prefix_text = self.binding.detokenize(self.tokens[self.prefix_offset:self.read_offset])
+        text = self.binding.detokenize(self.tokens[self.prefix_offset:])
+        if len(text)<=len(prefix_text) or text.endswith("\ufffd"):
+            # Incomplete character, wait for the next tokens
+            return ""
+        self.read_offset = len(self.tokens)
+        self.prefix_offset = max(0, self.read_offset-DETOKENIZE_LOOKBACK)
+        return text[len(prefix_text):]
+
+    def flush(self) -> str:
+        """Returns the text of the held back tokens (end of the generation)."""
+        if self.read_offset==len(self.tokens):
+            return ""
+        prefix_text = self.binding.detokenize(self.tokens[self.prefix_offset:self.read_offset])
+        text = self.binding.detokenize(self.tokens[self.prefix_offset:])
+        self.read_offset = len(self.tokens)
+        return text[len(prefix_text):]
@@ -0,0 +1,143 @@
+######
+# Project       : lollms
+# File          : tokenizer_cache.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Memoizing layer around LLMBinding.tokenize/detokenize. Building a prompt
+# tokenizes the same texts (conditioning, templates, discussion parts) many
+# times, and for remote bindings every call is an HTTP round trip.
+######
+from collections import OrderedDict
+from typing import Any
+from lollms.generation import timed_span
+import threading
+import hashlib
+import sys
+
+
+def _as_list(tokens) -> list:
+    """Tokens returned by a binding (list, tensor, ndarray...) as a list of python scalars."""
+    return tokens.tolist() if hasattr(tokens, "tolist") else list(tokens)
+
+
+class TokenizerCache:
+    """
+    Bounded LRU cache of tokenize/detokenize results.
+
+    Texts are keyed by their blake2b digest (the text itself is not kept) and
+    token lists by their tuple. The model name is part of every key so that
+    switching models never returns tokens from another vocabulary.
+
+    Args:
+        binding (LLMBinding): The binding whose tokenizer is memoized.
+        max_memory (int): Approximate memory budget in bytes (0 disables the cache).
+    """
+    def __init__(self, binding:Any, max_memory:int=32*1024*1024) -> None:
+        self.binding        = binding
+        self.max_memory     = max_memory
+        self.memory         = 0
+        self.hits           = 0
+        self.misses         = 0
+
+        self._entries:OrderedDict = OrderedDict()
+        self._lock          = threading.Lock()
+
+    @timed_span("tokenization")
+    def tokenize(self, prompt:str) -> list:
+        """
+        Same as LLMBinding.tokenize but memoized. The tokens are always returned as a list
+        of python scalars (tensors and arrays are converted), which the caller can modify.
+        """
+        if self.max_memory<=0:
+            return _as_list(self.binding.tokenize(prompt))
+        key = ("t", self.binding.config.model_name, hashlib.blake2b(prompt.encode("utf-8", errors="surrogatepass"), digest_size=16).digest())
+        tokens = self._get(key)
+        if tokens is None:
+            tokens = _as_list(self.binding.tokenize(prompt))
+            self._put(key, tuple(tokens), 64+8*len(tokens))
+            return tokens
+        return list(tokens)
+
+    @timed_span("tokenization")
+    def detokenize(self, tokens_list:list) -> str:
+        """Same as LLMBinding.detokenize but memoized."""
+        if self.max_memory<=0:
+            return self.binding.detokenize(tokens_list)
+        try:
+            key = ("d", self.binding.config.model_name, tuple(tokens_list))
+            hash(key)
+        except TypeError:
+            # Unhashable tokens (tensors...)
+            return self.binding.detokenize(tokens_list)
+        text = self._get(key)
+        if text is None:
+            text = self.binding.detokenize(tokens_list)
+            self._put(key, text, 64+8*len(tokens_list)+sys.getsizeof(text))
+        return text
+
+    async def atokenize(self, prompt:str) -> list:
+        """Same as tokenize, the tokenizer of the binding is called with LLMBinding.atokenize."""
+        if self.max_memory<=0:
+            return _as_list(await self.binding.atokenize(prompt))
+        key = ("t", self.binding.config.model_name, hashlib.blake2b(prompt.encode("utf-8", errors="surrogatepass"), digest_size=16).digest())
+        tokens = self._get(key)
+        if tokens is None:
+            tokens = _as_list(await self.binding.atokenize(prompt))
+            self._put(key, tuple(tokens), 64+8*len(tokens))
+            return tokens
+        return list(tokens)
+
+    async def adetokenize(self, tokens_list:list) -> str:
+        """Same as detokenize, the tokenizer of the binding is called with LLMBinding.adetokenize."""
+        if self.max_memory<=0:
+            return await self.binding.adetokenize(tokens_list)
+        try:
+            key = ("d", self.binding.config.model_name, tuple(tokens_list))
+            hash(key)
+        except TypeError:
+            # Unhashable tokens (tensors...)
+            return await self.binding.adetokenize(tokens_list)
+        text = self._get(key)
+        if text is None:
+            text = await self.binding.adetokenize(tokens_list)
+            self._put(key, text, 64+8*len(tokens_list)+sys.getsizeof(text))
+        return text
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.memory = 0
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "memory": self.memory,
+                "max_memory": self.max_memory,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _put(self, key, value, size:int):
+        if size>self.max_memory:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.memory -= previous[1]
+            self._entries[key] = (value, size)
+            self.memory += size
+            while self.memory>self.max_memory:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.memory -= evicted_size
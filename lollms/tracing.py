@@ -0,0 +1,378 @@
+######
+# Project       : lollms
+# File          : tracing.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Opt-in span tracing. Spans are opened with `tracer.span(name)` (or the
+# `traced` decorator), nest per thread and are exported in the background to a
+# JSON lines file or to an OTLP/HTTP collector. Only a fraction of the traces
+# (sample_rate) is recorded and nothing is recorded when tracing is disabled.
+######
+from ascii_colors import ASCIIColors
+from lollms.utilities import trace_exception
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from typing import Dict, List
+import threading
+import random
+import queue
+import json
+import time
+import os
+
+
+class Span:
+    """A timed operation. Spans opened while another one is active on the same thread become its children."""
+    def __init__(self, name:str, trace_id:str, parent_id:str=None, attributes:dict=None) -> None:
+        self.name           = name
+        self.trace_id       = trace_id
+        self.span_id        = os.urandom(8).hex()
+        self.parent_id      = parent_id
+        self.attributes     = dict(attributes) if attributes else {}
+        self.start_time     = time.time_ns()
+        self.end_time       = None
+        self.error          = None
+
+    def set_attribute(self, name:str, value):
+        self.attributes[name] = value
+
+    @property
+    def duration(self) -> float:
+        """Duration in seconds (None while the span is open)."""
+        return (self.end_time-self.start_time)/1e9 if self.end_time is not None else None
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _UnsampledSpan:
+    """Placeholder of a trace that is not recorded (its children are not recorded either)."""
+    trace_id    = None
+    span_id     = None
+
+    def set_attribute(self, name:str, value):
+        pass
+
+_UNSAMPLED = _UnsampledSpan()
+
+
+class JSONLinesExporter:
+    """Appends the finished spans to a file, one JSON object per line."""
+    def __init__(self, path:str|Path) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def export(self, spans:List[Span]):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), default=str) + "\n")
+
+
+class OTLPExporter:
+    """
+    Sends the finished spans to an OpenTelemetry collector with the OTLP/HTTP JSON protocol.
+
+    Args:
+        endpoint (str): Traces endpoint of the collector (usually http://host:4318/v1/traces).
+        service_name (str): Name of the service reported in the resource of the spans.
+        timeout (float): Timeout of the export requests in seconds.
+    """
+    def __init__(self, endpoint:str="http://localhost:4318/v1/traces", service_name:str="lollms", timeout:float=5) -> None:
+        self.endpoint       = endpoint
+        self.service_name   = service_name
+        self.timeout        = timeout
+
+    @staticmethod
+    def _value(value) -> dict:
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def encode(self, spans:List[Span]) -> dict:
+        otlp_spans = []
+        for span in spans:
+            otlp_span = {
+                "traceId": span.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1, # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(span.start_time),
+                "endTimeUnixNano": str(span.end_time),
+                "attributes": [{"key": key, "value": self._value(value)} for key, value in span.attributes.items()],
+                # STATUS_CODE_OK or STATUS_CODE_ERROR
+                "status": {"code": 2, "message": span.error} if span.error is not None else {"code": 1},
+            }
+            if span.parent_id is not None:
+                otlp_span["parentSpanId"] = span.parent_id
+            otlp_spans.append(otlp_span)
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{"scope": {"name": "lollms"}, "spans": otlp_spans}],
+            }]
+        }
+
+    def export(self, spans:List[Span]):
+        import requests
+        response = requests.post(self.endpoint, json=self.encode(spans), timeout=self.timeout)
+        response.raise_for_status()
+
+
+class Tracer:
+    """
+    Records spans and exports them in the background.
+
+    The sampling decision is taken when a trace starts (a span opened with no active
+    parent on the thread) and applies to all the spans of the trace. When the export
+    queue is full, the new spans are dropped instead of slowing down the generation.
+
+    Args:
+        exporter: Object with an export(spans) method (None disables tracing).
+        sample_rate (float): Fraction of the traces that are recorded (0 to 1).
+        max_queue_size (int): Maximum number of finished spans waiting to be exported.
+        flush_interval (float): Maximum time in seconds a finished span waits before being exported.
+    """
+    def __init__(self, exporter=None, sample_rate:float=1.0, max_queue_size:int=10000, flush_interval:float=1.0) -> None:
+        self.exporter       = exporter
+        self.sample_rate    = sample_rate
+        self.flush_interval = flush_interval
+        self.nb_spans       = 0
+        self.nb_dropped     = 0
+
+        self._local         = threading.local()
+        self._queue         = queue.Queue(max_queue_size)
+        self._thread        = None
+        self._lock          = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None and self.sample_rate>0
+
+    def configure(self, exporter, sample_rate:float=1.0):
+        """Changes the exporter (None disables tracing) and the sampling rate."""
+        self.flush()
+        self.exporter = exporter
+        self.sample_rate = min(max(sample_rate, 0), 1)
+
+    def _stack(self) -> list:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def current_span(self) -> Span:
+        """The innermost recorded span of the calling thread (None if there is none)."""
+        stack = self._stack()
+        return stack[-1] if len(stack)>0 and isinstance(stack[-1], Span) else None
+
+    @contextmanager
+    def span(self, name:str, **attributes):
+        """
+        Opens a span for the duration of the with block.
+
+        Args:
+            name (str): Name of the operation.
+            **attributes: Attributes of the span.
+
+        Yields:
+            Span: The span (an object ignoring the attributes if the trace is not sampled).
+        """
+        if not self.enabled:
+            yield _UNSAMPLED
+            return
+        stack = self._stack()
+        parent = stack[-1] if len(stack)>0 else None
+        if parent is None:
+            span = Span(name, os.urandom(16).hex(), None, attributes) if random.random()<self.sample_rate else _UNSAMPLED
+        elif parent is _UNSAMPLED:
+            span = _UNSAMPLED
+        else:
+            span = Span(name, parent.trace_id, parent.span_id, attributes)
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as ex:
+            if span is not _UNSAMPLED:
+                span.error = f"{type(ex).__name__}: {ex}"
+            raise
+        finally:
+            stack.pop()
+            if span is not _UNSAMPLED:
+                span.end_time = time.time_ns()
+                self._finish(span)
+
+    def _finish(self, span:Span):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._export_loop, name="lollms-tracing-exporter", daemon=True)
+                self._thread.start()
+            self.nb_spans += 1
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            with self._lock:
+                self.nb_dropped += 1
+
+    def _export(self, spans:List[Span]):
+        exporter = self.exporter
+        if exporter is None or len(spans)==0:
+            return
+        try:
+            exporter.export(spans)
+        except Exception as ex:
+            ASCIIColors.warning(f"Couldn't export {len(spans)} spans: {ex}")
+
+    def _export_loop(self):
+        while True:
+            spans = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining<=0:
+                    break
+                try:
+                    span = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if span is None:
+                    break
+                spans.append(span)
+            flushed = [span for span in spans if isinstance(span, threading.Event)]
+            self._export([span for span in spans if isinstance(span, Span)])
+            for event in flushed:
+                event.set()
+
+    def flush(self, timeout:float=5):
+        """Waits until the spans finished before this call are exported."""
+        if self._thread is None:
+            return
+        event = threading.Event()
+        try:
+            self._queue.put(event, timeout=timeout)
+            # Wakes up the exporter if it is waiting for more spans
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        event.wait(timeout)
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "sample_rate": self.sample_rate,
+                "exporter": type(self.exporter).__name__ if self.exporter is not None else None,
+                "spans": self.nb_spans,
+                "dropped_spans": self.nb_dropped,
+                "pending_spans": self._queue.qsize(),
+            }
+
+
+# Tracer of the application (disabled until setup_tracing is called)
+tracer = Tracer()
+
+
+def traced(name:str, **attributes):
+    """Decorator recording a span with the tracer of the application for each call of the function."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return fn(*args, **kwargs)
+            with tracer.span(name, **attributes):
+                return fn(*args, **kwargs)
+        wrapper.__traced__ = True
+        return wrapper
+    return decorator
+
+
+def trace_overrides(cls, names:Dict[str, str], **attributes):
+    """
+    Wraps the methods a subclass defines with `traced`. Used by base classes whose methods
+    are overridden by bindings, personalities and extensions. The spans also carry the
+    function and the file defining it (code.function and code.filepath).
+
+    Args:
+        cls (type): The subclass (from __init_subclass__).
+        names (dict): Method name -> span name.
+        **attributes: Attributes of the spans.
+    """
+    for method_name, span_name in names.items():
+        method = cls.__dict__.get(method_name)
+        if callable(method) and not getattr(method, "__traced__", False):
+            code = getattr(method, "__code__", None)
+            code_attributes = {"code.function": method.__qualname__, "code.filepath": code.co_filename} if code is not None else {}
+            setattr(cls, method_name, traced(span_name, **attributes, **code_attributes)(method))
+
+
+@contextmanager
+def trace_http(service:str, method:str, url:str):
+    """Span of an HTTP call to a service (set the status code with span.set_attribute("http.status_code", ...))."""
+    with tracer.span("service.http", **{"service":service, "http.method":method.upper(), "http.url":url}) as span:
+        yield span
+
+
+def traced_session(service:str):
+    """
+    Builds a requests.Session recording a span for each HTTP call it makes.
+
+    Args:
+        service (str): Name of the service reported in the spans.
+
+    Returns:
+        requests.Session: The session.
+    """
+    import requests
+
+    class TracedSession(requests.Session):
+        def request(self, method, url, *args, **kwargs):
+            if not tracer.enabled:
+                return super().request(method, url, *args, **kwargs)
+            with trace_http(service, method, str(url)) as span:
+                response = super().request(method, url, *args, **kwargs)
+                span.set_attribute("http.status_code", response.status_code)
+                return response
+
+    return TracedSession()
+
+
+def setup_tracing(config, lollms_paths) -> Tracer:
+    """
+    Configures the tracer of the application from the configuration.
+
+    Args:
+        config (LOLLMSConfig): Configuration (tracing_enabled, tracing_sample_rate, tracing_exporter, tracing_otlp_endpoint).
+        lollms_paths (LollmsPaths): Paths of the application (the JSON lines file goes to the logs folder).
+
+    Returns:
+        Tracer: The tracer of the application.
+    """
+    if not config.tracing_enabled:
+        tracer.configure(None)
+        return tracer
+    try:
+        if config.tracing_exporter=="otlp":
+            exporter = OTLPExporter(config.tracing_otlp_endpoint)
+        else:
+            exporter = JSONLinesExporter(lollms_paths.personal_log_path/"traces.jsonl")
+        tracer.configure(exporter, config.tracing_sample_rate)
+        ASCIIColors.info(f"Tracing enabled ({type(exporter).__name__}, sample rate {tracer.sample_rate})")
+    except Exception as ex:
+        trace_exception(ex)
+        tracer.configure(None)
+    return tracer
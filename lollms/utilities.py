@@ -9,6 +9,7 @@
 # module.
 ######
 from ascii_colors import ASCIIColors, trace_exception
+from lollms.generation import timed_span
 from sklearn.feature_extraction.text import TfidfVectorizer
 import numpy as np
 from pathlib import Path
@@ -17,7 +18,9 @@ import re
 import subprocess
 import gc
 
-from typing import List
+from typing import List, Optional, Tuple
+from collections import deque
+from functools import lru_cache
 
 from PIL import Image
 import requests
@@ -327,6 +330,129 @@ def find_first_available_file_index(folder_path, prefix, extension=""):
 
 
 # Prompting tools
+class AntipromptDetector:
+    """
+    Streaming antiprompt matcher used by the hallucination suppression system.
+
+    The antiprompts are compiled once into an Aho-Corasick automaton (case insensitive).
+    Every call to `feed` only walks the newly received characters, the automaton state
+    carries the partial matches across chunk boundaries, so a whole generation is
+    scanned in O(n) instead of rescanning the full output on every token.
+
+    Args:
+        anti_prompts (list): The antiprompts to look for.
+    """
+    def __init__(self, anti_prompts:list=["!@>"]) -> None:
+        self.anti_prompts = [prompt.lower() for prompt in anti_prompts if prompt]
+        self.max_length = max([len(prompt) for prompt in self.anti_prompts], default=0)
+        self._build()
+        self.reset()
+
+    def _build(self):
+        # goto[state] : char -> state, output[state] : antiprompt (the shortest one ending here, earliest in the list)
+        # depth[state] : length of the antiprompt beginning that the state stands for
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [None]
+        self._depth = [0]
+        for prompt in self.anti_prompts:
+            state = 0
+            for c in prompt:
+                next_state = self._goto[state].get(c)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(None)
+                    self._depth.append(self._depth[state]+1)
+                    self._goto[state][c] = next_state
+                state = next_state
+            if self._output[state] is None:
+                self._output[state] = prompt
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and c not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(c, 0)
+                if self._output[next_state] is None:
+                    self._output[next_state] = self._output[self._fail[next_state]]
+
+    def reset(self):
+        """Restarts the detection on a new stream."""
+        self.state = 0
+        self.position = 0
+        self.match:Optional[Tuple[str, int]] = None
+        # Original offsets of the last lowered characters (lowering can change the length of some characters)
+        self._offsets = deque(maxlen=max(self.max_length, 1))
+
+    def _step(self, state:int, c:str) -> int:
+        while state and c not in self._goto[state]:
+            state = self._fail[state]
+        return self._goto[state].get(c, 0)
+
+    def feed(self, text:str) -> Optional[Tuple[str, int]]:
+        """
+        Scans newly received text.
+
+        Args:
+            text (str): The new chunk (appended to everything fed since the last reset).
+
+        Returns:
+            Optional[Tuple[str, int]]: The detected antiprompt and the offset, in the fed stream, where the text must be cut. None if no antiprompt was found.
+        """
+        if self.match is not None or not self.anti_prompts:
+            self.position += len(text)
+            return self.match
+        state = self.state
+        for i, c in enumerate(text):
+            for lc in c.lower():
+                state = self._step(state, lc)
+                self._offsets.append(self.position+i)
+                prompt = self._output[state]
+                if prompt is not None:
+                    self.match = (prompt, self._offsets[-len(prompt)])
+                    self.state = state
+                    self.position += len(text)
+                    return self.match
+        self.state = state
+        self.position += len(text)
+        return None
+
+    @property
+    def pending_offset(self) -> int:
+        """
+        Offset, in the fed stream, of the end of the text that may still be the beginning of an
+        antiprompt (the position of the stream when no antiprompt is in progress).
+        """
+        depth = self._depth[self.state]
+        if self.match is not None or depth==0:
+            return self.position
+        return self._offsets[-depth]
+
+    def clone(self) -> "AntipromptDetector":
+        """Returns a new detector on a fresh stream that shares the compiled automaton."""
+        detector = AntipromptDetector.__new__(AntipromptDetector)
+        detector.anti_prompts = self.anti_prompts
+        detector.max_length = self.max_length
+        detector._goto, detector._fail, detector._output, detector._depth = self._goto, self._fail, self._output, self._depth
+        detector.reset()
+        return detector
+
+    def search(self, text:str) -> Optional[Tuple[str, int]]:
+        """One shot search that does not touch the streaming state."""
+        return self.clone().feed(text)
+
+
+@lru_cache(maxsize=32)
+def get_antiprompt_detector(anti_prompts:tuple=("!@>",)) -> AntipromptDetector:
+    """Returns a shared detector compiled for these antiprompts (use `search`, or `clone` it before streaming)."""
+    return AntipromptDetector(list(anti_prompts))
+
+
 def detect_antiprompt(text:str, anti_prompts=["!@>"]) -> bool:
     """
     Detects if any of the antiprompts in self.anti_prompts are present in the given text.
@@ -338,10 +464,8 @@ def detect_antiprompt(text:str, anti_prompts=["!@>"]) -> bool:
     Returns:
         bool: True if any antiprompt is found in the text (ignoring case), False otherwise.
     """
-    for prompt in anti_prompts:
-        if prompt.lower() in text.lower():
-            return prompt.lower()
-    return None
+    match = get_antiprompt_detector(tuple(anti_prompts)).search(text)
+    return match[0] if match is not None else None
 
 
 def remove_text_from_string(string, text_to_find):
@@ -802,27 +926,14 @@ class PromptReshaper:
         for placeholder, text in placeholders.items():
             template = template.replace(placeholder, text)
         return template
+    @timed_span("prompt_building")
     def build(self, placeholders:dict, tokenize, detokenize, max_nb_tokens:int, place_holders_to_sacrifice:list=[])->str:
-        # Tokenize the template without placeholders
-        template_text = self.template
-        template_tokens = tokenize(template_text)
-        
-        # Calculate the number of tokens in the template without placeholders
-        template_tokens_count = len(template_tokens)
-        
-        # Calculate the number of tokens for each placeholder
-        placeholder_tokens_count = {}
-        all_count = template_tokens_count
-        for placeholder, text in placeholders.items():
-            text_tokens = tokenize(text)
-            placeholder_tokens_count[placeholder] = len(text_tokens)
-            all_count += placeholder_tokens_count[placeholder]
-
         def fill_template(template, data):
             for key, value in data.items():
                 placeholder = "{{" + key + "}}"
-                n_text_tokens = len(tokenize(template))
-                if key in place_holders_to_sacrifice:
+                if key in place_holders_to_sacrifice and placeholder in template:
+                    # Only the sacrificed placeholders need the size of the current template
+                    n_text_tokens = len(tokenize(template))
                     n_remaining = max_nb_tokens - n_text_tokens
                     t_value = tokenize(value)
                     n_value = len(t_value)
@@ -0,0 +1,383 @@
+"""
+project: lollms
+file: load_test.py
+author: ParisNeo
+description:
+    Load test of the lollms server. Concurrent virtual users send generation requests to
+    /lollms_generate, /v1/chat/completions and the socket.io generate_text event, then the
+    percentiles of the time to first token and of the total latency, the decoding speed and
+    the error rate of each scenario are reported and compared to the stored baselines.
+
+    With --serve, a server using the synthetic binding of this folder is started first so
+    the numbers only depend on the server (not on a real model).
+
+    usage:
+        python load_test.py --serve --concurrency 8 --requests 64
+        python load_test.py --serve --save-baseline       # stores the current numbers as the baselines
+        python load_test.py --host localhost --port 9600  # against a running server
+        python load_test.py --serve --no-check            # only reports the numbers
+"""
+import argparse
+import subprocess
+import threading
+import requests
+import socketio
+import json
+import math
+import time
+import sys
+import os
+from pathlib import Path
+
+
+SCENARIOS = ["lollms_generate", "chat_completions", "socketio"]
+VOCABULARY = ["the", "model", "server", "token", "request", "answer", "fast", "queue", "binding", "stream", "lollms", "prompt", "cache", "text", "of", "and", "a", "is"]
+# Metrics where a higher value is a regression (the other ones must not decrease)
+LOWER_IS_BETTER = ["ttft_p50", "ttft_p95", "ttft_p99", "latency_p50", "latency_p95", "latency_p99"]
+HIGHER_IS_BETTER = ["tokens_per_second_p50", "throughput"]
+
+
+class RequestResult:
+    """Measures of one request (times in seconds, ttft is None when the response is not streamed)."""
+    def __init__(self, ttft:float=None, latency:float=None, nb_tokens:int=0, error:str=None) -> None:
+        self.ttft       = ttft
+        self.latency    = latency
+        self.nb_tokens  = nb_tokens
+        self.error      = error
+
+
+def build_prompt(index:int, nb_words:int) -> str:
+    # The index makes every prompt different (no response cache hits)
+    return f"request {index}: " + " ".join(VOCABULARY[(index+i) % len(VOCABULARY)] for i in range(nb_words))
+
+
+def percentile(values:list, p:float) -> float:
+    """Nearest rank percentile (None for an empty list)."""
+    if len(values)==0:
+        return None
+    values = sorted(values)
+    rank = max(0, min(len(values)-1, math.ceil(p/100*len(values))-1))
+    return values[rank]
+
+
+# ----------------------------------- Virtual users -----------------------------------
+class LollmsGenerateUser:
+    """Sends requests to /lollms_generate. The tokens are counted as the words of the output."""
+    def __init__(self, url:str, stream:bool) -> None:
+        self.url        = url
+        self.stream     = stream
+        self.session    = requests.Session()
+
+    def generate(self, prompt:str, n_predict:int) -> RequestResult:
+        start = time.perf_counter()
+        response = self.session.post(f"{self.url}/lollms_generate", json={"prompt":prompt, "n_predict":n_predict, "stream":self.stream}, stream=self.stream)
+        if response.status_code!=200:
+            return RequestResult(error=f"HTTP {response.status_code}")
+        if not self.stream:
+            output = response.json()
+            if isinstance(output, dict):
+                return RequestResult(error=output.get("error", "no generation"))
+            return RequestResult(None, time.perf_counter()-start, len(output.split()))
+        ttft = None
+        output = ""
+        for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+            if chunk and ttft is None:
+                ttft = time.perf_counter()-start
+            output += chunk
+        if ttft is None:
+            return RequestResult(error="empty response")
+        return RequestResult(ttft, time.perf_counter()-start, len(output.split()))
+
+    def close(self):
+        self.session.close()
+
+
+class ChatCompletionsUser:
+    """Sends requests to /v1/chat/completions. The tokens are read from the usage of the response."""
+    def __init__(self, url:str, stream:bool) -> None:
+        self.url        = url
+        self.stream     = stream
+        self.session    = requests.Session()
+
+    def generate(self, prompt:str, n_predict:int) -> RequestResult:
+        start = time.perf_counter()
+        data = {"messages":[{"role":"user", "content":prompt}], "max_tokens":n_predict, "stream":self.stream}
+        response = self.session.post(f"{self.url}/v1/chat/completions", json=data, stream=self.stream)
+        if response.status_code!=200:
+            return RequestResult(error=f"HTTP {response.status_code}")
+        if not self.stream:
+            output = response.json()
+            if "usage" not in output:
+                return RequestResult(error=output.get("error", "no generation"))
+            return RequestResult(None, time.perf_counter()-start, output["usage"]["completion_tokens"])
+        ttft = None
+        nb_tokens = 0
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data: ") or line=="data: [DONE]":
+                continue
+            chunk = json.loads(line[len("data: "):])
+            if chunk.get("usage") is not None:
+                nb_tokens = chunk["usage"]["completion_tokens"]
+            elif ttft is None and any(choice.get("delta", {}).get("content") for choice in chunk.get("choices", [])):
+                ttft = time.perf_counter()-start
+        if ttft is None:
+            return RequestResult(error="empty response")
+        return RequestResult(ttft, time.perf_counter()-start, nb_tokens)
+
+    def close(self):
+        self.session.close()
+
+
+class SocketIOUser:
+    """Sends generate_text events on its own socket.io connection. The tokens are counted as the received chunks."""
+    def __init__(self, url:str, timeout:float=600) -> None:
+        self.timeout    = timeout
+        self.sio        = socketio.Client()
+        self._done      = threading.Event()
+        self._first     = None
+        self._chunks    = 0
+        self._error     = None
+
+        @self.sio.event
+        def text_chunk(data):
+            if self._first is None:
+                self._first = time.perf_counter()
+            self._chunks += 1
+
+        @self.sio.event
+        def text_generated(data):
+            self._done.set()
+
+        @self.sio.event
+        def generation_error(data):
+            self._error = data.get("error", "generation error")
+            self._done.set()
+
+        self.sio.connect(url)
+
+    def generate(self, prompt:str, n_predict:int) -> RequestResult:
+        self._done.clear()
+        self._first = None
+        self._chunks = 0
+        self._error = None
+        start = time.perf_counter()
+        self.sio.emit("generate_text", {"prompt":prompt, "personality":-1, "n_predicts":n_predict})
+        if not self._done.wait(self.timeout):
+            return RequestResult(error="timeout")
+        if self._error is not None:
+            return RequestResult(error=self._error)
+        return RequestResult(self._first-start if self._first is not None else None, time.perf_counter()-start, self._chunks)
+
+    def close(self):
+        self.sio.disconnect()
+
+
+def build_user(scenario:str, url:str, stream:bool):
+    if scenario=="lollms_generate":
+        return LollmsGenerateUser(url, stream)
+    if scenario=="chat_completions":
+        return ChatCompletionsUser(url, stream)
+    return SocketIOUser(url)
+
+
+# ----------------------------------- Load generation -----------------------------------
+def run_scenario(scenario:str, url:str, concurrency:int, nb_requests:int, n_predict:int, prompt_length:int, stream:bool) -> dict:
+    """Runs nb_requests requests with `concurrency` virtual users and returns the report of the scenario."""
+    results = []
+    lock = threading.Lock()
+    next_request = [0]
+
+    def virtual_user():
+        try:
+            user = build_user(scenario, url, stream)
+        except Exception as ex:
+            with lock:
+                results.append(RequestResult(error=f"connection failed: {ex}"))
+            return
+        try:
+            while True:
+                with lock:
+                    index = next_request[0]
+                    if index>=nb_requests:
+                        break
+                    next_request[0] += 1
+                try:
+                    result = user.generate(build_prompt(index, prompt_length), n_predict)
+                except Exception as ex:
+                    result = RequestResult(error=str(ex))
+                with lock:
+                    results.append(result)
+        finally:
+            user.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=virtual_user, name=f"load-test-user-{i}") for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter()-start
+
+    succeeded = [result for result in results if result.error is None]
+    ttfts = [result.ttft for result in succeeded if result.ttft is not None]
+    latencies = [result.latency for result in succeeded]
+    # Decoding speed of each request (the prefill is excluded when the ttft is known)
+    speeds = [result.nb_tokens/(result.latency-(result.ttft or 0)) for result in succeeded if result.latency-(result.ttft or 0)>0]
+    errors = {}
+    for result in results:
+        if result.error is not None:
+            errors[result.error] = errors.get(result.error, 0) + 1
+    return {
+        "requests": len(results),
+        "errors": sum(errors.values()),
+        "error_rate": sum(errors.values())/len(results) if len(results)>0 else 1.0,
+        "error_messages": errors,
+        "ttft_p50": percentile(ttfts, 50),
+        "ttft_p95": percentile(ttfts, 95),
+        "ttft_p99": percentile(ttfts, 99),
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "tokens_per_second_p50": percentile(speeds, 50),
+        "throughput": sum(result.nb_tokens for result in succeeded)/duration if duration>0 else 0,
+        "requests_per_second": len(succeeded)/duration if duration>0 else 0,
+        "duration": duration,
+    }
+
+
+def check_regressions(scenario:str, report:dict, baseline:dict, tolerance:float, error_tolerance:float) -> list:
+    """Returns the list of the metrics of the report that regressed past the baseline."""
+    regressions = []
+    for metric in LOWER_IS_BETTER:
+        if baseline.get(metric) is not None and report.get(metric) is not None and report[metric]>baseline[metric]*(1+tolerance):
+            regressions.append(f"{scenario}.{metric}: {report[metric]:.4f} > {baseline[metric]:.4f} (+{tolerance*100:.0f}%)")
+    for metric in HIGHER_IS_BETTER:
+        if baseline.get(metric) is not None and report.get(metric) is not None and report[metric]<baseline[metric]*(1-tolerance):
+            regressions.append(f"{scenario}.{metric}: {report[metric]:.4f} < {baseline[metric]:.4f} (-{tolerance*100:.0f}%)")
+    if report["error_rate"]>baseline.get("error_rate", 0)+error_tolerance:
+        regressions.append(f"{scenario}.error_rate: {report['error_rate']:.4f} > {baseline.get('error_rate', 0):.4f}")
+    return regressions
+
+
+def print_report(scenario:str, report:dict):
+    def fmt(value, scale=1000, unit="ms"):
+        return f"{value*scale:.1f}{unit}" if value is not None else "n/a"
+    print(f"\n== {scenario} ({report['requests']} requests in {report['duration']:.1f}s)")
+    print(f"ttft      p50 {fmt(report['ttft_p50'])}  p95 {fmt(report['ttft_p95'])}  p99 {fmt(report['ttft_p99'])}")
+    print(f"latency   p50 {fmt(report['latency_p50'])}  p95 {fmt(report['latency_p95'])}  p99 {fmt(report['latency_p99'])}")
+    print(f"tokens/s  p50 {fmt(report['tokens_per_second_p50'], 1, '')}  throughput {report['throughput']:.1f} tokens/s  {report['requests_per_second']:.2f} requests/s")
+    print(f"errors    {report['errors']} ({report['error_rate']*100:.1f}%)")
+    for message, count in report["error_messages"].items():
+        print(f"          {count} x {message}")
+
+
+# ----------------------------------- Synthetic server -----------------------------------
+def start_synthetic_server(host:str, port:int, args) -> subprocess.Popen:
+    """Starts a lollms server using the synthetic binding and waits until it answers."""
+    env = dict(os.environ)
+    env["LOLLMS_SYNTHETIC_PREFILL_BASE_LATENCY"] = str(args.prefill_base_latency)
+    env["LOLLMS_SYNTHETIC_PREFILL_LATENCY"] = str(args.prefill_latency)
+    env["LOLLMS_SYNTHETIC_TOKEN_LATENCY"] = str(args.token_latency)
+    env["LOLLMS_SYNTHETIC_OUTPUT_LENGTH"] = str(args.output_length)
+    env["LOLLMS_SYNTHETIC_CPU_BOUND"] = "1" if args.cpu_bound else "0"
+    server = subprocess.Popen(
+                                [
+                                    sys.executable, "-m", "lollms.server.elf",
+                                    "--host", host,
+                                    "--port", str(port),
+                                    "--binding_name", str((Path(__file__).parent/"synthetic_binding").resolve()).replace("\\","/"),
+                                    "--model_name", "synthetic",
+                                    "--binding_workers", str(args.binding_workers)
+                                ],
+                                env=env
+                            )
+    deadline = time.time() + args.server_timeout
+    while time.time()<deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"The server exited with code {server.returncode}")
+        try:
+            if requests.get(f"http://{host}:{port}/get_generation_status", timeout=1).status_code==200:
+                return server
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError(f"The server didn't start within {args.server_timeout}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='lollms server load test')
+    parser.add_argument('--host', type=str, default='localhost', help='Server host')
+    parser.add_argument('--port', type=int, default=9600, help='Server port')
+    parser.add_argument('--scenarios', type=str, default=",".join(SCENARIOS), help=f'Comma separated list of scenarios among {", ".join(SCENARIOS)}')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of concurrent virtual users')
+    parser.add_argument('--requests', type=int, default=64, help='Number of requests per scenario')
+    parser.add_argument('--n-predict', type=int, default=128, help='Maximum number of generated tokens per request')
+    parser.add_argument('--prompt-length', type=int, default=256, help='Number of words of the prompts')
+    parser.add_argument('--no-stream', action='store_true', help='Use non streamed HTTP responses (the ttft is not measured)')
+    parser.add_argument('--baseline', type=str, default=str(Path(__file__).parent/"baselines.json"), help='Baselines file')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the numbers of this run as the baselines')
+    parser.add_argument('--no-check', action='store_true', help='Only report the numbers (no comparison to the baselines)')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative degradation allowed before a metric is considered as regressed')
+    parser.add_argument('--error-tolerance', type=float, default=0.01, help='Increase of the error rate allowed before it is considered as regressed')
+    parser.add_argument('--output', type=str, default=None, help='Writes the reports to this json file')
+    parser.add_argument('--serve', action='store_true', help='Start a server with the synthetic binding for the test')
+    parser.add_argument('--prefill-base-latency', type=float, default=20, help='Synthetic binding: fixed prompt processing time in ms')
+    parser.add_argument('--prefill-latency', type=float, default=0.2, help='Synthetic binding: processing time per prompt token in ms')
+    parser.add_argument('--token-latency', type=float, default=10, help='Synthetic binding: time per generated token in ms')
+    parser.add_argument('--output-length', type=int, default=128, help='Synthetic binding: number of generated tokens')
+    parser.add_argument('--cpu-bound', action='store_true', help='Synthetic binding: spend the latencies computing instead of sleeping')
+    parser.add_argument('--binding-workers', type=int, default=0, help='Number of binding worker processes of the synthetic server (0 runs the binding in the server process)')
+    parser.add_argument('--server-timeout', type=float, default=120, help='Time in seconds to wait for the synthetic server to start')
+    args = parser.parse_args()
+
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(",") if scenario.strip()]
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            print(f"Error: unknown scenario {scenario}")
+            sys.exit(2)
+
+    url = f"http://{args.host}:{args.port}"
+    server = start_synthetic_server(args.host, args.port, args) if args.serve else None
+    try:
+        reports = {}
+        for scenario in scenarios:
+            print(f"Running {scenario} with {args.concurrency} virtual users")
+            reports[scenario] = run_scenario(scenario, url, args.concurrency, args.requests, args.n_predict, args.prompt_length, not args.no_stream)
+            print_report(scenario, reports[scenario])
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=4)
+
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        baselines = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+        for scenario, report in reports.items():
+            baselines[scenario] = {metric:report[metric] for metric in LOWER_IS_BETTER+HIGHER_IS_BETTER+["error_rate"]}
+        baseline_path.write_text(json.dumps(baselines, indent=4))
+        print(f"\nBaselines saved to {baseline_path}")
+    elif args.no_check:
+        pass
+    elif baseline_path.exists():
+        baselines = json.loads(baseline_path.read_text())
+        regressions = []
+        for scenario, report in reports.items():
+            if scenario in baselines:
+                regressions += check_regressions(scenario, report, baselines[scenario], args.tolerance, args.error_tolerance)
+            else:
+                # A scenario without baseline can't be checked, this is not a pass
+                regressions.append(f"{scenario}: no baseline in {baseline_path} (use --save-baseline to create it)")
+        if len(regressions)>0:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nNo regression")
+    else:
+        print(f"\nNo baselines found at {baseline_path} (use --save-baseline to create them)")
+        sys.exit(1)
@@ -0,0 +1,129 @@
+######
+# Project       : lollms
+# File          : synthetic_binding/__init__.py
+# Author        : ParisNeo with the help of the community
+# license       : Apache 2.0
+# Description   :
+# Deterministic binding used by the load tests. It doesn't load any model: it
+# waits for a configurable prefill time, then emits a fixed number of tokens
+# at a configurable rate. The output only depends on the prompt. In cpu bound
+# mode the latencies are spent computing instead of sleeping, like a CPU model.
+######
+from lollms.binding import LLMBinding, BindingType
+from lollms.config import BaseConfig, TypedConfig, ConfigTemplate, InstallOption
+from lollms.paths import LollmsPaths
+from lollms.main_config import LOLLMSConfig
+from lollms.com import LoLLMsCom
+from lollms.types import MSG_TYPE
+from pathlib import Path
+from typing import Callable
+import hashlib
+import time
+import os
+
+binding_name = "SyntheticBinding"
+binding_folder_name = "synthetic_binding"
+
+VOCABULARY = ["the", "model", "server", "token", "request", "answer", "fast", "queue", "binding", "stream", "lollms", "prompt", "cache", "text", "of", "and", "a", "is"]
+
+
+class SyntheticBinding(LLMBinding):
+    """
+    Synthetic binding with a configurable latency profile.
+
+    The binding configuration can be overridden with environment variables so that the
+    load test can start a server with a given profile:
+        LOLLMS_SYNTHETIC_PREFILL_LATENCY (ms per prompt token), LOLLMS_SYNTHETIC_PREFILL_BASE_LATENCY (ms),
+        LOLLMS_SYNTHETIC_TOKEN_LATENCY (ms), LOLLMS_SYNTHETIC_OUTPUT_LENGTH (tokens), LOLLMS_SYNTHETIC_CPU_BOUND (0 or 1).
+    """
+    def __init__(self, 
+                config: LOLLMSConfig, 
+                lollms_paths: LollmsPaths, 
+                installation_option:InstallOption=InstallOption.INSTALL_IF_NECESSARY,
+                lollmsCom:LoLLMsCom=None
+                ) -> None:
+        binding_config = TypedConfig(
+            ConfigTemplate([
+                {"name":"prefill_base_latency","type":"float","value":20, "min":0, "help":"Fixed time spent processing the prompt in ms"},
+                {"name":"prefill_latency","type":"float","value":0.2, "min":0, "help":"Time spent processing each prompt token in ms"},
+                {"name":"token_latency","type":"float","value":10, "min":0, "help":"Time spent generating each token in ms"},
+                {"name":"output_length","type":"int","value":128, "min":1, "help":"Number of generated tokens (capped by n_predict)"},
+                {"name":"cpu_bound","type":"bool","value":False, "help":"Spend the latencies computing (holding the GIL) instead of sleeping"},
+                {"name":"ctx_size","type":"int","value":4096, "min":512, "help":"Context size"},
+            ]),
+            BaseConfig(config={})
+        )
+        super().__init__(
+                            Path(__file__).parent, 
+                            lollms_paths, 
+                            config, 
+                            binding_config, 
+                            installation_option,
+                            supported_file_extensions=[''],
+                            binding_type=BindingType.TEXT_ONLY,
+                            lollmsCom=lollmsCom
+                        )
+        self.config.ctx_size = self.binding_config.config.ctx_size
+
+    def _setting(self, name:str, cast=float):
+        value = os.environ.get(f"LOLLMS_SYNTHETIC_{name.upper()}")
+        return cast(value) if value is not None else cast(self.binding_config.config[name])
+
+    def build_model(self):
+        self.prefill_base_latency   = self._setting("prefill_base_latency")/1000
+        self.prefill_latency        = self._setting("prefill_latency")/1000
+        self.token_latency          = self._setting("token_latency")/1000
+        self.output_length          = self._setting("output_length", int)
+        self.cpu_bound              = self._setting("cpu_bound", lambda value: str(value).lower() in ["1", "true"])
+        return self
+
+    def _wait(self, duration:float):
+        if not self.cpu_bound:
+            time.sleep(duration)
+            return
+        # CPU time of the thread, concurrent generations in the same process share the GIL
+        end = time.thread_time() + duration
+        while time.thread_time()<end:
+            pass
+
+    def install(self):
+        super().install()
+
+    def list_models(self):
+        return ["synthetic"]
+
+    def get_available_models(self, app:LoLLMsCom=None):
+        return [{"name":"synthetic", "category":"generic", "description":"Synthetic model used by the load tests", "rank":0, "type":"synthetic", "variants":[{"name":"synthetic", "size":0}]}]
+
+    def tokenize(self, prompt:str):
+        return prompt.split(" ")
+
+    def detokenize(self, tokens_list:list):
+        return " ".join(tokens_list)
+
+    def embed(self, text):
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        return [byte/255 for byte in digest]
+
+    def generate(self, 
+                 prompt:str,                  
+                 n_predict: int = 128,
+                 callback: Callable[[str], None] = None,
+                 verbose: bool = False,
+                 **gpt_params ):
+        """
+        Emits min(n_predict, output_length) tokens chosen from the hash of the prompt.
+        """
+        nb_prompt_tokens = len(self.tokenize(prompt))
+        self._wait(self.prefill_base_latency + nb_prompt_tokens*self.prefill_latency)
+        seed = int.from_bytes(hashlib.sha256(prompt.encode("utf-8")).digest()[:8], "little")
+        output = ""
+        nb_tokens = 0
+        for nb_tokens in range(1, min(n_predict, self.output_length)+1):
+            self._wait(self.token_latency)
+            chunk = VOCABULARY[(seed + nb_tokens*7919) % len(VOCABULARY)] + " "
+            output += chunk
+            if callback is not None and callback(chunk, MSG_TYPE.MSG_TYPE_CHUNK) is False:
+                break
+        self.report_usage(nb_prompt_tokens, nb_tokens)
+        return output
@@ -0,0 +1,103 @@
+"""
+project: lollms
+file: conftest.py
+author: ParisNeo
+description: 
+    Fixtures of the unit tests: a fake binding and a minimal server exposing the
+    generation endpoints (no model, no personal folders).
+"""
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from lollms.app import LollmsApplication
+from lollms.binding import LLMBinding
+from lollms.scheduler import GenerationScheduler
+from lollms.tokenizer_cache import TokenizerCache
+from lollms.types import MSG_TYPE
+import lollms.server.endpoints.lollms_generator as lollms_generator
+import pytest
+import time
+
+
+def wait_for(condition, timeout:float=5):
+    """Waits until condition() is true, fails the test after timeout seconds."""
+    deadline = time.time()+timeout
+    while not condition():
+        assert time.time()<deadline, "timeout"
+        time.sleep(0.01)
+
+
+class FakeConfig(dict):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+class FakeBinding(LLMBinding):
+    """Binding emitting the characters of `text` one by one, waiting `delay` seconds before each of them."""
+    def __init__(self, text:str="Hello world", delay:float=0.0) -> None:
+        # LLMBinding.__init__ needs the personal folders
+        self.text                   = text
+        self.delay                  = delay
+        self.config                 = FakeConfig(model_name="fake", binding_name="fake")
+        self.binding_config         = {"max_concurrent_generations":1}
+        self.tokenizer_cache        = TokenizerCache(self)
+        self.prefix_cache           = None
+        self.nb_generations         = 0
+
+    def tokenize(self, prompt:str):
+        return prompt.split(" ")
+
+    def detokenize(self, tokens_list:list):
+        return " ".join(tokens_list)
+
+    def generate(self, prompt:str, n_predict:int=128, callback=None, verbose:bool=False, **gpt_params):
+        self.nb_generations += 1
+        output = ""
+        for chunk in self.text[:n_predict]:
+            time.sleep(self.delay)
+            output += chunk
+            if callback is not None and callback(chunk, MSG_TYPE.MSG_TYPE_CHUNK) is False:
+                break
+        return output
+
+
+class FakeServer:
+    """The parts of LOLLMSElfServer used by the generation endpoints."""
+    generate_text           = LollmsApplication.generate_text
+    generate_choices        = LollmsApplication.generate_choices
+    _prewarm_prompt         = LollmsApplication._prewarm_prompt
+    learn_from_discussion   = LollmsApplication.learn_from_discussion
+
+    def __init__(self, binding:FakeBinding=None, on_position=None) -> None:
+        self.binding                = binding if binding is not None else FakeBinding()
+        self.model                  = self.binding
+        self.config                 = FakeConfig(temperature=0.1, model_name="fake", binding_name="fake", ctx_size=4096)
+        self.scheduler              = GenerationScheduler(on_position=on_position)
+        self.batcher                = None
+        self.response_cache         = None
+        self.prefix_cache           = None
+        self.speculative_decoder    = None
+        self.model_pool             = None
+        self.embedding_batcher      = None
+
+    def error(self, *args, **kwargs):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = FakeServer()
+    monkeypatch.setattr(lollms_generator, "elf_server", server)
+    return server
+
+
+@pytest.fixture
+def client(server):
+    app = FastAPI()
+    app.include_router(lollms_generator.router)
+    return TestClient(app)
@@ -0,0 +1,114 @@
+"""
+project: lollms
+file: test_async_tokenizer.py
+author: ParisNeo
+description:
+    Async interface of the bindings (tokenizer and generation) and of the tokenizer cache
+"""
+from conftest import FakeBinding, FakeServer
+import numpy as np
+import asyncio
+import threading
+
+
+class CountingBinding(FakeBinding):
+    """Fake binding recording the threads its tokenizer runs on."""
+    def __init__(self) -> None:
+        super().__init__()
+        self.threads = []
+
+    def tokenize(self, prompt:str):
+        self.threads.append(threading.current_thread())
+        return super().tokenize(prompt)
+
+    def detokenize(self, tokens_list:list):
+        self.threads.append(threading.current_thread())
+        return super().detokenize(tokens_list)
+
+
+def test_the_tokenizer_runs_outside_of_the_event_loop():
+    binding = CountingBinding()
+    async def run():
+        return await binding.atokenize("hello world"), await binding.adetokenize(["hello", "world"])
+    assert asyncio.run(run())==(["hello", "world"], "hello world")
+    assert threading.main_thread() not in binding.threads
+
+
+def test_the_tokenizer_cache_memoizes_the_async_calls():
+    binding = CountingBinding()
+    async def run():
+        results = []
+        for _ in range(3):
+            results.append(await binding.tokenizer_cache.atokenize("hello world"))
+            results.append(await binding.tokenizer_cache.adetokenize(["hello", "world"]))
+        return results
+    assert asyncio.run(run())==[["hello", "world"], "hello world"]*3
+    assert len(binding.threads)==2
+    # The sync and async calls share the cache
+    assert binding.tokenizer_cache.tokenize("hello world")==["hello", "world"]
+    assert len(binding.threads)==2
+
+
+def test_the_completion_endpoint_counts_the_prompt_tokens(server, client):
+    response = client.post("/v1/chat/completions", json={"messages":[{"role":"user", "content":"one two three"}]})
+    # The fake binding splits "!@>user: one two three\n!@>assistant:" on the spaces (4 tokens)
+    assert response.json()["usage"]["prompt_tokens"]==4
+
+
+class ArrayBinding(FakeBinding):
+    """Fake binding tokenizing into a numpy array of word lengths."""
+    def tokenize(self, prompt:str):
+        return np.array([len(word) for word in prompt.split(" ")])
+
+
+def test_the_tokenizer_cache_returns_lists_on_hits_and_misses():
+    binding = ArrayBinding()
+    for _ in range(2):
+        tokens = binding.tokenizer_cache.tokenize("hello big world")
+        assert type(tokens) is list and tokens==[5, 3, 5]
+        assert all(type(token) is int for token in tokens)
+    assert binding.tokenizer_cache.hits==1
+    assert asyncio.run(binding.tokenizer_cache.atokenize("a bb"))==[1, 2]
+
+
+class AsyncBinding(FakeBinding):
+    """Fake binding with a native agenerate (the sync generate is never used)."""
+    def __init__(self) -> None:
+        super().__init__()
+        self.closed = False
+
+    def generate(self, prompt:str, n_predict:int=128, callback=None, verbose:bool=False, **gpt_params):
+        raise AssertionError("generate called")
+
+    async def agenerate(self, prompt:str, n_predict:int=128, verbose:bool=False, **gpt_params):
+        try:
+            for chunk in self.text[:n_predict]:
+                await asyncio.sleep(0)
+                yield chunk
+        finally:
+            self.closed = True
+
+
+def test_the_default_agenerate_streams_the_chunks_of_generate():
+    binding = FakeBinding()
+    async def run(nb_chunks:int):
+        chunks = []
+        async for chunk in binding.agenerate("hi"):
+            chunks.append(chunk)
+            if len(chunks)==nb_chunks:
+                break
+        return chunks
+    assert "".join(asyncio.run(run(100)))=="Hello world"
+    assert asyncio.run(run(3))==list("Hel")
+
+
+def test_scheduler_jobs_generate_through_a_native_agenerate():
+    server = FakeServer(AsyncBinding())
+    assert server.binding.has_native_agenerate and not FakeBinding().has_native_agenerate
+    assert server.scheduler.run(server.generate_text, "hi", 100)=="Hello world"
+    received = []
+    def callback(chunk, chunk_type):
+        received.append(chunk)
+        return len(received)<3
+    assert server.scheduler.run(server.generate_text, "hi", 100, callback)=="Hel"
+    assert server.binding.closed
@@ -0,0 +1,98 @@
+"""
+project: lollms
+file: test_batching.py
+author: ParisNeo
+description:
+    Continuous batching: slow clients, stops and shutdown of the decode loop
+"""
+from lollms.batching import ContinuousBatcher
+from conftest import FakeBinding
+import threading
+import pytest
+import time
+
+
+class BatchBinding(FakeBinding):
+    """Fake binding decoding the characters of `text` for every sequence of the batch."""
+    def __init__(self, text:str="Hello world") -> None:
+        super().__init__(text)
+        self.positions  = {}
+        self.nb_steps   = {}
+        self.removed    = []
+        self.handles    = {}
+        self._next      = 0
+
+    def add_sequence(self, prompt:str, n_predict:int=128, **gpt_params):
+        self._next += 1
+        self.positions[self._next] = 0
+        self.nb_steps[self._next] = 0
+        self.handles[prompt] = self._next
+        return self._next
+
+    def decode_step(self, handles:list) -> dict:
+        # One token per millisecond
+        time.sleep(0.001)
+        chunks = {}
+        for handle in handles:
+            position = self.positions[handle]
+            chunks[handle] = self.text[position] if position<len(self.text) else None
+            self.positions[handle] = position+1
+            self.nb_steps[handle] += 1
+        return chunks
+
+    def remove_sequence(self, handle):
+        self.removed.append(handle)
+
+
+def test_a_slow_client_does_not_stall_the_batch():
+    binding = BatchBinding("x"*200)
+    batcher = ContinuousBatcher(binding, max_batch_size=2, max_queued_chunks=4)
+    release = threading.Event()
+    slow = threading.Thread(target=batcher.generate, args=("slow", 200, lambda chunk, chunk_type: release.wait()), daemon=True)
+    slow.start()
+    try:
+        start = time.time()
+        assert batcher.generate("fast", 200)=="x"*200
+        assert time.time()-start<5
+        # The slow sequence is paused once its client is max_queued_chunks behind
+        assert binding.nb_steps[binding.handles["slow"]]<=5
+    finally:
+        release.set()
+        slow.join(5)
+        batcher.stop()
+
+
+def test_a_stopped_sequence_leaves_the_batch():
+    binding = BatchBinding()
+    batcher = ContinuousBatcher(binding)
+    received = []
+    def callback(chunk, chunk_type):
+        received.append(chunk)
+        return len(received)<5
+    assert batcher.generate("hi", 100, callback)=="Hello"
+    assert received==list("Hello")
+    assert binding.removed==[1]
+    batcher.stop()
+
+
+def test_stop_fails_the_sequences_and_ends_the_decode_loop():
+    binding = BatchBinding("x"*100000)
+    batcher = ContinuousBatcher(binding, max_batch_size=1)
+    errors = []
+    def generate():
+        try:
+            batcher.generate("hi", 100000)
+        except RuntimeError as ex:
+            errors.append(ex)
+    threads = [threading.Thread(target=generate, daemon=True) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    while batcher.nb_active_sequences==0:
+        time.sleep(0.01)
+    batcher.stop()
+    for thread in threads:
+        thread.join(5)
+    assert len(errors)==2
+    assert not batcher._thread.is_alive()
+    with pytest.raises(RuntimeError):
+        batcher.generate("hi")
@@ -0,0 +1,92 @@
+"""
+project: lollms
+file: test_binding_workers.py
+author: ParisNeo
+description:
+    Binding worker processes running the synthetic binding of the load tests:
+    dispatch, cancellation, calls and restart of a killed worker
+"""
+from lollms.paths import LollmsPaths
+from lollms.main_config import LOLLMSConfig
+from lollms.binding import BindingBuilder
+from lollms.binding_workers import BindingWorkerPool, BindingWorkersModel
+from conftest import wait_for
+from pathlib import Path
+import threading
+import pytest
+
+SYNTHETIC_BINDING = Path(__file__).parent.parent/"benchmarks"/"synthetic_binding"
+
+
+@pytest.fixture(scope="module")
+def setup(tmp_path_factory):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        # 50 tokens in 0.5s, the workers inherit the environment
+        monkeypatch.setenv("LOLLMS_SYNTHETIC_PREFILL_BASE_LATENCY", "0")
+        monkeypatch.setenv("LOLLMS_SYNTHETIC_TOKEN_LATENCY", "10")
+        monkeypatch.setenv("LOLLMS_SYNTHETIC_OUTPUT_LENGTH", "50")
+        lollms_paths = LollmsPaths(personal_path=tmp_path_factory.mktemp("personal"))
+        config = LOLLMSConfig(lollms_paths.default_cfg_path, lollms_paths)
+        config.binding_name = str(SYNTHETIC_BINDING)
+        config.model_name = "synthetic"
+        binding = BindingBuilder().build_binding(config, lollms_paths)
+        pool = BindingWorkerPool(config, lollms_paths, 2, restart_delay=0.1, start_timeout=60)
+        try:
+            wait_for(lambda: all(worker.ready for worker in pool.workers), 60)
+            yield BindingWorkersModel(binding, pool), pool
+        finally:
+            pool.shutdown()
+
+
+def test_requests_go_to_the_least_loaded_worker(setup):
+    model, pool = setup
+    threads = [threading.Thread(target=model.generate, args=(f"prompt {i}", 50), daemon=True) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    wait_for(lambda: sum(worker["pending"] for worker in pool.get_status()["workers"])==2)
+    assert [worker["pending"] for worker in pool.get_status()["workers"]]==[1, 1]
+    for thread in threads:
+        thread.join(30)
+
+
+def test_a_canceled_generation_stops_in_the_worker(setup):
+    model, pool = setup
+    received = []
+    def callback(chunk, chunk_type):
+        received.append(chunk)
+        return len(received)<3
+    output = model.generate("prompt", 50, callback)
+    # The chunks still in the pipe when the cancellation arrives are dropped
+    assert output=="".join(received) and len(received)==3
+    assert all(worker["pending"]==0 for worker in pool.get_status()["workers"])
+
+
+def test_tokenization_and_embeddings_run_in_the_workers(setup):
+    model, pool = setup
+    assert not model.local_model
+    assert model.tokenize("a b c")==["a", "b", "c"]
+    assert model.detokenize(["a", "b"])=="a b"
+    assert model.tokenizer_cache.tokenize("a b c")==["a", "b", "c"]
+    assert model.embed("text")==model.binding.embed("text")
+    with pytest.raises(RuntimeError):
+        pool.call("generate", "prompt")
+
+
+def test_a_killed_worker_fails_its_generation_and_restarts(setup):
+    model, pool = setup
+    worker = pool.workers[0]
+    restarts = worker.restarts
+    errors = []
+    def generate():
+        try:
+            model.generate("prompt", 50)
+        except RuntimeError as ex:
+            errors.append(ex)
+    thread = threading.Thread(target=generate, daemon=True)
+    thread.start()
+    wait_for(lambda: len(worker.pending)==1)
+    worker.process.kill()
+    thread.join(30)
+    assert len(errors)==1
+    wait_for(lambda: worker.ready and worker.restarts==restarts+1, 60)
+    assert len(model.generate("prompt", 5).split())==5
@@ -0,0 +1,151 @@
+"""
+project: lollms
+file: test_cancellation.py
+author: ParisNeo
+description: 
+    Cancellation of queued and running generation jobs
+"""
+from lollms.scheduler import GenerationScheduler
+from conftest import wait_for
+import asyncio
+import threading
+import pytest
+
+
+def test_on_cancel_is_called_for_a_queued_job():
+    scheduler = GenerationScheduler()
+    release = threading.Event()
+    scheduler.submit(release.wait, client_id="blocker")
+    canceled = []
+    ran = []
+    job = scheduler.submit(ran.append, 1, client_id="client", on_cancel=lambda: canceled.append(True))
+    assert scheduler.cancel(job.id)
+    release.set()
+    assert job.future.cancelled()
+    assert canceled==[True]
+    assert ran==[]
+
+
+@pytest.mark.parametrize("url, body", [
+    ("/lollms_generate", {"prompt":"hi", "stream":True}),
+    ("/v1/chat/completions", {"messages":[{"role":"user", "content":"hi"}], "stream":True}),
+    ("/v1/completions", {"prompt":"hi", "stream":True}),
+])
+def test_canceling_a_queued_stream_ends_the_response(server, client, url, body):
+    queued_jobs = []
+    server.scheduler.on_position = lambda job, position: queued_jobs.append(job) if job.client_id!="blocker" else None
+    release = threading.Event()
+    server.scheduler.submit(release.wait, client_id="blocker")
+
+    responses = []
+    request = threading.Thread(target=lambda: responses.append(client.post(url, json=body)), daemon=True)
+    request.start()
+    try:
+        wait_for(lambda: len(queued_jobs)>0)
+        assert client.post(f"/stop_gen/{queued_jobs[0].id}").json()["status"]
+        request.join(5)
+        assert not request.is_alive(), "the stream of the canceled job never ended"
+        assert responses[0].status_code==200
+        assert "Hello" not in responses[0].text
+        assert server.binding.nb_generations==0
+    finally:
+        release.set()
+
+
+def test_stop_gen_only_cancels_the_calling_client(server, client):
+    queued_jobs = []
+    server.scheduler.on_position = lambda job, position: queued_jobs.append(job) if job.client_id!="blocker" and job not in queued_jobs else None
+    release = threading.Event()
+    server.scheduler.submit(release.wait, client_id="blocker")
+
+    responses = {}
+    requests = [
+        threading.Thread(target=lambda client_id=client_id: responses.setdefault(client_id, client.post("/lollms_generate", json={"prompt":"hi"}, headers={"X-Client-Id":client_id})), daemon=True)
+        for client_id in ["a", "b"]
+    ]
+    for request in requests:
+        request.start()
+    try:
+        wait_for(lambda: len(queued_jobs)==2)
+        # Without X-Client-Id, the client is identified by its address
+        assert client.post("/stop_gen").json()["canceled"]==0
+        assert client.post("/stop_gen", headers={"X-Client-Id":"a"}).json()["canceled"]==1
+        canceled = [job.client_id for job in queued_jobs if job.future.cancelled()]
+        assert canceled==["http:a"]
+    finally:
+        release.set()
+    for request in requests:
+        request.join(5)
+    assert responses["a"].json()["status"] is False
+    assert responses["b"].json()=="Hello world"
+
+
+def test_canceling_the_awaiting_task_cancels_the_job():
+    scheduler = GenerationScheduler()
+    release = threading.Event()
+    scheduler.submit(release.wait, client_id="blocker")
+    ran = []
+    async def cancel_while_queued():
+        task = asyncio.ensure_future(scheduler.run_async(ran.append, 1, client_id="client"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    try:
+        asyncio.run(cancel_while_queued())
+        assert scheduler.queue_depth==0
+    finally:
+        release.set()
+    assert ran==[]
+
+
+@pytest.mark.parametrize("url, body", [
+    ("/lollms_generate", {"prompt":"hi"}),
+    ("/v1/chat/completions", {"messages":[{"role":"user", "content":"hi"}]}),
+    ("/v1/completions", {"prompt":"hi"}),
+])
+def test_non_streamed_responses_have_the_request_id(server, client, url, body):
+    job_ids = []
+    server.scheduler.on_position = lambda job, position: job_ids.append(job.id)
+    release = threading.Event()
+    server.scheduler.submit(release.wait, client_id="blocker")
+    responses = []
+    request = threading.Thread(target=lambda: responses.append(client.post(url, json=body)), daemon=True)
+    request.start()
+    try:
+        wait_for(lambda: len(job_ids)>1)
+    finally:
+        release.set()
+    request.join(5)
+    assert responses[0].headers["X-Request-ID"]==job_ids[-1]
+
+
+def test_stop_gen_cancels_the_requests_of_the_address_without_client_id(server, client):
+    queued_jobs = []
+    server.scheduler.on_position = lambda job, position: queued_jobs.append(job) if job.client_id!="blocker" and job not in queued_jobs else None
+    release = threading.Event()
+    server.scheduler.submit(release.wait, client_id="blocker")
+    responses = []
+    request = threading.Thread(target=lambda: responses.append(client.post("/lollms_generate", json={"prompt":"hi"})), daemon=True)
+    request.start()
+    try:
+        wait_for(lambda: len(queued_jobs)==1)
+        assert queued_jobs[0].client_id=="http:testclient"
+        assert client.post("/stop_gen").json()["canceled"]==1
+    finally:
+        release.set()
+    request.join(5)
+    assert responses[0].json()["status"] is False
+
+
+def test_canceling_a_running_summary_stops_it(server):
+    server.config.summerize_discussion = True
+    server.config.debug = False
+    received = []
+    def callback(chunk, chunk_type):
+        received.append(chunk)
+        if len(received)==3:
+            server.scheduler.cancel(server.scheduler.current_job().id)
+        return True
+    server.learn_from_discussion("title", "discussion", 100, callback)
+    assert received==list("Hel")
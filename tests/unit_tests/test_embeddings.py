@@ -0,0 +1,68 @@
+"""
+project: lollms
+file: test_embeddings.py
+author: ParisNeo
+description:
+    Batched embeddings running as scheduler jobs
+"""
+from lollms.embeddings import EmbeddingBatcher, index_vectorizer
+from lollms.scheduler import GenerationScheduler
+from safe_store import VectorizationMethod
+from conftest import FakeBinding
+from types import SimpleNamespace
+import threading
+
+
+class EmbeddingBinding(FakeBinding):
+    """Fake binding embedding a text as [its length] and recording the scheduler job of each batch."""
+    def __init__(self, scheduler:GenerationScheduler) -> None:
+        super().__init__()
+        self.scheduler  = scheduler
+        self.batches    = []
+
+    def embed_batch(self, texts:list) -> list:
+        self.batches.append((list(texts), self.scheduler.current_job()))
+        return [[len(text)] for text in texts]
+
+
+def test_embedding_batches_are_scheduler_jobs():
+    scheduler = GenerationScheduler()
+    binding = EmbeddingBinding(scheduler)
+    batcher = EmbeddingBatcher(max_wait=0.05, scheduler=scheduler)
+    # The batch waits for the running generation
+    release = threading.Event()
+    scheduler.submit(release.wait, client_id="generation")
+    futures = [batcher.submit(binding, [text]) for text in ["a", "bb", "ccc"]]
+    assert not any(future.done() for future in futures)
+    release.set()
+    assert [future.result(5) for future in futures]==[[[1]], [[2]], [[3]]]
+    texts, job = binding.batches[0]
+    assert texts==["a", "bb", "ccc"]
+    assert job is not None and job.client_id=="embeddings"
+
+
+def test_embeddings_requested_by_a_job_are_computed_inline():
+    scheduler = GenerationScheduler()
+    binding = EmbeddingBinding(scheduler)
+    batcher = EmbeddingBatcher(scheduler=scheduler)
+    assert scheduler.run(batcher.embed, binding, ["abcd"])==[[4]]
+
+
+def test_a_failed_batch_fails_its_requests():
+    scheduler = GenerationScheduler()
+    binding = EmbeddingBinding(scheduler)
+    binding.embed_batch = lambda texts: 1/0
+    batcher = EmbeddingBatcher(scheduler=scheduler)
+    future = batcher.submit(binding, ["a"])
+    assert isinstance(future.exception(5), ZeroDivisionError)
+
+
+def test_indexing_batches_are_scheduler_jobs():
+    scheduler = GenerationScheduler()
+    binding = EmbeddingBinding(scheduler)
+    batcher = EmbeddingBatcher(max_batch_size=2, scheduler=scheduler)
+    chunks = {index:{"chunk_text":"x"*index} for index in range(1, 4)}
+    vectorizer = SimpleNamespace(vectorization_method=VectorizationMethod.MODEL_EMBEDDING, model=binding, chunks=chunks, save_db=False, ready=False)
+    assert index_vectorizer(vectorizer, 2, batcher)
+    assert [chunk["embeddings"] for chunk in chunks.values()]==[[1], [2], [3]]
+    assert [(texts, job.client_id) for texts, job in binding.batches]==[(["x", "xx"], "embeddings"), (["xxx"], "embeddings")]
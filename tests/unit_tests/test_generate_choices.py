@@ -0,0 +1,92 @@
+"""
+project: lollms
+file: test_generate_choices.py
+author: ParisNeo
+description:
+    Generation of several choices for one prompt (n>1 requests)
+"""
+from lollms.scheduler import SchedulerLane
+from conftest import FakeBinding, FakeServer
+import threading
+import pytest
+import time
+
+
+def test_prompt_is_prewarmed_in_a_background_job():
+    server = FakeServer()
+    lanes = []
+    server.binding.prefix_cache = object()
+    server.binding.prewarm_prefix = lambda tokens: lanes.append(server.scheduler.current_job().lane)
+    outputs = server.generate_choices("hi", 5, nb_choices=2)
+    assert outputs==["Hello", "Hello"]
+    assert lanes==[SchedulerLane.BACKGROUND]
+
+
+class ConcurrencyProbe(FakeBinding):
+    """Fake binding recording the seeds it receives and the maximum number of parallel generations."""
+    def __init__(self, delay:float=0.02) -> None:
+        super().__init__(delay=delay)
+        self.binding_config = {"max_concurrent_generations":4}
+        self.seeds          = []
+        self.running        = 0
+        self.max_running    = 0
+        self.lock           = threading.Lock()
+
+    def generate(self, prompt:str, n_predict:int=128, callback=None, verbose:bool=False, **gpt_params):
+        with self.lock:
+            self.seeds.append(gpt_params.get("seed"))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            return super().generate(prompt, n_predict, callback, verbose, **gpt_params)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+def test_choices_use_the_free_scheduler_slots():
+    server = FakeServer(ConcurrencyProbe())
+    server.scheduler.set_concurrency(3)
+    outputs = server.scheduler.run(server.generate_choices, "hi", 5, nb_choices=4)
+    assert outputs==["Hello"]*4
+    assert server.binding.max_running==3
+
+
+def test_choices_run_one_after_the_other_when_the_scheduler_is_full():
+    server = FakeServer(ConcurrencyProbe())
+    server.scheduler.set_concurrency(2)
+    release = threading.Event()
+    server.scheduler.submit(release.wait, client_id="other")
+    try:
+        outputs = server.scheduler.run(server.generate_choices, "hi", 5, nb_choices=3)
+    finally:
+        release.set()
+    assert outputs==["Hello"]*3
+    assert server.binding.max_running==1
+
+
+def test_jobs_wait_for_the_slots_taken_by_the_choices():
+    server = FakeServer(ConcurrencyProbe(delay=0.05))
+    server.scheduler.set_concurrency(2)
+    choices = server.scheduler.submit(server.generate_choices, "hi", 5, nb_choices=2, client_id="a")
+    while server.binding.max_running<2:
+        time.sleep(0.01)
+    # Records the number of running branches when it starts
+    other = server.scheduler.submit(lambda: server.binding.running, client_id="b")
+    assert choices.result(5)==["Hello"]*2
+    assert other.result(5)==0
+
+
+def test_seed_is_forwarded_to_the_choices(server, client):
+    server.binding = server.model = ConcurrencyProbe(delay=0)
+    client.post("/lollms_generate", json={"prompt":"hi", "n":2, "seed":10})
+    client.post("/v1/chat/completions", json={"messages":[{"role":"user", "content":"hi"}], "seed":3})
+    client.post("/lollms_generate", json={"prompt":"hi"})
+    assert sorted(server.binding.seeds[:2])==[10, 11]
+    assert server.binding.seeds[2:]==[3, None]
+
+
+@pytest.mark.parametrize("body", [{"n":0}, {"n":1000}, {"best_of":0}, {"best_of":1000}])
+def test_number_of_choices_is_validated(client, body):
+    assert client.post("/lollms_generate", json={"prompt":"hi", **body}).status_code==422
+    assert client.post("/v1/chat/completions", json={"messages":[{"role":"user", "content":"hi"}], **body}).status_code==422
@@ -0,0 +1,73 @@
+"""
+project: lollms
+file: test_model_pool.py
+author: ParisNeo
+description:
+    Acquire and unload races of the model pool
+"""
+from lollms.model_pool import ModelPool, ACQUIRE_ATTEMPTS
+from conftest import FakeBinding, FakeConfig
+import asyncio
+import pytest
+
+
+class FakeApp:
+    def __init__(self) -> None:
+        self.config = FakeConfig(binding_name="fake", model_name="active")
+        self.model  = None
+
+
+def _binding(model_name:str) -> FakeBinding:
+    binding = FakeBinding()
+    binding.config = FakeConfig(binding_name="fake", model_name=model_name)
+    binding.get_model_path = lambda: None
+    binding.destroy_model = lambda: None
+    return binding
+
+
+def _pool_unloading_on_load(nb_unloads:int) -> ModelPool:
+    """Pool whose model "other" is unloaded right after load returns, nb_unloads times."""
+    pool = ModelPool(FakeApp(), max_memory=0)
+    load = pool.load
+    unloads = []
+    def racing_load(model_name, binding_name=None):
+        if pool.get_status()["models"]==[]:
+            binding = _binding(model_name)
+            pool.register(binding, binding)
+        future = load(model_name, binding_name)
+        if len(unloads)<nb_unloads:
+            unloads.append(pool.unload(model_name))
+        return future
+    pool.load = racing_load
+    return pool
+
+
+def test_acquire_retries_when_the_model_is_unloaded_before_use():
+    pool = _pool_unloading_on_load(1)
+    entry = pool.acquire("other")
+    assert entry.model is not None
+    assert entry.users==1
+    assert pool.get_status()["models"][0]["users"]==1
+
+
+def test_acquire_raises_when_the_model_keeps_being_unloaded():
+    pool = _pool_unloading_on_load(ACQUIRE_ATTEMPTS)
+    with pytest.raises(RuntimeError):
+        pool.acquire("other")
+
+
+def test_acquire_async_retries_when_the_model_is_unloaded_before_use():
+    pool = _pool_unloading_on_load(1)
+    entry = asyncio.run(pool.acquire_async("other"))
+    assert entry.model is not None
+    assert entry.users==1
+
+
+def test_used_models_are_not_unloaded():
+    pool = ModelPool(FakeApp(), max_memory=0)
+    binding = _binding("other")
+    pool.register(binding, binding)
+    entry = pool.acquire("other")
+    assert not pool.unload("other")
+    pool.release(entry)
+    assert pool.unload("other")
@@ -0,0 +1,45 @@
+"""
+project: lollms
+file: test_response_cache.py
+author: ParisNeo
+description:
+    Only the deterministic generations are answered from the response cache
+"""
+from lollms.response_cache import ResponseCache
+from conftest import FakeBinding
+import pytest
+
+
+@pytest.mark.parametrize("url, body", [
+    ("/lollms_generate", {"prompt":"hi"}),
+    ("/v1/chat/completions", {"messages":[{"role":"user", "content":"hi"}]}),
+    ("/v1/completions", {"prompt":"hi"}),
+])
+def test_temperature_zero_requests_are_cached(server, client, url, body):
+    server.response_cache = ResponseCache()
+    client.post(url, json={**body, "temperature":0})
+    client.post(url, json={**body, "temperature":0})
+    assert server.binding.nb_generations==1
+    assert server.response_cache.hits==1
+
+
+def test_sampled_requests_are_not_cached(server, client):
+    server.response_cache = ResponseCache()
+    client.post("/lollms_generate", json={"prompt":"hi", "temperature":0.7})
+    client.post("/lollms_generate", json={"prompt":"hi", "temperature":0.7})
+    assert server.binding.nb_generations==2
+    assert server.response_cache.hits==0
+
+
+def test_outputs_stopped_by_the_callback_are_not_cached():
+    cache = ResponseCache()
+    binding = FakeBinding()
+    received = []
+    def callback(chunk, chunk_type):
+        received.append(chunk)
+        return len(received)<3
+    assert cache.generate(binding.generate, "hi", 100, callback, temperature=0)=="Hel"
+    assert cache.generate(binding.generate, "hi", 100, temperature=0)=="Hello world"
+    assert binding.nb_generations==2
+    assert cache.generate(binding.generate, "hi", 100, temperature=0)=="Hello world"
+    assert cache.hits==1
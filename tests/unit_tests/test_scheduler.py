@@ -0,0 +1,65 @@
+"""
+project: lollms
+file: test_scheduler.py
+author: ParisNeo
+description:
+    Concurrency, lanes and queue positions of the generation scheduler
+"""
+from lollms.scheduler import GenerationScheduler, SchedulerLane
+from conftest import wait_for
+import threading
+import time
+
+
+def test_set_concurrency_grows_the_worker_pool():
+    scheduler = GenerationScheduler(max_workers=2)
+    scheduler.set_concurrency(6)
+    release = threading.Event()
+    jobs = [scheduler.submit(release.wait, client_id=i) for i in range(6)]
+    wait_for(lambda: scheduler.workers.active==6)
+    assert scheduler.workers.waiting==0
+    release.set()
+    for job in jobs:
+        assert job.result(5)
+
+
+def test_concurrency_limit_keeps_extra_jobs_in_the_scheduler_queue():
+    scheduler = GenerationScheduler(max_concurrent_generations=2, max_workers=4)
+    release = threading.Event()
+    jobs = [scheduler.submit(release.wait, client_id=i) for i in range(4)]
+    wait_for(lambda: scheduler.workers.active==2)
+    assert scheduler.queue_depth==2
+    assert scheduler.workers.waiting==0
+    release.set()
+    for job in jobs:
+        assert job.result(5)
+
+
+def test_interactive_jobs_go_before_background_jobs():
+    scheduler = GenerationScheduler()
+    release = threading.Event()
+    scheduler.submit(release.wait, client_id="blocker")
+    wait_for(lambda: scheduler.busy)
+    order = []
+    background = scheduler.submit(order.append, "background", client_id="a", lane=SchedulerLane.BACKGROUND)
+    interactive = scheduler.submit(order.append, "interactive", client_id="b")
+    assert (interactive.position, background.position)==(0, 1)
+    release.set()
+    background.result(5)
+    assert order==["interactive", "background"]
+
+
+def test_queue_positions_follow_the_round_robin():
+    scheduler = GenerationScheduler()
+    release = threading.Event()
+    scheduler.submit(release.wait, client_id="blocker")
+    wait_for(lambda: scheduler.busy)
+    positions = {}
+    on_position = lambda job, position: positions.__setitem__(job.id, position)
+    a1 = scheduler.submit(time.sleep, 0, client_id="a", on_position=on_position)
+    a2 = scheduler.submit(time.sleep, 0, client_id="a", on_position=on_position)
+    b1 = scheduler.submit(time.sleep, 0, client_id="b", on_position=on_position)
+    assert [positions[job.id] for job in [a1, b1, a2]]==[0, 1, 2]
+    assert [job.position for job in [a1, b1, a2]]==[0, 1, 2]
+    release.set()
+    a2.result(5)
@@ -0,0 +1,123 @@
+"""
+project: lollms
+file: test_speculative.py
+author: ParisNeo
+description:
+    Speculative decoding with two toy bindings: the draft model agrees with the main
+    model at a controllable rate
+"""
+from lollms.speculative import SpeculativeDecoder, IncrementalDetokenizer, DETOKENIZE_LOOKBACK
+from conftest import FakeBinding
+import random
+import pytest
+
+
+PROMPT = "prompt"
+TEXT = "Héllo wörld, speculative ✓ decoding "*4
+
+
+class ToyBinding(FakeBinding):
+    """
+    Byte level toy model: it always answers PROMPT with `text`. The draft version
+    (agreement<1) proposes a wrong token with probability 1-agreement.
+    """
+    def __init__(self, text:str=TEXT, agreement:float=1.0, seed:int=0) -> None:
+        super().__init__(text)
+        self.target_text    = text
+        self.target         = list(text.encode("utf-8"))
+        self.agreement      = agreement
+        self.random         = random.Random(seed)
+        self.prompt_length  = 0
+        self.nb_passes      = 0
+        self.detokenized    = []
+
+    def tokenize(self, prompt:str):
+        tokens = list(prompt.encode("utf-8"))
+        self.prompt_length = len(tokens)
+        return tokens
+
+    def detokenize(self, tokens_list:list):
+        self.detokenized.append(len(tokens_list))
+        return bytes(tokens_list).decode("utf-8", errors="replace")
+
+    def generate(self, prompt:str, n_predict:int=128, callback=None, verbose:bool=False, **gpt_params):
+        # Continues the part of the answer already in the prompt
+        self.text = self.target_text[len(prompt)-len(PROMPT):]
+        return super().generate(prompt, n_predict, callback, verbose, **gpt_params)
+
+    def _next(self, position:int):
+        if position>=len(self.target):
+            return None
+        if self.agreement<1 and self.random.random()>=self.agreement:
+            # Any byte but the right one
+            return (self.target[position]+1)%128
+        return self.target[position]
+
+    def score_tokens(self, tokens:list, nb_candidates:int=0, **gpt_params) -> list:
+        self.nb_passes += 1
+        first = len(tokens)-nb_candidates-self.prompt_length
+        return [self._next(first+i) for i in range(nb_candidates+1)]
+
+
+def _decoder(agreement:float, **kwargs):
+    binding = ToyBinding()
+    draft_binding = ToyBinding(agreement=agreement)
+    # The decoder tokenizes with the main binding
+    draft_binding.prompt_length = len(PROMPT.encode("utf-8"))
+    return SpeculativeDecoder(binding, draft_binding, **kwargs), binding
+
+
+def _generate(decoder, n_predict:int=1000):
+    chunks = []
+    output = decoder.generate(PROMPT, n_predict, lambda chunk, chunk_type: chunks.append(chunk) is None)
+    assert "".join(chunks)==output
+    return output
+
+
+@pytest.mark.parametrize("agreement", [1.0, 0.7, 0.3])
+def test_output_is_the_one_of_plain_decoding(agreement):
+    decoder, binding = _decoder(agreement, min_acceptance_rate=0)
+    assert _generate(decoder)==binding.generate(PROMPT, 1000)==TEXT
+
+
+def test_output_is_cut_at_n_predict():
+    decoder, binding = _decoder(1.0)
+    assert _generate(decoder, 7)==bytes(binding.target[:7]).decode("utf-8")
+
+
+def test_draft_tokens_are_accepted_when_the_models_agree():
+    decoder, binding = _decoder(1.0, nb_draft_tokens=4)
+    _generate(decoder)
+    status = decoder.get_status()
+    assert status["acceptance_rate"]==1.0
+    assert status["accepted_tokens"]==status["proposed_tokens"]
+    # Each verification pass emits the 4 draft tokens and the next token of the main model
+    assert binding.nb_passes<=len(binding.target)//5+1
+
+
+def test_falls_back_to_plain_decoding_when_the_draft_model_disagrees():
+    decoder, binding = _decoder(0.0, window=20, min_acceptance_rate=0.5)
+    assert _generate(decoder)==TEXT
+    status = decoder.get_status()
+    assert status["fallbacks"]==1
+    assert not status["active"]
+    # Once fallen back, the generation doesn't go through the draft model anymore
+    nb_passes = binding.nb_passes
+    assert decoder.generate(PROMPT, 1000)==TEXT
+    assert binding.nb_passes==nb_passes
+
+
+def test_only_the_new_tokens_are_detokenized():
+    decoder, binding = _decoder(1.0)
+    _generate(decoder)
+    # Multi-byte characters are held back until they are complete, so the window is a bit larger than the look-back
+    assert max(binding.detokenized)<=DETOKENIZE_LOOKBACK+4
+
+
+def test_incomplete_characters_are_held_back():
+    detokenizer = IncrementalDetokenizer(ToyBinding())
+    chunks = [detokenizer.add(token) for token in "a✓".encode("utf-8")]
+    assert chunks==["a", "", "", "✓"]
+    detokenizer = IncrementalDetokenizer(ToyBinding())
+    assert [detokenizer.add(token) for token in "✓".encode("utf-8")[:2]]==["", ""]
+    assert detokenizer.flush()=="�"
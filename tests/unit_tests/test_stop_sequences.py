@@ -0,0 +1,61 @@
+"""
+project: lollms
+file: test_stop_sequences.py
+author: ParisNeo
+description:
+    Stop sequence detection of the generated chunks
+"""
+from lollms.generation import RECPTION_MANAGER, ROLE_CHANGE_DECISION
+from conftest import FakeBinding
+import pytest
+
+
+def _receive(stop_sequences:list, chunks:list):
+    """Feeds the chunks until a stop sequence is detected and returns the text sent to the client."""
+    reception_manager = RECPTION_MANAGER(stop_sequences)
+    sent = ""
+    for chunk in chunks:
+        rx = reception_manager.new_chunk(chunk)
+        sent += rx.value
+        if rx.status==ROLE_CHANGE_DECISION.ROLE_CHANGED:
+            break
+    else:
+        sent += reception_manager.flush()
+    assert sent==reception_manager.reception_buffer
+    return sent, reception_manager.stop_sequence
+
+
+@pytest.mark.parametrize("chunks", [
+    ["Hello !@>user"],
+    ["Hello !", "@", ">user"],
+    ["Hello !@", ">user"],
+    ["H", "e", "l", "l", "o", " ", "!", "@", ">"],
+])
+def test_role_change_is_detected_across_chunks(chunks):
+    assert _receive(None, chunks)==("Hello ", "!@>")
+
+
+def test_stop_sequences_are_case_insensitive():
+    assert _receive(["User:"], ["Hi us", "ER: no"])==("Hi ", "User:")
+
+
+def test_held_back_text_is_released_on_false_alerts():
+    reception_manager = RECPTION_MANAGER(["!@>"])
+    assert reception_manager.new_chunk("Hello !").status==ROLE_CHANGE_DECISION.MOVE_ON
+    rx = reception_manager.new_chunk("x")
+    assert (rx.status, rx.value)==(ROLE_CHANGE_DECISION.FALSE_ALERT, "!x")
+    assert _receive(None, ["a!", "@b", "!@", "c"])==("a!@b!@c", None)
+
+
+def test_held_back_text_is_sent_at_the_end():
+    assert _receive(["\n\n"], ["a", "\n"])==("a\n", None)
+
+
+def test_the_first_stop_sequence_of_the_text_wins():
+    assert _receive(["bc", "ab"], ["xa", "bc"])==("x", "ab")
+
+
+def test_completion_stops_on_the_requested_stop_sequence(server, client):
+    server.binding = server.model = FakeBinding("Hello WORLD, bye")
+    response = client.post("/v1/completions", json={"prompt":"hi", "stop":["world"]})
+    assert response.json()=="Hello "